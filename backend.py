@@ -6,72 +6,289 @@ for var in ["http_proxy", "https_proxy", "all_proxy", "HTTP_PROXY", "HTTPS_PROXY
 import uvicorn
 from celery import Celery
 from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form,BackgroundTasks
+from fastapi.responses import StreamingResponse,JSONResponse
 from sqlalchemy.orm import Session
 from datetime import datetime
 
 from werkzeug.security import generate_password_hash,check_password_hash
-from dataSQL import User,get_db,Workspace,Document,Conversation
+from dataSQL import User,get_db,Workspace,Document,Conversation,IngestJob,dataSession
 from dataSchames import (RegisterRequest,RegisterResponse,UserResponse,ConversationsResponse,
-                         LoginRequest,FileItem,chatRequest,chatResponse,Message)
-from model import ChatCompletion,Embedding,RankModel
+                         LoginRequest,FileItem,chatRequest,chatResponse,Message,IngestJobResponse)
+from scheduler import BulkEmbedder
 from dataES import (DocumentMeta,ChunkInfo,QAHistory,ImageInfo,SmallRAGDB)
-from typing import List,Dict
+from typing import List,Dict,Optional
 import shutil
 import hashlib
-from utills import split_text,extract_with_pdfplumber,extract_and_split_with_pages
+import asyncio
+import time
+from pipeline import IngestPipeline,IngestCancelled,IngestResult
+from jobs import IngestWorkerPool,JobContext,TERMINAL_STATUSES
+from utills import split_text,extract_with_pdfplumber,extract_and_split_with_pages,count_pages,chunking_signature
+import config
+import runtime
+from runtime import get_llm,get_inference,get_esdb,aget_inference,aget_aesdb,aget_rerank_cache,run_blocking
+from rerank_cache import arank_with_cache
+from retrieval import RerankCascade
 
 celery_app = Celery("rag", broker="redis://localhost:6379")
 app = FastAPI(title="多用户 RAG 系统 API")
-llm = ChatCompletion()
-embed = Embedding()
-ranker = RankModel()
-ESDB = SmallRAGDB(es_url="http://localhost:9200")
-ESDB.init_indices(overwrite=False)
+# 模型与 ES 客户端均为延迟初始化的单例，见 runtime.py
+
+
+def build_document_meta(file_path:str,doc_id:int,workspace_id:int,user_username:str,file_hash:str="",
+                        abstract:str="",full_content:str="",embedding_status:str="processing") -> DocumentMeta:
+    now = datetime.utcnow()
+    return DocumentMeta(
+        doc_id=str(doc_id),
+        workspace_id=str(workspace_id),
+        user_username=user_username,
+        title=os.path.basename(file_path),
+        file_name=os.path.basename(file_path),
+        abstract=abstract + "..." if len(abstract) >= 500 else abstract,
+        full_content=full_content,  # 仅保留前 DOC_FULL_CONTENT_MAX_CHARS 个字符，全文由 chunk 索引覆盖
+        embedding_status=embedding_status,
+        file_size=os.path.getsize(file_path),
+        file_hash=file_hash,
+        created_at=now,
+        updated_at=now,
+    )
 
 
 # @celery_app.task(bind=True, max_retries=3, autoretry_for=(Exception,))
-def process_pdf_task(file_path:str,doc_id:int,workspace_id:int,user_username:str):
+def process_pdf_task(file_path:str,doc_id:int,workspace_id:int,user_username:str,file_hash:str="",
+                     ctx:Optional[JobContext]=None) -> IngestResult:
+    """
+    解析 → 向量化 → 写入 ES。ctx 不为空时上报进度并响应取消；失败时抛出异常由任务池记录
+    """
     try:
-        text_blocks,all_page_numbers = extract_and_split_with_pages(file_path)
-        full_text = "\n\n".join(text_blocks)
-        now = datetime.utcnow()
-        doc_meta = DocumentMeta(
-            doc_id=str(doc_id),
-            workspace_id=str(workspace_id),
-            user_username=user_username,
-            title=os.path.basename(file_path),
-            file_name=os.path.basename(file_path),
-            abstract=full_text[:500] + "..." if len(full_text) > 500 else full_text,
-            full_content=full_text,  # 可选：若不需要全文检索可省略
-            embedding_status="processing",
-            file_size=os.path.getsize(file_path),
-            file_hash="TODO_compute_hash",  # 建议计算 SHA256
-            created_at=now,
-            updated_at=now,
+        # 与 ES 中已有 chunk 做差异比对：首次入库全部新增；文档更新或重启恢复时只处理变化部分
+        if ctx is not None:
+            ctx.set_total_pages(count_pages(file_path))
+
+        doc_meta = build_document_meta(file_path, doc_id, workspace_id, user_username, file_hash)
+        print(f" 增加 doc_meta{doc_id} 结果",get_esdb().create_document(str(doc_id),doc_meta))
+
+        # 流式入库：解析、向量化、写 ES 三阶段并行，峰值内存与文档大小无关
+        # 入库向量化走调度器的 BULK 通道：小批执行、让在线查询优先
+        result = IngestPipeline(BulkEmbedder(get_inference()), get_esdb()).run(
+            file_path, str(doc_id), str(workspace_id), user_username,
+            on_progress=ctx.report if ctx is not None else None,
+            should_stop=ctx.cancelled if ctx is not None else None,
         )
-        print(f" 增加 doc_meta{doc_id} 结果",ESDB.create_document(str(doc_id),doc_meta))
-
-        chunk_list = []
-        chunk_id = 0
-        for page_chunks,page_num in zip(text_blocks,all_page_numbers):
-            chunk_info = ChunkInfo(
-                chunk_id=f"{doc_id}_chunk_{chunk_id*(page_num + 1)}",
-                doc_id=str(doc_id),
-                workspace_id=str(workspace_id),
-                user_username=user_username,
-                chunk_content=page_chunks,
-                page_number=page_num,
-                created_at=datetime.utcnow(),
-                embedding_vector = embed.embed(page_chunks).tolist(),
-                chunk_order = chunk_id*(page_num + 1),
-            )
-            chunk_list.append(chunk_info)
-            chunk_id += 1
-
-        ESDB.bulk_create_chunks(chunk_list)
-        ESDB.refresh_all()
+        if ctx is not None:
+            ctx.report(result.pages, result.chunks, force=True)
+            ctx.set_stats(result.normalize.as_dict())
+
+        doc_meta = build_document_meta(file_path, doc_id, workspace_id, user_username, file_hash,
+                                       abstract=result.abstract,
+                                       full_content=result.full_content,
+                                       embedding_status="completed")
+        get_esdb().create_document(str(doc_id), doc_meta)
+        get_esdb().refresh_all()
+        return result
+    except IngestCancelled as e:
+        # 被新上传的版本取代时保留已写入的 chunk，供新任务增量复用；
+        # 用户主动取消只删除本次新写入的 chunk，上一个已完成版本的 chunk 原样保留
+        if ctx is None or not ctx.superseded():
+            created = e.created_chunk_ids
+            for start in range(0, len(created), 500):
+                get_esdb().bulk_delete_chunks(created[start:start + 500])
+        raise
     except Exception as e:
         print(f"处理文件 {file_path} 时发生错误：{e}")
+        raise
+
+
+def clone_document_task(src_doc_id:int,file_path:str,doc_id:int,workspace_id:int,user_username:str,
+                        file_hash:str,ctx:Optional[JobContext]=None) -> bool:
+    """
+    同一文件（file_hash 相同）已在任意工作区用同一向量模型、同一切分配置入库完成时，直接复制其 chunk 与向量，
+    跳过解析和向量化。源文档在 ES 中不完整时返回 False，由调用方走完整流程。
+    复制期间每批检查一次取消，取消时删除已复制的部分并抛出 IngestCancelled
+    """
+    src_meta = get_esdb().get_document(str(src_doc_id))
+    if not src_meta:
+        return False
+    get_esdb().delete_chunks_by_doc(str(doc_id))
+    copied = get_esdb().clone_document_chunks(str(src_doc_id), str(doc_id), str(workspace_id), user_username,
+                                              should_stop=ctx.cancelled if ctx is not None else None)
+    if ctx is not None and ctx.cancelled():
+        if not ctx.superseded():
+            get_esdb().delete_chunks_by_doc(str(doc_id))
+        raise IngestCancelled(f"文档 {doc_id} 复制已取消")
+    if not copied:
+        return False
+
+    doc_meta = build_document_meta(file_path, doc_id, workspace_id, user_username, file_hash,
+                                   abstract=src_meta.get("abstract", "").removesuffix("..."),
+                                   full_content=src_meta.get("full_content", ""),
+                                   embedding_status="completed")
+    get_esdb().create_document(str(doc_id), doc_meta)
+    get_esdb().refresh_all()
+    if ctx is not None:
+        ctx.report(0, copied, force=True)
+    print(f"文档 {doc_id} 与文档 {src_doc_id} 内容相同，已复制 {copied} 个 chunk，跳过解析与向量化")
+    return True
+
+
+def find_reusable_document(db: Session, doc: Document) -> Optional[Document]:
+    """查找任意工作区/用户下，内容相同且已用当前向量模型、当前切分配置完成入库的文档"""
+    return db.query(Document).filter(
+        Document.file_hash == doc.file_hash,
+        Document.embedding_status == "completed",
+        Document.embedding_model == get_inference().model_id,
+        Document.chunking_config == chunking_signature(),
+        Document.id != doc.id
+    ).order_by(Document.updated_at.desc()).first()
+
+
+def run_ingest_job(job: IngestJob, ctx: JobContext):
+    doc = job.document
+    with dataSession() as db:
+        source = find_reusable_document(db, doc)
+        source_id = source.id if source is not None else None
+
+    kwargs = dict(
+        file_path=job.file_path,
+        doc_id=job.document_id,
+        workspace_id=doc.workspace_id,
+        user_username=job.user_username,
+        file_hash=doc.file_hash,
+        ctx=ctx,
+    )
+    slow_pages = None
+    if source_id is None or not clone_document_task(source_id, **kwargs):
+        slow_pages = process_pdf_task(**kwargs).slow_pages
+
+    with dataSession() as db:
+        db.query(Document).filter(Document.id == job.document_id).update(
+            {Document.embedding_model: get_inference().model_id, Document.chunking_config: chunking_signature(),
+             Document.slow_pages: slow_pages or None})
+        db.commit()
+
+
+ingest_pool = IngestWorkerPool(run_ingest_job)
+rerank_cascade = RerankCascade()
+
+
+@app.on_event("startup")
+def start_ingest_pool():
+    ingest_pool.start()
+    if config.WARMUP_ON_STARTUP:
+        runtime.start_warmup()
+
+
+@app.on_event("shutdown")
+def stop_ingest_pool():
+    ingest_pool.stop(timeout=5)
+
+
+@app.on_event("shutdown")
+async def close_runtime():
+    await runtime.aclose()
+
+
+def _job_response(job: IngestJob) -> IngestJobResponse:
+    return IngestJobResponse(
+        job_id=job.id,
+        document_id=job.document_id,
+        status=job.status,
+        pages_total=job.pages_total or 0,
+        pages_done=job.pages_done or 0,
+        chunks_done=job.chunks_done or 0,
+        attempts=job.attempts or 0,
+        error=job.error,
+        stats=job.stats,
+        created_at=job.created_at,
+        updated_at=job.updated_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+    )
+
+
+def _get_job_or_404(db: Session, job_id: int, current_user: str) -> IngestJob:
+    job = db.query(IngestJob).filter(
+        IngestJob.id == job_id,
+        IngestJob.user_username == current_user
+    ).first()
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="任务不存在或无权限"
+        )
+    return job
+
+
+@app.get("/stats")
+def get_stats():
+    """
+    运行时统计：缓存命中率等（依赖尚未初始化时对应项为 None，不会触发加载）。
+    统计中含 SQLite 查询与推理服务的 socket 调用，定义为同步接口由 FastAPI 在线程池中执行
+    """
+    inference = runtime.inference.peek()
+    rerank_cache = runtime.rerank_cache.peek()
+    vector_cache = runtime.vector_cache.peek()
+    return {
+        "embedding_cache": inference.embedding_cache_stats() if inference is not None else None,
+        "rerank_cache": rerank_cache.stats() if rerank_cache is not None else None,
+        "vector_cache": vector_cache.stats() if vector_cache is not None else None,
+        "rerank_cascade": rerank_cascade.stats(),
+        "inference_scheduler": inference.stats() if inference is not None else None,
+        "blocking_executor": runtime.blocking.stats(),
+    }
+
+
+@app.get("/healthz")
+async def healthz():
+    """存活检查：进程能响应即可，不依赖模型与 ES"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    """就绪检查：模型已加载且 ES 可连接时返回 200，否则 503，并给出各依赖的状态"""
+    deps = runtime.status()
+    ready = all(deps[name]["ready"] for name in runtime.required_dependencies())
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"ready": ready, "dependencies": deps},
+    )
+
+
+@app.get("/jobs/{job_id}", response_model=IngestJobResponse)
+async def get_job(job_id: int, current_user: str, db: Session = Depends(get_db)):
+    """轮询入库任务进度"""
+    return _job_response(_get_job_or_404(db, job_id, current_user))
+
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: int, current_user: str, db: Session = Depends(get_db)):
+    """以 Server-Sent Events 推送入库进度，任务结束后关闭连接"""
+    _get_job_or_404(db, job_id, current_user)
+
+    async def events():
+        last = None
+        while True:
+            with dataSession() as s:
+                job = s.get(IngestJob, job_id)
+                if job is None:
+                    return
+                payload = _job_response(job).model_dump_json()
+                finished = job.status in TERMINAL_STATUSES
+            if payload != last:
+                yield f"data: {payload}\n\n"
+                last = payload
+            if finished:
+                return
+            await asyncio.sleep(1)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/jobs/{job_id}/cancel", response_model=IngestJobResponse)
+async def cancel_job(job_id: int, current_user: str, db: Session = Depends(get_db)):
+    job = _get_job_or_404(db, job_id, current_user)
+    return _job_response(ingest_pool.cancel(db, job))
 
 
 
@@ -189,62 +406,36 @@ async def chat(request: chatRequest, db: Session = Depends(get_db)):
         Conversation.user_username == current_user,
         Conversation.id == conversation_id
     ).first()
-    question_vector = embed.embed(question).tolist()
-    results = ESDB.hybrid_search_chunks(question,question_vector,
-                                        workspace_id=str(workspace.id),
-                                        username=current_user,
-                                        top_k_text=10,top_k_vector=10)
-    bm25_hits,bge_hits = results["text_hits"],results["vector_hits"]
-    print("bm25_hits:",len(bm25_hits))
-    print("bge_hits:",len(bge_hits))
+    # 先向量化问题，再用一次 _msearch 同时做 BM25 与向量检索（一次 ES 往返），按 RRF 融合（按 chunk_id）。
+    # 单例未初始化时在线程池中构造，不阻塞事件循环
+    aesdb = await aget_aesdb()
+    inference = await aget_inference()
+    question_vector = (await inference.aembed(question)).tolist()
+    candidates = await aesdb.hybrid_search_chunks(question, question_vector, str(workspace.id), current_user, 10, 10)
+    print("bm25_hits:",sum(1 for c in candidates if c.bm25_rank is not None))
+    print("bge_hits:",sum(1 for c in candidates if c.knn_rank is not None))
 
     context = None
 
-    # Step 1: RRF 融合（按 chunk_id）
-    k_rrf = 60
-    fusion_score = {}
-
-    # 添加 BM25 结果
-    for rank, hit in enumerate(bm25_hits):
-        print("text: ", hit["chunk_content"])
-        chunk_id = hit["chunk_id"]
-        fusion_score[chunk_id] = fusion_score.get(chunk_id, 0) + 1.0 / (rank + 1 + k_rrf)
-
-    # 添加 BGE 向量结果
-    for rank, hit in enumerate(bge_hits):
-        print("text: ", hit["chunk_content"])
-        chunk_id = hit["chunk_id"]
-        fusion_score[chunk_id] = fusion_score.get(chunk_id, 0) + 1.0 / (rank + 1 + k_rrf)
+    # Step 2: 级联策略决定是否值得 rerank（候选过少 / 两路检索一致 / 向量得分过低的先剪枝）
+    decision = rerank_cascade.decide(candidates)
+    candidate_chunks = [c.hit for c in decision.candidates]
+    print(f"rerank 级联: {decision.branch}，候选 {len(candidate_chunks)} 个")
 
-    # 按 RRF 分数排序，取 top candidates（例如前 20 用于 rerank）
-    rrf_sorted = sorted(fusion_score.items(), key=lambda x: x[1], reverse=True)
-    top_candidate_ids = [cid for cid, score in rrf_sorted[:10]]  # 取前10个 chunk_id
-
-    if not top_candidate_ids:
-        final_results = []
-    else:
-        # Step 2: 获取完整 chunk 内容（去重后）
-        candidate_chunks = []
-        seen = set()
-        for hit in bm25_hits + bge_hits:
-            cid = hit["chunk_id"]
-            if cid in top_candidate_ids and cid not in seen:
-                candidate_chunks.append(hit)
-                seen.add(cid)
-                if len(candidate_chunks) >= len(top_candidate_ids):
-                    break
-
-        # Step 3: 用 RankModel 重排序
-        contents = [chunk["chunk_content"] for chunk in candidate_chunks]
-        print("contents:",contents)
-        rerank_scores = ranker.rank(question, contents)  # shape: (N,)
+    if decision.rerank:
+        # Step 3: 用 RankModel 重排序；命中缓存的 (问题, chunk) 对不再跑 rerank 模型
+        # 检索结果不含 rerank_token_ids，只为送入模型的候选用一次 mget 取回
+        rerank_scores = await arank_with_cache(
+            inference, await aget_rerank_cache(), question, candidate_chunks,
+            fetch_token_ids=lambda ids: aesdb.rerank_token_ids(ids, str(workspace.id)))  # shape: (N,)
 
         # 绑定分数并排序
         scored_chunks = [(chunk, score) for chunk, score in zip(candidate_chunks, rerank_scores)]
         scored_chunks.sort(key=lambda x: x[1], reverse=True)
+        candidate_chunks = [chunk for chunk, score in scored_chunks]
 
-        # Step 4: 返回最终 top-k（例如 top 5）
-        final_results = [chunk for chunk, score in scored_chunks[:5]]
+    # Step 4: 返回最终 top-k（例如 top 5）
+    final_results = candidate_chunks[:5]
 
     context = "\n".join([chunk["chunk_content"] for chunk in final_results])
     print("最终结果：", context)
@@ -254,7 +445,7 @@ async def chat(request: chatRequest, db: Session = Depends(get_db)):
         # 假设 messages 是一个 JSON 列，存储 [{"role": "user", "content": "..."}, ...]
         history: List[Dict[str, str]] = existing_conversation.messages or []
         # 调用 LLM 生成回答（传入历史）
-        answer = llm.answer_question(question, history=history, context=context)
+        answer = await run_blocking(lambda: get_llm().answer_question(question, history=history, context=context))
 
         # 将新交互加入历史
         new_history = history + [
@@ -266,7 +457,7 @@ async def chat(request: chatRequest, db: Session = Depends(get_db)):
         db.commit()
     else:
         # 新对话：无历史
-        answer = llm.answer_question(question, context=context)
+        answer = await run_blocking(lambda: get_llm().answer_question(question, context=context))
         new_conversation = Conversation(
             user_username=current_user,
             title = question,
@@ -420,9 +611,9 @@ async def upload_file(
             )
         else:
             # 内容不同 → 执行更新（覆盖）
-            # 删除旧文件（磁盘）
+            # 删除旧文件（磁盘）；新文件与旧文件同路径时刚刚已被覆盖写入，不能删除
             old_file_path = os.path.join("./data/users", current_user, same_name_doc.file_path)
-            if os.path.exists(old_file_path):
+            if os.path.exists(old_file_path) and os.path.abspath(old_file_path) != os.path.abspath(file_path):
                 os.remove(old_file_path)
 
             # 更新数据库记录
@@ -435,13 +626,18 @@ async def upload_file(
             db.commit()
             db.refresh(same_name_doc)
 
+            # 增量重建索引：只向量化新增 chunk，删除消失的 chunk，更新移动过的 chunk 位置
+            job = ingest_pool.enqueue(db, same_name_doc, file_path=str(file_path), user_username=current_user)
+
             return {
                 "success": True,
                 "message": "文件已更新",
                 "document_id": same_name_doc.id,
                 "filename": file.filename,
                 "size": file_size,
-                "modified": same_name_doc.updated_at
+                "modified": same_name_doc.updated_at,
+                "job_id": job.id,
+                "embedding_status": same_name_doc.embedding_status
             }
 
     else:
@@ -481,18 +677,8 @@ async def upload_file(
     db.commit()
     db.refresh(new_doc)
 
-    # task = process_pdf_task.delay(
-    #     file_path=str(file_path),  # 传递字符串路径
-    #     doc_id=new_doc.id,
-    #     workspace_id=workspace.id,
-    #     user_username=current_user
-    # )
-    process_pdf_task(
-        file_path=str(file_path),  # 传递字符串路径
-        doc_id=new_doc.id,
-        workspace_id=workspace.id,
-        user_username=current_user
-    )
+    # 入库改为后台任务：接口立即返回，进度通过 /jobs/{job_id} 查询
+    job = ingest_pool.enqueue(db, new_doc, file_path=str(file_path), user_username=current_user)
 
     return {
         "success": True,
@@ -501,7 +687,9 @@ async def upload_file(
         "filename": new_doc.filename,
         "size": file_size,
         "modified": new_doc.updated_at,
-        "hash": hash_hex  # 可选返回
+        "hash": hash_hex,  # 可选返回
+        "job_id": job.id,
+        "embedding_status": new_doc.embedding_status
     }
 
 @app.delete("/workspaces/{current_user}/{workspace_name}/documents/{document_name}")
@@ -531,6 +719,30 @@ async def delete_document(
             detail="文档不存在"
         )
 
+    # 先取消该文档尚未结束的入库任务：pending 直接取消，processing 等执行线程在检查点退出（最多等待片刻），
+    # 避免删除 chunk 之后旧任务又写回
+    jobs = [ingest_pool.cancel(db, job) for job in list(doc.jobs) if job.status not in TERMINAL_STATUSES]
+    running = [job.id for job in jobs if job.status == "processing"]
+    deadline = time.monotonic() + config.INGEST_CANCEL_WAIT_SECONDS
+    while running and time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+        db.expire_all()
+        running = [job_id for job_id, in db.query(IngestJob.id).filter(
+            IngestJob.id.in_(running), IngestJob.status.notin_(TERMINAL_STATUSES)).all()]
+    if running:
+        print(f"警告：文档 {doc.id} 的入库任务 {running} 未在 {config.INGEST_CANCEL_WAIT_SECONDS}s 内退出，继续删除")
+
+    # 通过存储层删除 chunk 与文档元数据，触发 chunk 监听器（向量缓存、重排缓存）失效
+    try:
+        await run_blocking(get_esdb().delete_chunks_by_doc, str(doc.id))
+        await run_blocking(get_esdb().delete_document, str(doc.id))
+    except Exception as e:
+        print(f"删除文档 {doc.id} 的索引数据失败：{e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="索引数据删除失败，请稍后重试"
+        )
+
     # 构建绝对路径并删除磁盘文件
     file_abs_path = os.path.join("./data/users", current_user, doc.file_path)
     try:
@@ -580,7 +792,9 @@ async def get_workspace_files(
             "name": doc.filename,
             "size": doc.file_size,
             "modified": doc.updated_at,
-            "id": doc.id
+            "id": doc.id,
+            "embedding_status": doc.embedding_status,
+            "slow_pages": doc.slow_pages
         })
     return files
 
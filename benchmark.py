@@ -0,0 +1,729 @@
+import os
+import json
+import argparse
+import time
+from typing import List
+
+import numpy as np
+
+"""
+性能基准脚本，用于对比优化前后的吞吐/延迟
+
+用法：
+    python benchmark.py embed --pdf data/users/dzl/uploads/default/RAG学习.pdf
+"""
+
+
+def _load_chunks(pdf_path: str, limit: int) -> List[str]:
+    from utills import extract_and_split_with_pages
+    chunks, _ = extract_and_split_with_pages(pdf_path)
+    return chunks[:limit] if limit > 0 else chunks
+
+
+def bench_embed(args):
+    """逐条 embed() 与批量 embed_batch() 的 chunks/s 对比"""
+    from model import Embedding
+
+    chunks = _load_chunks(args.pdf, args.limit)
+    embed = Embedding()
+    embed.embed_batch(chunks[:4])  # 预热，排除首次推理的初始化开销
+
+    start = time.perf_counter()
+    for chunk in chunks:
+        embed.embed(chunk)
+    single_cost = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embed.embed_batch(chunks, batch_size=args.batch_size)
+    batch_cost = time.perf_counter() - start
+
+    print(f"chunks: {len(chunks)}, batch_size: {args.batch_size}")
+    print(f"逐条 embed():      {single_cost:.2f}s  {len(chunks) / single_cost:.1f} chunks/s")
+    print(f"批量 embed_batch(): {batch_cost:.2f}s  {len(chunks) / batch_cost:.1f} chunks/s")
+    print(f"加速比: {single_cost / batch_cost:.2f}x")
+
+
+class _NullSink:
+    """只计数不写入的 bulk 目标，用于隔离 ES 网络开销"""
+    def __init__(self):
+        self.count = 0
+
+    def iter_chunk_positions(self, doc_id):
+        return iter(())
+
+    def bulk_create_chunks(self, chunks):
+        self.count += len(chunks)
+
+    def bulk_update_chunks(self, updates):
+        pass
+
+    def bulk_delete_chunks(self, chunk_ids):
+        pass
+
+
+def bench_ingest(args):
+    """一次性物化全部 chunk vs 流式流水线：墙钟时间与 Python 堆峰值"""
+    import tracemalloc
+    from model import Embedding
+    from pipeline import IngestPipeline
+    from utills import extract_and_split_with_pages
+
+    embed = Embedding()
+    embed.embed_batch(["预热"])
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    chunks, _ = extract_and_split_with_pages(args.pdf)
+    vectors = embed.embed_batch(chunks)
+    payload = [v.tolist() for v in vectors]
+    old_cost = time.perf_counter() - start
+    _, old_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del chunks, vectors, payload
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    sink = _NullSink()
+    IngestPipeline(embed, sink).run(args.pdf, "bench", "bench", "bench")
+    new_cost = time.perf_counter() - start
+    _, new_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"chunks: {sink.count}")
+    print(f"物化全部: {old_cost:.2f}s  峰值 {old_peak / 2**20:.1f} MiB")
+    print(f"流式流水线: {new_cost:.2f}s  峰值 {new_peak / 2**20:.1f} MiB")
+
+
+def bench_extract(args):
+    """不同进程数下的逐页提取耗时（每页一次 extract_text(layout=True)）"""
+    from utills import iter_page_texts
+
+    for workers in args.workers:
+        start = time.perf_counter()
+        pages = sum(1 for _ in iter_page_texts(args.pdf, workers=workers))
+        cost = time.perf_counter() - start
+        print(f"workers={workers}: {pages} 页，{cost:.2f}s，{pages / cost:.1f} 页/s")
+
+
+def bench_split(args):
+    """LangChain 按字符切分 vs 原生按 token 切分：吞吐与 chunk 的 token 长度分布"""
+    from utills import iter_page_texts, text_splitter, TokenTextSplitter, get_fast_tokenizer
+    import config
+
+    pages = [text for _, text in iter_page_texts(args.pdf)]
+    total_chars = sum(len(t) for t in pages)
+    tokenizer = get_fast_tokenizer(config.EMBEDDING_MODEL_PATH)
+    token_splitter = TokenTextSplitter()
+    token_splitter.split_text(pages[0])  # 预热：加载 tokenizer
+
+    for name, splitter in (("langchain(char)", text_splitter), ("native(token)", token_splitter)):
+        start = time.perf_counter()
+        chunks = [c for text in pages for c in splitter.split_text(text)]
+        cost = time.perf_counter() - start
+        lengths = [len(e.ids) + 2 for e in tokenizer.encode_batch(chunks, add_special_tokens=False)]
+        over = sum(1 for n in lengths if n > 512)
+        print(f"{name:16s} {cost:.3f}s  {total_chars / cost / 1e6:.2f} M字符/s  "
+              f"{len(chunks)} 个 chunk，最长 {max(lengths)} token，超出 512 的 {over} 个")
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _run_concurrent(fn, concurrency: int, requests_per_worker: int):
+    """concurrency 个线程各执行 requests_per_worker 次 fn()，返回 (总耗时, 每次延迟列表)"""
+    import threading
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(requests_per_worker):
+            t0 = time.perf_counter()
+            fn()
+            cost = time.perf_counter() - t0
+            with lock:
+                latencies.append(cost)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies
+
+
+def bench_sched(args):
+    """并发查询下：各请求直接调用模型 vs 经 InferenceScheduler 跨请求合批"""
+    from model import Embedding, RankModel
+    from scheduler import InferenceScheduler
+
+    embed, ranker = Embedding(cache=None), RankModel()
+    scheduler = InferenceScheduler(embed, ranker, max_wait_ms=args.max_wait_ms)
+    question = "检索增强生成的主要步骤有哪些？"
+    candidates = ["RAG 先检索相关文档，再把检索结果作为上下文交给大模型生成答案。"] * 10
+
+    cases = {
+        "direct": lambda: (embed.embed(question), ranker.rank_pairs([(question, c) for c in candidates])),
+        "scheduler": lambda: (scheduler.embed(question), scheduler.rank(question, candidates)),
+    }
+    for name, fn in cases.items():
+        fn()  # 预热
+        total, lat = _run_concurrent(fn, args.concurrency, args.requests)
+        print(f"{name:10s} 并发 {args.concurrency}: {len(lat) / total:.1f} req/s  "
+              f"p50 {_percentile(lat, 0.5) * 1000:.0f}ms  p99 {_percentile(lat, 0.99) * 1000:.0f}ms")
+    print(scheduler.stats())
+
+
+def bench_priority(args):
+    """后台持续入库向量化时，在线查询的延迟：BULK 优先级通道 vs 与入库同一通道排队"""
+    import threading
+    from model import Embedding, RankModel
+    from scheduler import InferenceScheduler, INTERACTIVE, BULK
+
+    embed = Embedding(cache=None)
+    scheduler = InferenceScheduler(embed, RankModel())
+    chunk = "检索增强生成把外部知识库与大模型结合，" * 20
+    question = "什么是检索增强生成？"
+
+    for name, ingest_priority in (("同一通道(FIFO)", INTERACTIVE), ("优先级通道", BULK)):
+        stop = threading.Event()
+
+        def ingest():
+            while not stop.is_set():
+                scheduler.embed_batch([chunk] * 64, priority=ingest_priority)
+
+        bg = threading.Thread(target=ingest, daemon=True)
+        bg.start()
+        time.sleep(1)
+        total, lat = _run_concurrent(lambda: scheduler.embed(question), args.concurrency, args.requests)
+        stop.set()
+        bg.join()
+        print(f"{name:14s} 查询 p50 {_percentile(lat, 0.5) * 1000:.0f}ms  p99 {_percentile(lat, 0.99) * 1000:.0f}ms")
+
+
+def _rss_mb() -> float:
+    """当前进程常驻内存（MB），仅 Linux"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def bench_onnx(args):
+    """torch 与 ONNX int8 后端的一致性（向量余弦、rerank 排序）以及延迟、内存对比"""
+    from model import Embedding, RankModel
+    from onnx_backend import OnnxEmbedding, OnnxRankModel
+
+    chunks = _load_chunks(args.pdf, args.limit)
+    question = args.question
+    backends = {}
+    for name, make in (("torch", lambda: (Embedding(), RankModel())),
+                       ("onnx", lambda: (OnnxEmbedding(), OnnxRankModel()))):
+        before = _rss_mb()
+        embed, ranker = make()
+        embed.cache = None  # 对比模型本身，不走缓存
+        backends[name] = (embed, ranker, _rss_mb() - before)
+
+    vectors, scores = {}, {}
+    for name, (embed, ranker, mem) in backends.items():
+        embed.embed_batch(chunks[:4])
+        ranker.rank_pairs([(question, c) for c in chunks[:4]])  # 预热
+
+        start = time.perf_counter()
+        vectors[name] = embed.embed_batch(chunks)
+        batch_cost = time.perf_counter() - start
+
+        lat = []
+        for _ in range(args.queries):
+            t = time.perf_counter()
+            embed.embed(question)
+            lat.append(time.perf_counter() - t)
+
+        candidates = chunks[:args.candidates]
+        start = time.perf_counter()
+        scores[name] = ranker.rank_pairs([(question, c) for c in candidates])
+        rank_cost = time.perf_counter() - start
+
+        print(f"{name:6s} 加载内存 +{mem:.0f}MB  批量向量化 {len(chunks) / batch_cost:.1f} chunks/s  "
+              f"单条查询 p50 {_percentile(lat, 0.5) * 1000:.1f}ms  "
+              f"rerank {len(candidates)} 条 {rank_cost * 1000:.0f}ms")
+
+    a, b = vectors["torch"], vectors["onnx"]
+    cos = np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    print(f"向量余弦相似度: mean {cos.mean():.4f}  min {cos.min():.4f}")
+
+    order_torch = np.argsort(-scores["torch"])
+    order_onnx = np.argsort(-scores["onnx"])
+    k = min(args.top_k, len(order_torch))
+    overlap = len(set(order_torch[:k]) & set(order_onnx[:k])) / k if k else 1.0
+    ranks_torch = np.argsort(order_torch)
+    ranks_onnx = np.argsort(order_onnx)
+    spearman = np.corrcoef(ranks_torch, ranks_onnx)[0, 1] if len(ranks_torch) > 1 else 1.0
+    print(f"rerank top-{k} 重合率: {overlap:.2%}  排序 Spearman: {spearman:.4f}  "
+          f"top-1 一致: {order_torch[0] == order_onnx[0] if k else True}")
+
+
+def bench_threads(args):
+    """不同 intra-op 线程数 × 并发数下的查询延迟/吞吐曲线，用于为当前机器选择线程预算"""
+    from model import create_embedding, create_rank_model
+
+    embed, ranker = create_embedding(cache=None), create_rank_model()
+    embed.cache = None
+    question = "检索增强生成的主要步骤有哪些？"
+    candidates = ["RAG 先检索相关文档，再把检索结果作为上下文交给大模型生成答案。" * 4] * args.candidates
+
+    def query():
+        embed.embed_batch([question])
+        ranker.rank_pairs([(question, c) for c in candidates])
+
+    print(f"os.cpu_count={os.cpu_count()}  可用核: {len(os.sched_getaffinity(0))}")
+    print(f"{'intra_op':>8s} {'并发':>4s} {'req/s':>8s} {'p50(ms)':>8s} {'p99(ms)':>8s}")
+    for intra_op in args.intra_op:
+        embed.threads.intra_op = ranker.threads.intra_op = intra_op
+        query()  # 预热
+        for concurrency in args.concurrency:
+            total, lat = _run_concurrent(query, concurrency, args.requests)
+            print(f"{intra_op:>8d} {concurrency:>4d} {len(lat) / total:>8.1f} "
+                  f"{_percentile(lat, 0.5) * 1000:>8.0f} {_percentile(lat, 0.99) * 1000:>8.0f}")
+
+
+def bench_rerank(args):
+    """rerank 时对候选原文分词 vs 使用入库时保存的 token id（只对问题分词）"""
+    from model import create_rank_model
+    from utills import encode_for_rerank
+
+    chunks = _load_chunks(args.pdf, args.candidates)
+    ranker = create_rank_model()
+    question = args.question
+
+    start = time.perf_counter()
+    token_ids = encode_for_rerank(chunks)
+    encode_cost = time.perf_counter() - start  # 入库时的一次性开销
+
+    cases = {
+        "原文分词": [(question, c) for c in chunks],
+        "预存 token id": [(question, ids) for ids in token_ids],
+    }
+    scores = {}
+    for name, pairs in cases.items():
+        ranker.rank_pairs(pairs[:4])  # 预热
+        lat = []
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            scores[name] = ranker.rank_pairs(pairs)
+            lat.append(time.perf_counter() - t)
+        print(f"{name:12s} {len(pairs)} 个候选: p50 {_percentile(lat, 0.5) * 1000:.1f}ms  "
+              f"p99 {_percentile(lat, 0.99) * 1000:.1f}ms")
+
+    tokenize_lat = []
+    for _ in range(args.repeat):
+        t = time.perf_counter()
+        ranker.tokenizer([[question, c] for c in chunks], padding=True, truncation=True, max_length=512)
+        tokenize_lat.append(time.perf_counter() - t)
+    a, b = scores.values()
+    print(f"其中候选分词耗时 p50 {_percentile(tokenize_lat, 0.5) * 1000:.1f}ms；"
+          f"入库时预计算 token id 共 {encode_cost * 1000:.1f}ms")
+    print(f"两种输入的分数最大差异: {float(np.max(np.abs(a - b))):.2e}")
+
+
+def _random_unit_vector(dim: int = 768) -> List[float]:
+    v = np.random.default_rng().standard_normal(dim).astype(np.float32)
+    return (v / np.linalg.norm(v)).tolist()
+
+
+def bench_search(args):
+    """混合检索：原先的 count + 两次 search（三次串行往返） vs 单次 _msearch"""
+    from dataES import SmallRAGDB
+    from retrieval import rrf_fuse
+    import config
+
+    db = SmallRAGDB(es_url=config.ES_URL)
+    index = db._indices["chunk"]
+
+    def three_calls(vector):
+        db.es.count(index=index)
+        text = db.es.search(index=index, body=db.bm25_chunk_body(args.question, args.workspace_id, args.username, args.top_k))
+        knn = db.es.search(index=index, body=db.knn_chunk_body(vector, args.workspace_id, args.username, args.top_k))
+        return rrf_fuse([h["_source"] for h in text["hits"]["hits"]], [h["_source"] for h in knn["hits"]["hits"]])
+
+    def msearch(vector):
+        return db.hybrid_search_chunks(args.question, vector, args.workspace_id, args.username, args.top_k, args.top_k)
+
+    vectors = [_random_unit_vector() for _ in range(args.repeat)]
+    for name, fn in (("count + 2×search", three_calls), ("_msearch", msearch)):
+        fn(vectors[0])  # 预热
+        lat = []
+        for vector in vectors:
+            t = time.perf_counter()
+            fn(vector)
+            lat.append(time.perf_counter() - t)
+        print(f"{name:18s} p50 {_percentile(lat, 0.5) * 1000:.1f}ms  p99 {_percentile(lat, 0.99) * 1000:.1f}ms")
+
+
+def bench_projection(args):
+    """检索结果带 / 不带 embedding_vector：响应体大小、JSON 反序列化耗时与端到端延迟"""
+    from dataES import SmallRAGDB
+    import config
+
+    db = SmallRAGDB(es_url=config.ES_URL)
+    index = db._indices["chunk"]
+    vectors = [_random_unit_vector() for _ in range(args.repeat)]
+    for name, include in (("含向量", True), ("默认投影", False)):
+        projection = db._projection("chunk", ["embedding_vector"] if include else [])
+        sizes, decode, lat = [], [], []
+        for vector in vectors:
+            body = {**db.knn_chunk_body(vector, args.workspace_id, args.username, args.top_k), **projection}
+            t = time.perf_counter()
+            res = db.es.search(index=index, body=body)
+            lat.append(time.perf_counter() - t)
+            raw = json.dumps(res.body)
+            sizes.append(len(raw))
+            t = time.perf_counter()
+            json.loads(raw)
+            decode.append(time.perf_counter() - t)
+        print(f"{name:6s} 响应体 {np.mean(sizes) / 1024:.1f}KB  反序列化 {np.mean(decode) * 1000:.2f}ms  "
+              f"p50 {_percentile(lat, 0.5) * 1000:.1f}ms  p99 {_percentile(lat, 0.99) * 1000:.1f}ms")
+
+
+def bench_chat(args):
+    """
+    并发 chat 的检索 + 生成链路：同步 ES 客户端与同步 LLM 调用直接跑在事件循环里（原实现）
+    vs AsyncElasticsearch + 阻塞调用交给有界执行器。异步客户端下对比两种检索方式：
+    向量化后一次 _msearch（/chat 采用）vs BM25 与向量化重叠、kNN 单独一次请求（两次 ES 往返）。
+    默认用 time.sleep 模拟 LLM 耗时（--real-llm 调用真实接口）。
+    """
+    import asyncio
+    import config
+    from dataES import SmallRAGDB, AsyncSmallRAGDB
+    from retrieval import rrf_fuse
+    from runtime import BlockingExecutor, get_inference, get_llm
+
+    inference = get_inference()
+    db = SmallRAGDB(es_url=config.ES_URL)
+    questions = [f"{args.question} #{i}" for i in range(args.concurrency)]
+
+    def generate(question: str, candidates) -> str:
+        context = "\n".join(c.hit["chunk_content"] for c in candidates[:5])
+        if args.real_llm:
+            return get_llm().answer_question(question, context=context)
+        time.sleep(args.llm_ms / 1000)
+        return context
+
+    async def blocking_chat(question: str):
+        vector = (await inference.aembed(question)).tolist()
+        candidates = db.hybrid_search_chunks(question, vector, args.workspace_id, args.username, 10, 10)
+        generate(question, candidates)
+
+    async def async_chat(aesdb, executor, question: str):
+        vector = (await inference.aembed(question)).tolist()
+        candidates = await aesdb.hybrid_search_chunks(question, vector, args.workspace_id, args.username, 10, 10)
+        await executor.run(generate, question, candidates)
+
+    async def overlapped_chat(aesdb, executor, question: str):
+        bm25 = asyncio.create_task(aesdb.bm25_search_chunks(question, args.workspace_id, args.username, size=10))
+        vector = (await inference.aembed(question)).tolist()
+        knn = await aesdb.knn_search_chunks(vector, args.workspace_id, args.username, k=10)
+        await executor.run(generate, question, rrf_fuse(await bm25, knn))
+
+    async def measure(chat):
+        lat = []
+
+        async def one(question):
+            t = time.perf_counter()
+            await chat(question)
+            lat.append(time.perf_counter() - t)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(q) for q in questions))
+        return time.perf_counter() - start, lat
+
+    async def main():
+        aesdb = AsyncSmallRAGDB(es_url=config.ES_URL)
+        aesdb.layout_source = db
+        executor = BlockingExecutor(max_workers=args.workers)
+        try:
+            for name, chat in (("同步客户端", blocking_chat),
+                               ("异步·msearch", lambda q: async_chat(aesdb, executor, q)),
+                               ("异步·重叠", lambda q: overlapped_chat(aesdb, executor, q))):
+                await chat(questions[0])  # 预热
+                total, lat = await measure(chat)
+                print(f"{name}  {len(questions)} 并发：总耗时 {total:.2f}s  吞吐 {len(questions) / total:.1f} chat/s  "
+                      f"p50 {_percentile(lat, 0.5) * 1000:.0f}ms  p99 {_percentile(lat, 0.99) * 1000:.0f}ms")
+        finally:
+            await aesdb.close()
+            executor.shutdown()
+
+    asyncio.run(main())
+
+
+def bench_store(args):
+    """小工作区检索：嵌入式 LocalStore vs ES（ES 不可达时只测本地），各规模下的入库耗时与混合检索延迟"""
+    import shutil
+    import tempfile
+    import uuid
+    from datetime import datetime, timezone
+    from dataES import SmallRAGDB
+    from local_store import LocalStore
+    import config
+
+    texts = _load_chunks(args.pdf, 0) if args.pdf else []
+    rng = np.random.default_rng(0)
+    alphabet = list("检索增强生成向量模型文档知识库问答系统分词倒排索引相似度排序数据存储查询片段")
+
+    def text(i: int) -> str:
+        if texts:
+            return texts[i % len(texts)]
+        return "".join(rng.choice(alphabet, size=120))
+
+    def chunk(i: int) -> dict:
+        return {
+            "chunk_id": f"bench_{i}", "doc_id": f"bench_doc_{i // 50}", "workspace_id": "bench_ws",
+            "user_username": "bench", "chunk_content": text(i), "embedding_vector": _random_unit_vector(),
+            "chunk_order": i, "created_at": datetime.now(timezone.utc),
+        }
+
+    backends = [("local", lambda: LocalStore(path=tempfile.mkdtemp(prefix="smallrag_bench_")))]
+    es_probe = SmallRAGDB(es_url=config.ES_URL)
+    if es_probe.ping():
+        backends.append(("es", lambda: SmallRAGDB(es_url=config.ES_URL, index_prefix=f"bench_{uuid.uuid4().hex[:8]}")))
+    else:
+        print("⚠️ ES 不可达，只测试本地存储")
+
+    questions = ["什么是检索增强生成", "向量相似度排序", "倒排索引如何存储"]
+    for size in args.sizes:
+        chunks = [chunk(i) for i in range(size)]
+        for name, factory in backends:
+            db = factory()
+            db.init_indices(overwrite=True)
+            t = time.perf_counter()
+            for start in range(0, size, 256):
+                db.bulk_create_chunks(chunks[start:start + 256])
+            db.refresh_all()
+            ingest = time.perf_counter() - t
+            lat = []
+            for i in range(args.repeat):
+                vector = _random_unit_vector()
+                t = time.perf_counter()
+                db.hybrid_search_chunks(questions[i % len(questions)], vector, "bench_ws", "bench", 10, 10)
+                lat.append(time.perf_counter() - t)
+            print(f"{name:5s} {size:6d} chunks  入库 {ingest:.2f}s  "
+                  f"检索 p50 {_percentile(lat, 0.5) * 1000:.1f}ms  p99 {_percentile(lat, 0.99) * 1000:.1f}ms")
+            if isinstance(db, LocalStore):
+                db.close()
+                shutil.rmtree(db.path, ignore_errors=True)
+            else:
+                db.delete_indices()
+
+
+def bench_vcache(args):
+    """
+    热点工作区向量缓存：各规模/精度下进程内 top-k 的延迟、内存与 recall@k（以 float32 精确结果为准）；
+    给出 --workspace-id 且 ES 可达时，再对比该工作区走 ES kNN 与走缓存的混合检索延迟
+    """
+    from vector_cache import WorkspaceVectorCache
+
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        vectors = rng.standard_normal((size, 768)).astype(np.float32)
+        rows = (list(range(size)), ["bench"] * size, [f"doc_{i // 50}" for i in range(size)], vectors)
+        queries = [_random_unit_vector() for _ in range(args.repeat)]
+        exact = None
+        for dtype in ("float32", "float16", "int8"):
+            cache = WorkspaceVectorCache(loader=lambda ws, n: rows, max_bytes=1 << 40, dtype=dtype)
+            cache.search("bench_ws", queries[0], "bench", args.top_k)  # 触发加载
+            cache._pool.shutdown(wait=True)
+            results, lat = [], []
+            for q in queries:
+                t = time.perf_counter()
+                results.append([cid for cid, _ in cache.search("bench_ws", q, "bench", args.top_k)])
+                lat.append(time.perf_counter() - t)
+            exact = exact or results
+            recall = np.mean([len(set(a) & set(b)) / args.top_k for a, b in zip(results, exact)])
+            print(f"{size:6d} chunks {dtype:8s} 内存 {cache.stats()['memory_mb']:.1f}MB  recall@{args.top_k} {recall:.3f}  "
+                  f"p50 {_percentile(lat, 0.5) * 1000:.2f}ms  p99 {_percentile(lat, 0.99) * 1000:.2f}ms")
+
+    if not args.workspace_id:
+        return
+    from dataES import SmallRAGDB
+    import config
+
+    db = SmallRAGDB(es_url=config.ES_URL)
+    if not db.ping():
+        print("⚠️ ES 不可达，跳过 ES 对比")
+        return
+    cache = WorkspaceVectorCache(loader=db.load_workspace_vectors, probe=db.workspace_signature)
+    vectors = [_random_unit_vector() for _ in range(args.repeat)]
+    for name, vc in (("ES kNN", None), ("向量缓存", cache)):
+        db.vector_cache = vc
+        db.hybrid_search_chunks(args.question, vectors[0], args.workspace_id, args.username, args.top_k, args.top_k)
+        cache._pool.shutdown(wait=True)  # 等待工作区加载完成
+        lat = []
+        for vector in vectors:
+            t = time.perf_counter()
+            db.hybrid_search_chunks(args.question, vector, args.workspace_id, args.username, args.top_k, args.top_k)
+            lat.append(time.perf_counter() - t)
+        print(f"{name:8s} p50 {_percentile(lat, 0.5) * 1000:.1f}ms  p99 {_percentile(lat, 0.99) * 1000:.1f}ms")
+    print(json.dumps(cache.stats(), ensure_ascii=False))
+
+
+def bench_tenants(args):
+    """
+    租户数增长时的混合检索延迟：旧布局（单索引、workspace_id + user_username 两个过滤、检索扫描全部分片）
+    vs 租户布局（按工作区 routing、tenant_key 单一过滤）。每个租户写入 --chunks-per-tenant 个随机 chunk（需要 ES）
+    """
+    import uuid
+    from datetime import datetime, timezone
+    from dataES import SmallRAGDB
+    import config
+
+    if not SmallRAGDB(es_url=config.ES_URL).ping():
+        print("⚠️ ES 不可达")
+        return
+    rng = np.random.default_rng(0)
+    alphabet = list("检索增强生成向量模型文档知识库问答系统分词倒排索引相似度排序数据存储查询片段")
+    questions = ["什么是检索增强生成", "向量相似度排序", "倒排索引如何存储"]
+
+    def create(layout: str) -> SmallRAGDB:
+        db = SmallRAGDB(es_url=config.ES_URL, index_prefix=f"bench_{layout}_{uuid.uuid4().hex[:8]}",
+                        chunk_shards=args.shards)
+        if layout == "legacy":
+            # 迁移前的布局：chunk 索引名即实体索引，mapping 不要求 routing
+            mappings = {k: v for k, v in db._get_mappings()["chunk"]["mappings"].items() if k != "_routing"}
+            db.es.indices.create(index=db._indices["chunk"],
+                                 body={"mappings": mappings, "settings": {"number_of_shards": args.shards}})
+        db.init_indices(overwrite=False)
+        assert db.tenant_routing == (layout == "tenant")
+        return db
+
+    for tenants in args.tenants:
+        chunks = [{
+            "chunk_id": f"t{t}_c{i}", "doc_id": f"t{t}_doc{i // 20}", "workspace_id": f"ws{t}",
+            "user_username": f"user{t}", "chunk_content": "".join(rng.choice(alphabet, size=120)),
+            "embedding_vector": _random_unit_vector(), "chunk_order": i, "created_at": datetime.now(timezone.utc),
+        } for t in range(tenants) for i in range(args.chunks_per_tenant)]
+        for layout in ("legacy", "tenant"):
+            db = create(layout)
+            try:
+                for start in range(0, len(chunks), 500):
+                    db.bulk_create_chunks(chunks[start:start + 500])
+                db.refresh_all()
+                picks = rng.integers(0, tenants, size=args.repeat)
+                db.hybrid_search_chunks(questions[0], _random_unit_vector(), "ws0", "user0", 10, 10)  # 预热
+                lat = []
+                for i, t in enumerate(picks):
+                    vector = _random_unit_vector()
+                    start = time.perf_counter()
+                    db.hybrid_search_chunks(questions[i % len(questions)], vector, f"ws{t}", f"user{t}", 10, 10)
+                    lat.append(time.perf_counter() - start)
+                print(f"{tenants:5d} 租户 {len(chunks):7d} chunks  {layout:6s}  "
+                      f"p50 {_percentile(lat, 0.5) * 1000:.1f}ms  p99 {_percentile(lat, 0.99) * 1000:.1f}ms")
+            finally:
+                db.delete_indices()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SmallRAG 性能基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("embed", help="逐条 vs 批量向量化")
+    p.add_argument("--pdf", required=True)
+    p.add_argument("--limit", type=int, default=0, help="最多使用多少个 chunk，0 表示全部")
+    p.add_argument("--batch-size", type=int, default=32)
+    p.set_defaults(func=bench_embed)
+
+    p = sub.add_parser("ingest", help="物化 vs 流式入库")
+    p.add_argument("--pdf", required=True)
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser("extract", help="串行 vs 多进程逐页提取")
+    p.add_argument("--pdf", required=True)
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.set_defaults(func=bench_extract)
+
+    p = sub.add_parser("split", help="字符切分 vs token 切分")
+    p.add_argument("--pdf", required=True)
+    p.set_defaults(func=bench_split)
+
+    p = sub.add_parser("sched", help="直接调用 vs 跨请求微批")
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--requests", type=int, default=20, help="每个并发线程发起的请求数")
+    p.add_argument("--max-wait-ms", type=float, default=5)
+    p.set_defaults(func=bench_sched)
+
+    p = sub.add_parser("priority", help="入库期间的在线查询延迟")
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--requests", type=int, default=20)
+    p.set_defaults(func=bench_priority)
+
+    p = sub.add_parser("onnx", help="torch vs ONNX int8 后端：一致性、延迟与内存")
+    p.add_argument("--pdf", required=True)
+    p.add_argument("--limit", type=int, default=256)
+    p.add_argument("--question", default="什么是检索增强生成？")
+    p.add_argument("--queries", type=int, default=50, help="单条查询延迟的采样次数")
+    p.add_argument("--candidates", type=int, default=50, help="参与 rerank 的候选数")
+    p.add_argument("--top-k", type=int, default=5)
+    p.set_defaults(func=bench_onnx)
+
+    p = sub.add_parser("threads", help="推理线程预算扫描：延迟/吞吐曲线")
+    p.add_argument("--intra-op", type=int, nargs="+", default=[1, 2, 4, 8])
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    p.add_argument("--requests", type=int, default=10, help="每个并发线程发起的请求数")
+    p.add_argument("--candidates", type=int, default=10, help="每个请求 rerank 的候选数")
+    p.set_defaults(func=bench_threads)
+
+    p = sub.add_parser("rerank", help="rerank 候选原文分词 vs 预存 token id")
+    p.add_argument("--pdf", required=True)
+    p.add_argument("--question", default="什么是检索增强生成？")
+    p.add_argument("--candidates", type=int, default=20)
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_rerank)
+
+    p = sub.add_parser("search", help="混合检索：三次往返 vs 单次 _msearch（需要 ES）")
+    p.add_argument("--workspace-id", required=True)
+    p.add_argument("--username", required=True)
+    p.add_argument("--question", default="什么是检索增强生成？")
+    p.add_argument("--top-k", type=int, default=10)
+    p.add_argument("--repeat", type=int, default=50)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("projection", help="检索结果是否回传向量：响应体大小与延迟（需要 ES）")
+    p.add_argument("--workspace-id", required=True)
+    p.add_argument("--username", required=True)
+    p.add_argument("--top-k", type=int, default=10)
+    p.add_argument("--repeat", type=int, default=50)
+    p.set_defaults(func=bench_projection)
+
+    p = sub.add_parser("chat", help="并发 chat：同步客户端 vs 异步客户端 + 有界执行器（需要 ES 与模型）")
+    p.add_argument("--workspace-id", required=True)
+    p.add_argument("--username", required=True)
+    p.add_argument("--question", default="什么是检索增强生成？")
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--workers", type=int, default=16, help="有界执行器线程数")
+    p.add_argument("--llm-ms", type=float, default=500, help="模拟 LLM 生成耗时（毫秒）")
+    p.add_argument("--real-llm", action="store_true", help="调用真实 LLM 接口")
+    p.set_defaults(func=bench_chat)
+
+    p = sub.add_parser("store", help="嵌入式本地存储 vs ES：不同工作区规模下的入库与混合检索")
+    p.add_argument("--pdf", help="用 PDF 切分出的文本作为 chunk 内容，缺省时随机生成")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    p.add_argument("--repeat", type=int, default=50)
+    p.set_defaults(func=bench_store)
+
+    p = sub.add_parser("vcache", help="热点工作区向量缓存：进程内 top-k 的延迟/内存/召回，可选对比 ES kNN")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    p.add_argument("--top-k", type=int, default=10)
+    p.add_argument("--repeat", type=int, default=100)
+    p.add_argument("--workspace-id", help="给出时对比该工作区走 ES kNN 与走缓存的混合检索（需要 ES）")
+    p.add_argument("--username", default="dzl")
+    p.add_argument("--question", default="什么是检索增强生成")
+    p.set_defaults(func=bench_vcache)
+
+    p = sub.add_parser("tenants", help="旧布局 vs 按工作区 routing 的租户布局：租户数增长时的混合检索延迟（需要 ES）")
+    p.add_argument("--tenants", type=int, nargs="+", default=[10, 100, 1000])
+    p.add_argument("--chunks-per-tenant", type=int, default=50)
+    p.add_argument("--shards", type=int, default=4)
+    p.add_argument("--repeat", type=int, default=100)
+    p.set_defaults(func=bench_tenants)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,123 @@
+import os
+
+"""
+集中管理后端可调参数，均可通过同名环境变量覆盖
+"""
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+# -------------------------
+# 模型路径
+# -------------------------
+EMBEDDING_MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH", "/home/dzl/PycharmProjects/SmallRag/BAAI/bge-base-zh-v1.5")
+RERANK_MODEL_PATH = os.getenv("RERANK_MODEL_PATH", "/home/dzl/PycharmProjects/SmallRag/BAAI/bge-reranker-base")
+
+# -------------------------
+# 服务
+# -------------------------
+ES_URL = os.getenv("ES_URL", "http://localhost:9200")
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") == "1"  # 启动后在后台加载模型并跑一次空前向
+ES_CONNECTIONS_PER_NODE = _env_int("ES_CONNECTIONS_PER_NODE", 64)   # 每个 ES 节点的连接池上限，应不小于并发检索数
+ES_REQUEST_TIMEOUT = float(os.getenv("ES_REQUEST_TIMEOUT", "10"))  # 单次 ES 请求超时（秒）
+ES_MAX_RETRIES = _env_int("ES_MAX_RETRIES", 2)                     # 连接失败/超时的重试次数
+ES_CHUNK_SHARDS = _env_int("ES_CHUNK_SHARDS", 4)                   # 新建 chunk 索引的主分片数；按工作区 routing 后每次检索只访问其中一个
+ES_LAYOUT_CHECK_SECONDS = float(os.getenv("ES_LAYOUT_CHECK_SECONDS", "30"))  # 检查 chunk 别名是否被 migrate_chunks.py 切换的最小间隔
+BLOCKING_EXECUTOR_WORKERS = _env_int("BLOCKING_EXECUTOR_WORKERS", 16)  # async 接口中阻塞调用（LLM、同步 SDK）的线程数
+BLOCKING_EXECUTOR_QUEUE = _env_int("BLOCKING_EXECUTOR_QUEUE", 256)     # 排队中的阻塞调用上限，超出时请求在协程中等待
+
+# -------------------------
+# 存储后端
+# -------------------------
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "es")  # es：Elasticsearch；local：嵌入式存储（local_store.py），无需 ES
+LOCAL_STORE_DIR = os.getenv("LOCAL_STORE_DIR", "./data/local_store")
+LOCAL_VECTOR_INDEX = os.getenv("LOCAL_VECTOR_INDEX", "exact")   # exact：精确计算；hnsw：hnswlib 近似索引（需安装 hnswlib）
+LOCAL_HNSW_MIN_SIZE = _env_int("LOCAL_HNSW_MIN_SIZE", 20000)    # 工作区向量数达到该值才建 HNSW，小工作区精确计算更快
+LOCAL_TOKENIZER = os.getenv("LOCAL_TOKENIZER", "bigram")        # bigram：中文按字二元组切分；jieba：jieba 搜索模式分词（需安装 jieba）
+
+# -------------------------
+# 向量化
+# -------------------------
+EMBED_BATCH_SIZE = _env_int("EMBED_BATCH_SIZE", 32)  # 每次前向推理的文本条数
+
+# -------------------------
+# 推理后端
+# -------------------------
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")  # torch：PyTorch 原模型；onnx：ONNX Runtime CPU 推理
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "./data/onnx")  # 导出的 ONNX 模型目录，缺失时首次启动自动导出
+ONNX_QUANTIZE = os.getenv("ONNX_QUANTIZE", "1") == "1"       # 权重动态量化为 int8
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "local")  # local：进程内加载模型；remote：连接共享推理服务（inference_server.py）
+INFERENCE_SOCKET = os.getenv("INFERENCE_SOCKET", "/tmp/smallrag-inference.sock")
+INFERENCE_POOL_SIZE = _env_int("INFERENCE_POOL_SIZE", 8)  # 每个 API 进程到推理服务的最大连接数
+
+# -------------------------
+# 推理线程预算（避免 torch 默认占满所有核，与 FastAPI 线程池、多 worker 叠加后过度订阅 CPU）
+# -------------------------
+EMBED_INTRA_OP_THREADS = _env_int("EMBED_INTRA_OP_THREADS", 0)  # 单个算子内的并行线程数，0 为框架默认
+EMBED_INTER_OP_THREADS = _env_int("EMBED_INTER_OP_THREADS", 0)  # 算子间并行线程数；torch 下为进程级，取两模型的最大值
+EMBED_CPU_AFFINITY = os.getenv("EMBED_CPU_AFFINITY", "")         # 绑核，如 "0-3"；空为不绑定
+RANK_INTRA_OP_THREADS = _env_int("RANK_INTRA_OP_THREADS", 0)
+RANK_INTER_OP_THREADS = _env_int("RANK_INTER_OP_THREADS", 0)
+RANK_CPU_AFFINITY = os.getenv("RANK_CPU_AFFINITY", "")
+
+# -------------------------
+# 入库流水线
+# -------------------------
+ES_BULK_SIZE = _env_int("ES_BULK_SIZE", 256)                # 每次 bulk 写入 ES 的文档数
+PIPELINE_QUEUE_SIZE = _env_int("PIPELINE_QUEUE_SIZE", 4)    # 各阶段之间的有界队列长度（单位：批次）
+DOC_FULL_CONTENT_MAX_CHARS = _env_int("DOC_FULL_CONTENT_MAX_CHARS", 20000)  # 文档元数据 full_content 保留的最大字符数
+PDF_EXTRACT_WORKERS = _env_int("PDF_EXTRACT_WORKERS", 1)          # PDF 逐页提取的进程数，1 为串行
+PDF_EXTRACT_SHARD_PAGES = _env_int("PDF_EXTRACT_SHARD_PAGES", 8)  # 并行提取时每个任务负责的页数
+INGEST_WORKERS = _env_int("INGEST_WORKERS", 1)  # 后台入库任务的并发线程数
+INGEST_LEASE_SECONDS = _env_int("INGEST_LEASE_SECONDS", 60)  # 执行中任务的租约时长；持有进程超过该时间未续约，任务才会被其他进程重新领取
+INGEST_CANCEL_WAIT_SECONDS = _env_int("INGEST_CANCEL_WAIT_SECONDS", 10)  # 删除文档时等待其执行中任务退出的最长时间
+
+# -------------------------
+# 向量缓存
+# -------------------------
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "1") == "1"
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "./data/cache/embedding_cache.db")
+EMBED_CACHE_MAX_MB = _env_int("EMBED_CACHE_MAX_MB", 1024)  # 超出后按 LRU 淘汰
+RERANK_CACHE_ENABLED = os.getenv("RERANK_CACHE_ENABLED", "1") == "1"
+RERANK_CACHE_SIZE = _env_int("RERANK_CACHE_SIZE", 100000)  # (问题, chunk) 分数条目上限，按 LRU 淘汰
+RERANK_PRETOKENIZE = os.getenv("RERANK_PRETOKENIZE", "1") == "1"  # 入库时保存 chunk 的 rerank token id，查询时免去对候选分词
+# 热点工作区向量常驻内存，kNN 在进程内计算（仅 STORAGE_BACKEND=es；本地存储本身就在进程内）
+VECTOR_CACHE_ENABLED = os.getenv("VECTOR_CACHE_ENABLED", "1") == "1"
+VECTOR_CACHE_MAX_MB = _env_int("VECTOR_CACHE_MAX_MB", 512)          # 所有工作区合计的内存预算，超出后按 LRU 淘汰整个工作区
+VECTOR_CACHE_MAX_CHUNKS = _env_int("VECTOR_CACHE_MAX_CHUNKS", 20000)  # chunk 数超过该值的工作区不缓存，始终走 ES kNN
+VECTOR_CACHE_CHECK_SECONDS = float(os.getenv("VECTOR_CACHE_CHECK_SECONDS", "5"))        # 命中时探测其他进程写入的最小间隔
+VECTOR_CACHE_DEBOUNCE_SECONDS = float(os.getenv("VECTOR_CACHE_DEBOUNCE_SECONDS", "2"))  # 工作区写入停止多久后才重新加载，应不小于 ES refresh_interval
+# int8（每行缩放系数）：内存为 float32 的 1/4，分块反量化后检索最快；float16：精度更高，但 numpy 的半精度转换较慢；float32
+VECTOR_CACHE_DTYPE = os.getenv("VECTOR_CACHE_DTYPE", "int8")
+
+# -------------------------
+# 文本切分
+# -------------------------
+TEXT_SPLITTER = os.getenv("TEXT_SPLITTER", "token")           # token：按模型 token 计长；char：按字符计长（旧行为）
+CHUNK_SIZE_TOKENS = _env_int("CHUNK_SIZE_TOKENS", 448)        # 为 rerank 时拼接的问题预留约 60 个 token
+CHUNK_OVERLAP_TOKENS = _env_int("CHUNK_OVERLAP_TOKENS", 48)
+NORMALIZE_TEXT = os.getenv("NORMALIZE_TEXT", "1") == "1"      # 压缩版面空白并去除页眉页脚
+HEADER_FOOTER_WINDOW = _env_int("HEADER_FOOTER_WINDOW", 8)     # 用于识别页眉页脚的前若干页
+NORMALIZE_COUNT_RAW_CHUNKS = os.getenv("NORMALIZE_COUNT_RAW_CHUNKS", "0") == "1"  # 统计规范化前的 chunk 数（需对原文再切分一次，仅评估时开启）
+PAGE_TIME_BUDGET = float(os.getenv("PAGE_TIME_BUDGET", "0"))   # 单页提取耗时上限（秒），0 表示不限制；入库线程中串行提取时需借助子进程计时
+PAGE_TIMEOUT_ACTION = os.getenv("PAGE_TIMEOUT_ACTION", "fallback")  # 超时处理：fallback 降级为非 layout 模式；skip 跳过该页
+
+# -------------------------
+# 检索与 rerank 级联
+# -------------------------
+CASCADE_ENABLED = os.getenv("CASCADE_ENABLED", "1") == "1"                  # 关闭时总是对 RRF 前 CASCADE_MAX_RERANK 个候选 rerank
+CASCADE_MIN_CANDIDATES = _env_int("CASCADE_MIN_CANDIDATES", 3)            # 候选少于该值时直接按 RRF 顺序返回
+CASCADE_AGREEMENT_TOP_K = _env_int("CASCADE_AGREEMENT_TOP_K", 3)          # 两路检索前 k 名完全一致时跳过 rerank，0 关闭
+CASCADE_MIN_VECTOR_SCORE = float(os.getenv("CASCADE_MIN_VECTOR_SCORE", "0.6"))  # 向量得分 (1+cos)/2 低于该值的候选先剪掉，0 关闭
+CASCADE_MAX_RERANK = _env_int("CASCADE_MAX_RERANK", 10)                   # 送入 rerank 的候选上限
+
+# -------------------------
+# 在线推理调度（跨请求微批）
+# -------------------------
+SCHED_MAX_BATCH_EMBED = _env_int("SCHED_MAX_BATCH_EMBED", 32)   # 单次前向最多合并的查询条数
+SCHED_MAX_BATCH_RANK = _env_int("SCHED_MAX_BATCH_RANK", 64)     # 单次前向最多合并的 (问题, 候选) 对数
+SCHED_MAX_WAIT_MS = float(os.getenv("SCHED_MAX_WAIT_MS", "5"))   # 凑批最长等待时间
+SCHED_MAX_BATCH_BULK = _env_int("SCHED_MAX_BATCH_BULK", 8)     # 有在线请求排队时后台入库每批上限，决定插队前最多等待多久；空闲时增长到 EMBED_BATCH_SIZE
@@ -1,11 +1,19 @@
+import asyncio
+import functools
+import time
+from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import Optional, Dict, Any, List, Union
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, Iterator, List, Tuple, Union, Callable, Set
 from pydantic import BaseModel, Field, ConfigDict
-from elasticsearch import Elasticsearch, NotFoundError, ConnectionError as ESConnectionError
-from elasticsearch.helpers import bulk
+from elasticsearch import Elasticsearch, AsyncElasticsearch, NotFoundError, BadRequestError, ConnectionError as ESConnectionError
+from elasticsearch.helpers import bulk, scan, BulkIndexError
 from elasticsearch.exceptions import TransportError
 import traceback
 import logging
+import numpy as np
+import config
+from retrieval import Candidate, rrf_fuse
 
 # 可选：配置日志
 logging.basicConfig(level=logging.INFO)
@@ -40,6 +48,9 @@ class ChunkInfo(BaseModel):
     embedding_vector: List[float] = Field(..., min_length=768, max_length=768)
     chunk_order: int
     page_number: Optional[int] = None
+    content_hash: Optional[str] = None  # 规范化文本的 SHA-256，用于增量更新时比对 chunk
+    rerank_token_ids: Optional[List[int]] = None  # rerank 模型词表下的 token id（不含特殊符号），不建索引
+    rerank_tokenizer: Optional[str] = None        # 生成 rerank_token_ids 所用的分词器，换模型后旧 id 不再使用
     metadata: dict = Field(default_factory=dict)
     created_at: datetime
 
@@ -70,12 +81,21 @@ class ImageInfo(BaseModel):
     format: str
     created_at: datetime
 
+@dataclass
+class ChunkChange:
+    """chunk 写入/删除事件，供缓存（rerank 分数、热点工作区向量等）失效使用"""
+    action: str                                           # upsert / delete
+    chunk_ids: List[str] = field(default_factory=list)    # 为空时以 doc_id 表示整篇文档
+    doc_id: Optional[str] = None
+    workspace_ids: Set[str] = field(default_factory=set)  # 受影响的全部工作区（非空时必须完整），为空表示未知
+
 # -------------------------
 # 工具函数：安全执行 ES 操作
 # -------------------------
 
 def safe_es_call(func):
     """装饰器：统一捕获 ES 异常"""
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
@@ -93,20 +113,374 @@ def safe_es_call(func):
             raise
     return wrapper
 
+
+def _is_routing_missing(e: Exception) -> bool:
+    return "routing_missing_exception" in str(getattr(e, "errors", None) or e)
+
+
+def retry_on_layout_change(func):
+    """
+    装饰器：chunk 写入前按 ES_LAYOUT_CHECK_SECONDS 间隔检查布局；遇到 routing_missing
+    （chunk 别名已被 migrate_chunks.py 切换到租户布局）时立即重新检测，布局确有变化则重试一次
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            self.refresh_tenant_routing()
+        except Exception as e:
+            logger.warning(f"⚠️ 检查 chunk 索引布局失败: {e}")
+        try:
+            return func(self, *args, **kwargs)
+        except (BadRequestError, BulkIndexError) as e:
+            if not _is_routing_missing(e) or not self.refresh_tenant_routing(force=True):
+                raise
+            logger.warning(f"⚠️ chunk 索引布局已变化，按新布局重试 {func.__name__}")
+            return func(self, *args, **kwargs)
+    return wrapper
+
 # -------------------------
-# Elasticsearch 数据库管理类（增强版）
+# 检索请求体构造与结果解析（同步 / 异步客户端共用）
 # -------------------------
 
-class SmallRAGDB:
-    def __init__(self, es_url: str = "http://localhost:9200"):
-        self.es = Elasticsearch(es_url)
-        self._indices = {
-            "document": "smallrag_document_meta",
-            "chunk": "smallrag_chunk_info",
-            "qa": "smallrag_qa_history",
-            "image": "smallrag_image_info"
+def _client_options() -> Dict[str, Any]:
+    """同步 / 异步客户端共用的连接池与超时设置"""
+    return {
+        "connections_per_node": config.ES_CONNECTIONS_PER_NODE,
+        "request_timeout": config.ES_REQUEST_TIMEOUT,
+        "max_retries": config.ES_MAX_RETRIES,
+        "retry_on_timeout": True,
+    }
+
+def _index_names(prefix: str = "smallrag") -> Dict[str, str]:
+    return {
+        "document": f"{prefix}_document_meta",
+        "chunk": f"{prefix}_chunk_info",
+        "qa": f"{prefix}_qa_history",
+        "image": f"{prefix}_image_info"
+    }
+
+def tenant_key(workspace_id, username: str) -> str:
+    """chunk 的租户键：工作区与用户名合成一个 keyword，检索时一个 term 过滤代替两个"""
+    return f"{workspace_id}:{username}"
+
+class _SearchRequests:
+    _indices: Dict[str, str]
+
+    # chunk 索引是否为租户布局（按 workspace_id routing、带 tenant_key 字段），由 SmallRAGDB.init_indices 检测；
+    # 旧布局下检索不带 routing，并按 workspace_id / user_username 两个字段过滤
+    tenant_routing = False
+
+    def _routing(self, workspace_id) -> Optional[str]:
+        return str(workspace_id) if self.tenant_routing else None
+
+    # 检索结果投影：默认不取回向量与全文等大字段
+    # 各索引中体积大、检索结果通常用不到的字段；
+    # chunk 的 rerank_token_ids 只有送入 rerank 的候选才需要，由 rerank_token_ids() 按 id 单独取回
+    _HEAVY_FIELDS = {
+        "document": ["full_content"],
+        "chunk": ["embedding_vector", "rerank_token_ids"],
+        "qa": ["qa_vector", "qa_concat_vector"],
+        "image": ["embedding_vector"],
+    }
+
+    def _projection(
+            self,
+            kind: str,
+            include: List[str] = (),
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> Dict:
+        """
+        生成合并进检索请求体的投影参数
+        include: 需要取回的大字段（默认被排除），如 ["embedding_vector"]
+        source_includes: 只取回这些 _source 字段（优先于默认排除规则）
+        stored_fields: 额外取回的 store=true 字段
+        """
+        params: Dict[str, Any] = {}
+        if source_includes is not None:
+            params["_source"] = {"includes": list(source_includes)}
+        else:
+            excludes = [f for f in self._HEAVY_FIELDS[kind] if f not in include]
+            params["_source"] = {"excludes": excludes} if excludes else True
+        if stored_fields:
+            params["stored_fields"] = list(stored_fields)
+        return params
+
+    def _chunk_projection(self, include_vectors: bool, source_includes: Optional[List[str]],
+                          stored_fields: Optional[List[str]]) -> Dict:
+        return self._projection("chunk", ["embedding_vector"] if include_vectors else [],
+                                source_includes, stored_fields)
+
+    @staticmethod
+    def _hit_dicts(res: Dict, with_score: bool = False) -> List[Dict]:
+        """_source 与 stored_fields（单值展开）合并为一个 dict"""
+        results = []
+        for hit in res["hits"]["hits"]:
+            item = dict(hit.get("_source") or {})
+            for name, values in (hit.get("fields") or {}).items():
+                item[name] = values[0] if len(values) == 1 else values
+            if with_score:
+                item["_score"] = hit["_score"]
+            results.append(item)
+        return results
+
+    def _chunk_filters(self, workspace_id, username: str, doc_ids: Optional[List[str]] = None) -> List[Dict]:
+        if self.tenant_routing:
+            filters = [{"term": {"tenant_key": tenant_key(workspace_id, username)}}]
+        else:
+            filters = [
+                {"term": {"workspace_id": workspace_id}},
+                {"term": {"user_username": username}}
+            ]
+        if doc_ids is not None:
+            filters.append({"terms": {"doc_id": list(doc_ids)}})
+        return filters
+
+    def bm25_chunk_body(self, text_query: str, workspace_id, username: str, size: int,
+                        doc_ids: Optional[List[str]] = None) -> Dict:
+        """全文检索（BM25）请求体"""
+        return {
+            "size": size,
+            "query": {
+                "bool": {
+                    "must": [
+                        {"match": {"chunk_content": text_query}}
+                    ],
+                    "filter": self._chunk_filters(workspace_id, username, doc_ids)
+                }
+            }
+        }
+
+    def knn_chunk_body(self, vector_query: List[float], workspace_id, username: str, k: int,
+                       doc_ids: Optional[List[str]] = None) -> Dict:
+        """向量检索（KNN）请求体"""
+        return {
+            "size": k,
+            "knn": {
+                "field": "embedding_vector",
+                "query_vector": vector_query,
+                "k": k,
+                "num_candidates": max(10, k * 2),
+                "filter": self._chunk_filters(workspace_id, username, doc_ids)
+            }
         }
 
+    # 热点工作区向量缓存（vector_cache.WorkspaceVectorCache），由 runtime 注入；None 时 kNN 始终走 ES
+    vector_cache = None
+
+    def knn_leg(self, vector_query: List[float], workspace_id, username: str, k: int,
+                doc_ids: Optional[List[str]], projection: Dict) -> Tuple[Dict, Optional[List[Tuple[str, float]]]]:
+        """
+        向量检索这一路的请求体。工作区向量已缓存时在进程内算出 top-k，请求体退化为按 id 取回这些 chunk；
+        返回 (请求体, 缓存给出的 [(chunk_id, 得分)])，后者为 None 表示走 ES kNN
+        """
+        scored = None
+        if self.vector_cache is not None:
+            scored = self.vector_cache.search(str(workspace_id), vector_query, username, k, doc_ids)
+        if scored is None:
+            return {**self.knn_chunk_body(vector_query, workspace_id, username, k, doc_ids), **projection}, None
+        return {"size": len(scored), "query": {"ids": {"values": [cid for cid, _ in scored]}}, **projection}, scored
+
+    @staticmethod
+    def knn_leg_hits(hits: List[Dict], scored: Optional[List[Tuple[str, float]]]) -> List[Dict]:
+        """按缓存给出的顺序与得分重排 ids 查询的结果；走 ES kNN 时原样返回"""
+        if scored is None:
+            return hits
+        by_id = {h["chunk_id"]: h for h in hits}
+        return [{**by_id[cid], "_score": score} for cid, score in scored if cid in by_id]
+
+    def token_ids_request(self, chunk_ids: List[str], workspace_id) -> Dict:
+        """按 id 取回 rerank_token_ids 的 mget 参数"""
+        return {"index": self._indices["chunk"], "ids": list(chunk_ids), "routing": self._routing(workspace_id),
+                "source_includes": ["rerank_token_ids"]}
+
+    @staticmethod
+    def _parse_token_ids(res: Dict) -> Dict[str, List[int]]:
+        return {doc["_id"]: doc["_source"]["rerank_token_ids"] for doc in res["docs"]
+                if doc.get("found") and doc["_source"].get("rerank_token_ids")}
+
+    def _msearch_lines(self, bodies: List[Dict], routing: Optional[str] = None) -> List[Dict]:
+        header = {"index": self._indices["chunk"]}
+        if routing is not None:
+            header["routing"] = routing
+        searches = []
+        for body in bodies:
+            searches.extend((header, body))
+        return searches
+
+    def _parse_msearch(self, res: Dict) -> List[List[Dict]]:
+        """单个子查询失败时记录日志并按无结果处理"""
+        results = []
+        for sub in res["responses"]:
+            if "error" in sub:
+                logger.error(f"❌ 子查询失败: {sub['error']}")
+                results.append([])
+            else:
+                results.append(self._hit_dicts(sub, with_score=True))
+        return results
+
+# -------------------------
+# 存储后端接口：入库流水线与问答检索只依赖这些方法
+# -------------------------
+
+class RAGStore(ABC):
+    """
+    文档元数据与 chunk 的存储后端。
+    实现：SmallRAGDB（Elasticsearch）、local_store.LocalStore（嵌入式，SQLite + 内存映射向量文件）。
+    检索命中为 chunk 字段的 dict，带 "_score"；默认不含 embedding_vector（include_vectors=True 时返回）
+    与 rerank_token_ids（rerank_token_ids() 按需取回）。
+    QA 历史与图片只有 ES 后端支持。
+    """
+
+    def __init__(self):
+        self._chunk_listeners: List[Callable[[ChunkChange], None]] = []
+
+    # -------------------------
+    # chunk 变更通知
+    # -------------------------
+
+    def add_chunk_listener(self, listener: Callable[[ChunkChange], None]):
+        """注册 chunk 变更回调，在写入/删除成功后同步调用"""
+        self._chunk_listeners.append(listener)
+
+    def _notify_chunks(self, change: ChunkChange):
+        for listener in self._chunk_listeners:
+            try:
+                listener(change)
+            except Exception as e:  # 回调失败不影响写入本身
+                logger.error(f"❌ chunk 变更回调失败: {e}")
+
+    def _validate_and_serialize(self, model_cls: type[BaseModel], data: Union[BaseModel, Dict]) -> Dict:
+        if isinstance(data, dict):
+            instance = model_cls(**data)
+        elif isinstance(data, model_cls):
+            instance = data
+        else:
+            raise TypeError(f"Expected dict or {model_cls.__name__}, got {type(data)}")
+        return instance.model_dump()
+
+    # -------------------------
+    # 生命周期
+    # -------------------------
+
+    @abstractmethod
+    def init_indices(self, overwrite: bool = False) -> bool: ...
+
+    @abstractmethod
+    def ping(self) -> bool: ...
+
+    @abstractmethod
+    def refresh_all(self):
+        """使此前的写入对检索可见"""
+
+    # -------------------------
+    # 文档与 chunk 读写
+    # -------------------------
+
+    @abstractmethod
+    def create_document(self, doc_id: str, data: Union[DocumentMeta, Dict[str, Any]]) -> Any: ...
+
+    @abstractmethod
+    def get_document(self, doc_id: str) -> Optional[Dict]: ...
+
+    @abstractmethod
+    def update_document(self, doc_id: str, update_data: Union[DocumentMeta, Dict[str, Any]]) -> Any: ...
+
+    @abstractmethod
+    def delete_document(self, doc_id: str) -> Any: ...
+
+    @abstractmethod
+    def create_chunk(self, chunk_id: str, data: Union[ChunkInfo, Dict[str, Any]]) -> Any: ...
+
+    @abstractmethod
+    def get_chunk(self, chunk_id: str) -> Optional[Dict]: ...
+
+    @abstractmethod
+    def update_chunk(self, chunk_id: str, update_data: Union[ChunkInfo, Dict[str, Any]]) -> Any: ...
+
+    @abstractmethod
+    def delete_chunk(self, chunk_id: str) -> Any: ...
+
+    @abstractmethod
+    def bulk_create_chunks(self, chunks: List[Union[ChunkInfo, Dict]]) -> Any: ...
+
+    @abstractmethod
+    def bulk_update_chunks(self, updates: List[Dict[str, Any]]) -> Any:
+        """局部更新：每项需包含 chunk_id，其余字段覆盖原值"""
+
+    @abstractmethod
+    def bulk_delete_chunks(self, chunk_ids: List[str]) -> Any: ...
+
+    @abstractmethod
+    def delete_chunks_by_doc(self, doc_id: str) -> Any: ...
+
+    @abstractmethod
+    def iter_chunk_positions(self, doc_id: str) -> Iterator[Tuple[str, Optional[int], Optional[int]]]:
+        """遍历某文档现有 chunk 的 (chunk_id, chunk_order, page_number)"""
+
+    @abstractmethod
+    def clone_document_chunks(self, src_doc_id: str, dst_doc_id: str, workspace_id: str,
+                              user_username: str, bulk_size: int = 500,
+                              should_stop: Optional[Callable[[], bool]] = None) -> int:
+        """should_stop() 在每批写入前检查，返回 True 时停止复制并返回已复制的条数"""
+
+    # -------------------------
+    # 检索（按工作区 + 用户过滤，可再限定文档）
+    # -------------------------
+
+    @abstractmethod
+    def bm25_search_chunks(self, text_query: str, workspace_id, username: str, size: int = 5,
+                           doc_ids: Optional[List[str]] = None, include_vectors: bool = False) -> List[Dict]: ...
+
+    @abstractmethod
+    def knn_search_chunks(self, vector_query: List[float], workspace_id, username: str, k: int = 5,
+                          doc_ids: Optional[List[str]] = None, include_vectors: bool = False) -> List[Dict]:
+        """得分口径与 ES cosine 一致：(1 + cos) / 2"""
+
+    def hybrid_search_chunks(
+            self,
+            text_query: str,
+            vector_query: List[float],
+            workspace_id,
+            username: str,
+            top_k_text: int = 5,
+            top_k_vector: int = 5,
+            rrf_k: int = 60,
+            include_vectors: bool = False,
+            doc_ids: Optional[List[str]] = None
+    ) -> List[Candidate]:
+        """两路检索后按 RRF 融合；ES 后端改写为一次 _msearch"""
+        return rrf_fuse(
+            self.bm25_search_chunks(text_query, workspace_id, username, top_k_text, doc_ids, include_vectors),
+            self.knn_search_chunks(vector_query, workspace_id, username, top_k_vector, doc_ids, include_vectors),
+            k=rrf_k,
+        )
+
+    @abstractmethod
+    def rerank_token_ids(self, chunk_ids: List[str], workspace_id) -> Dict[str, List[int]]:
+        """按 id 取回 chunk 的 rerank_token_ids（检索结果默认不含），没有该字段的 chunk 不出现在结果中"""
+
+# -------------------------
+# Elasticsearch 数据库管理类（增强版）
+# -------------------------
+
+class SmallRAGDB(RAGStore, _SearchRequests):
+    def __init__(self, es_url: str = "http://localhost:9200", index_prefix: str = "smallrag",
+                 chunk_shards: int = config.ES_CHUNK_SHARDS):
+        super().__init__()
+        self.es = Elasticsearch(es_url, **_client_options())
+        self._indices = _index_names(index_prefix)
+        self.chunk_shards = chunk_shards
+        self.tenant_routing = False
+        self._layout_indices: List[str] = []  # 上次检测布局时 chunk 别名指向的实体索引
+        self._layout_checked_at = 0.0
+
+    def ping(self) -> bool:
+        try:
+            return bool(self.es.options(request_timeout=2).ping())
+        except Exception:
+            return False
+
     # -------------------------
     # 索引管理
     # -------------------------
@@ -123,15 +497,22 @@ class SmallRAGDB:
                 exists = self.es.indices.exists(index=index_name)
                 if exists:
                     if overwrite:
-                        self.es.indices.delete(index=index_name)
-                        self.es.indices.create(index=index_name, body=mappings[name])
+                        self.es.indices.delete(index=",".join(self.concrete_indices(index_name)))
+                        self._create_index(name, mappings[name])
                         logger.info(f"🔄 已覆盖重建索引: {index_name}")
                     else:
+                        # 已有索引补充新增字段（只能新增，不能修改已有字段类型；_routing 等元字段不能事后修改）
+                        self.es.indices.put_mapping(index=index_name,
+                                                    properties=mappings[name]["mappings"]["properties"])
                         logger.info(f"ℹ️ 索引已存在: {index_name}")
                 else:
-                    self.es.indices.create(index=index_name, body=mappings[name])
+                    self._create_index(name, mappings[name])
                     logger.info(f"✅ 已创建索引: {index_name}")
 
+            self.refresh_tenant_routing(force=True)
+            if not self.tenant_routing:
+                logger.warning(f"⚠️ {self._indices['chunk']} 仍为旧布局（未按工作区 routing），"
+                               f"检索会扫描全部分片；可运行 python migrate_chunks.py 迁移")
             logger.info("🎉 所有索引初始化完成！")
             return True
 
@@ -140,6 +521,58 @@ class SmallRAGDB:
             traceback.print_exc()
             return False
 
+    def _create_index(self, name: str, body: Dict):
+        """chunk 索引建为 {别名}_v1 并挂上别名，以后重新分片/迁移只需新建索引后切换别名"""
+        index_name = self._indices[name]
+        if name != "chunk":
+            self.es.indices.create(index=index_name, body=body)
+            return
+        self.es.indices.create(index=f"{index_name}_v1", body={
+            **body,
+            "settings": {"number_of_shards": self.chunk_shards},
+            "aliases": {index_name: {}},
+        })
+
+    def concrete_indices(self, name: str) -> List[str]:
+        """别名或索引名对应的实体索引"""
+        return list(self.es.indices.get(index=name).keys())
+
+    def detect_tenant_routing(self) -> bool:
+        """chunk 索引（别名指向的全部实体索引）是否要求 routing，即是否为租户布局"""
+        mapping = self.es.indices.get_mapping(index=self._indices["chunk"])
+        return bool(mapping) and all(
+            m["mappings"].get("_routing", {}).get("required", False) for m in mapping.values())
+
+    def layout_check_due(self) -> bool:
+        return time.monotonic() - self._layout_checked_at >= config.ES_LAYOUT_CHECK_SECONDS
+
+    def refresh_tenant_routing(self, force: bool = False) -> bool:
+        """
+        chunk 别名指向的实体索引变化（migrate_chunks.py 切换别名）后重新检测布局，运行中的服务无需重启。
+        非 force 时最多每 ES_LAYOUT_CHECK_SECONDS 秒检查一次，且实体索引未变时不重新读取 mapping。
+        返回布局是否变化
+        """
+        if not force and not self.layout_check_due():
+            return False
+        self._layout_checked_at = time.monotonic()
+        indices = sorted(self.concrete_indices(self._indices["chunk"]))
+        if not force and indices == self._layout_indices:
+            return False
+        self._layout_indices = indices
+        routing = self.detect_tenant_routing()
+        if routing == self.tenant_routing:
+            return False
+        logger.info(f"🔀 {self._indices['chunk']} -> {', '.join(indices)}，"
+                    f"{'租户布局（按工作区 routing）' if routing else '旧布局'}")
+        self.tenant_routing = routing
+        return True
+
+    def delete_indices(self):
+        """删除本实例的全部索引（含别名指向的实体索引），供测试与基准清理"""
+        for index_name in self._indices.values():
+            if self.es.indices.exists(index=index_name):
+                self.es.indices.delete(index=",".join(self.concrete_indices(index_name)))
+
     def _get_mappings(self) -> Dict[str, Dict]:
         return {
             "document": {
@@ -162,15 +595,21 @@ class SmallRAGDB:
             },
             "chunk": {
                 "mappings": {
+                    # 同一工作区的 chunk 落在同一分片，检索只访问该分片；按 id 读写时需先查出 routing
+                    "_routing": {"required": True},
                     "properties": {
                         "chunk_id": {"type": "keyword"},
                         "doc_id": {"type": "keyword"},
                         "workspace_id": {"type": "keyword"},
                         "user_username": {"type": "keyword"},
+                        "tenant_key": {"type": "keyword"},  # workspace_id:user_username，见 tenant_key()
                         "chunk_content": {"type": "text", "analyzer": "ik_max_word", "search_analyzer": "ik_max_word"},
                         "embedding_vector": {"type": "dense_vector", "dims": 768, "index": True, "similarity": "cosine"},
                         "chunk_order": {"type": "integer"},
                         "page_number": {"type": "integer"},
+                        "content_hash": {"type": "keyword"},
+                        "rerank_token_ids": {"type": "integer", "index": False, "doc_values": False},
+                        "rerank_tokenizer": {"type": "keyword"},
                         "metadata": {"type": "object"},
                         "created_at": {"type": "date"}
                     }
@@ -220,15 +659,6 @@ class SmallRAGDB:
     # 通用 CRUD 方法（带模型验证）
     # -------------------------
 
-    def _validate_and_serialize(self, model_cls: type[BaseModel], data: Union[BaseModel, Dict]) -> Dict:
-        if isinstance(data, dict):
-            instance = model_cls(**data)
-        elif isinstance(data, model_cls):
-            instance = data
-        else:
-            raise TypeError(f"Expected dict or {model_cls.__name__}, got {type(data)}")
-        return instance.model_dump()
-
     @safe_es_call
     def create_document(self, doc_id: str, data: Union[DocumentMeta, Dict[str, Any]]) -> Dict:
         body = self._validate_and_serialize(DocumentMeta, data)
@@ -250,27 +680,86 @@ class SmallRAGDB:
     # -------------------------
     # 批量操作（示例：chunks）
     # -------------------------
+    @staticmethod
+    def _with_tenant_key(body: Dict) -> Dict:
+        body["tenant_key"] = tenant_key(body["workspace_id"], body["user_username"])
+        return body
+
+    def _chunk_routes(self, chunk_ids: List[str], batch_size: int = 1000) -> Dict[str, Optional[str]]:
+        """
+        按 id 读写 chunk 前查出各自的 routing（租户布局下 get/update/delete 必须带 routing）；
+        旧布局下无需 routing，全部返回 None。租户布局下不存在的 chunk 不在结果中。
+        """
+        if not self.tenant_routing:
+            return {cid: None for cid in chunk_ids}
+        routes = {}
+        for start in range(0, len(chunk_ids), batch_size):
+            batch = list(chunk_ids[start:start + batch_size])
+            res = self.es.search(index=self._indices["chunk"],
+                                 body={"query": {"ids": {"values": batch}}, "size": len(batch), "_source": False})
+            routes.update((hit["_id"], hit.get("_routing")) for hit in res["hits"]["hits"])
+        return routes
+
+    def _route_workspaces(self, routes: Dict[str, Optional[str]]) -> Set[str]:
+        """租户布局下 routing 即 workspace_id，可直接告知缓存受影响的工作区；旧布局下未知（空集合）"""
+        return {r for r in routes.values() if r is not None} if self.tenant_routing else set()
+
+    @staticmethod
+    def _routed(action: Dict, routing: Optional[str]) -> Dict:
+        if routing is not None:
+            action["_routing"] = routing
+        return action
+
+    @retry_on_layout_change
     @safe_es_call
     def create_chunk(self, chunk_id: str, data: Union[ChunkInfo, Dict[str, Any]]) -> Dict:
-        body = self._validate_and_serialize(ChunkInfo, data)
-        return self.es.index(index=self._indices["chunk"], id=chunk_id, body=body)
+        body = self._with_tenant_key(self._validate_and_serialize(ChunkInfo, data))
+        res = self.es.index(index=self._indices["chunk"], id=chunk_id, body=body,
+                            routing=self._routing(body["workspace_id"]))
+        self._notify_chunks(ChunkChange("upsert", [chunk_id], body["doc_id"], {body["workspace_id"]}))
+        return res
 
     # -------------------------
     # 3. 分块（Chunk）操作 —— 补全
     # -------------------------
 
+    @retry_on_layout_change
     @safe_es_call
     def get_chunk(self, chunk_id: str) -> Optional[Dict]:
-        return self.es.get(index=self._indices["chunk"], id=chunk_id)["_source"]
+        routes = self._chunk_routes([chunk_id])
+        if chunk_id not in routes:
+            return None
+        return self.es.get(index=self._indices["chunk"], id=chunk_id, routing=routes[chunk_id])["_source"]
 
+    @retry_on_layout_change
     @safe_es_call
     def update_chunk(self, chunk_id: str, update_data: Union[ChunkInfo, Dict[str, Any]]) -> Dict:
-        body = self._validate_and_serialize(ChunkInfo, update_data)
-        return self.es.update(index=self._indices["chunk"], id=chunk_id, body={"doc": body})
+        body = self._with_tenant_key(self._validate_and_serialize(ChunkInfo, update_data))
+        index = self._indices["chunk"]
+        routing = self._routing(body["workspace_id"])
+        old_routing = self._chunk_routes([chunk_id]).get(chunk_id, routing)
+        if old_routing != routing:
+            # 换了工作区：文档要换分片，只能删掉旧文档后按新 routing 重写
+            self.es.delete(index=index, id=chunk_id, routing=old_routing)
+            res = self.es.index(index=index, id=chunk_id, body=body, routing=routing)
+        else:
+            res = self.es.update(index=index, id=chunk_id, body={"doc": body}, routing=routing)
+        # 旧布局下不知道 chunk 原来所在的工作区
+        workspaces = {body["workspace_id"], old_routing} if self.tenant_routing else set()
+        self._notify_chunks(ChunkChange("upsert", [chunk_id], body.get("doc_id"), workspaces))
+        return res
 
+    @retry_on_layout_change
     @safe_es_call
     def delete_chunk(self, chunk_id: str) -> Dict:
-        return self.es.delete(index=self._indices["chunk"], id=chunk_id)
+        routes = {}
+        try:
+            routes = self._chunk_routes([chunk_id])
+            if chunk_id not in routes:
+                return None
+            return self.es.delete(index=self._indices["chunk"], id=chunk_id, routing=routes[chunk_id])
+        finally:
+            self._notify_chunks(ChunkChange("delete", [chunk_id], workspace_ids=self._route_workspaces(routes)))
 
     # -------------------------
     # 4. 问答（QA）操作 —— 补全
@@ -320,11 +809,28 @@ class SmallRAGDB:
     # 6. 搜索接口 —— 补全缺失方法
     # -------------------------
 
-    def search_documents(self, query: Dict, size: int = 10) -> List[Dict]:
-        res = self.es.search(index=self._indices["document"], body=query, size=size)
-        return [hit["_source"] for hit in res["hits"]["hits"]]
+    def search_documents(
+            self,
+            query: Dict,
+            size: int = 10,
+            include_full_content: bool = False,
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> List[Dict]:
+        """query 中已指定 _source 时以调用方为准"""
+        projection = self._projection("document", ["full_content"] if include_full_content else [],
+                                      source_includes, stored_fields)
+        res = self.es.search(index=self._indices["document"], body={**projection, **query}, size=size)
+        return self._hit_dicts(res)
 
-    def search_chunks_by_vector(self, vector: List[float], k: int = 5) -> List[Dict]:
+    def search_chunks_by_vector(
+            self,
+            vector: List[float],
+            k: int = 5,
+            include_vectors: bool = False,
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> List[Dict]:
         res = self.es.search(
             index=self._indices["chunk"],
             body={
@@ -333,10 +839,48 @@ class SmallRAGDB:
                     "query_vector": vector,
                     "k": k,
                     "num_candidates": max(10, k * 2)
-                }
+                },
+                **self._chunk_projection(include_vectors, source_includes, stored_fields)
             }
         )
-        return [hit["_source"] for hit in res["hits"]["hits"]]
+        return self._hit_dicts(res)
+
+    def _msearch_hits(self, bodies: List[Dict], routing: Optional[str] = None) -> List[List[Dict]]:
+        """一次 _msearch 执行多个检索；单个子查询失败时记录日志并按无结果处理"""
+        res = self.es.msearch(searches=self._msearch_lines(bodies, routing))
+        return self._parse_msearch(res)
+
+    def bm25_search_chunks(
+            self,
+            text_query: str,
+            workspace_id,
+            username: str,
+            size: int = 5,
+            doc_ids: Optional[List[str]] = None,
+            include_vectors: bool = False,
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> List[Dict]:
+        body = {**self.bm25_chunk_body(text_query, workspace_id, username, size, doc_ids),
+                **self._chunk_projection(include_vectors, source_includes, stored_fields)}
+        res = self.es.search(index=self._indices["chunk"], body=body, routing=self._routing(workspace_id))
+        return self._hit_dicts(res, with_score=True)
+
+    def knn_search_chunks(
+            self,
+            vector_query: List[float],
+            workspace_id,
+            username: str,
+            k: int = 5,
+            doc_ids: Optional[List[str]] = None,
+            include_vectors: bool = False,
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> List[Dict]:
+        body, scored = self.knn_leg(vector_query, workspace_id, username, k, doc_ids,
+                                    self._chunk_projection(include_vectors, source_includes, stored_fields))
+        res = self.es.search(index=self._indices["chunk"], body=body, routing=self._routing(workspace_id))
+        return self.knn_leg_hits(self._hit_dicts(res, with_score=True), scored)
 
     def hybrid_search_chunks(
             self,
@@ -345,69 +889,52 @@ class SmallRAGDB:
             workspace_id:int,
             username:str,
             top_k_text: int = 5,
-            top_k_vector: int = 5
-    ) -> Dict[str, List[Dict]]:
+            top_k_vector: int = 5,
+            rrf_k: int = 60,
+            include_vectors: bool = False,
+            doc_ids: Optional[List[str]] = None,
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> List[Candidate]:
         """
-        混合检索：同时执行全文检索和向量检索，返回两类结果。
+        混合检索：全文检索与向量检索合并为一次 _msearch 请求（一次网络往返），结果按 RRF 融合。
+        工作区向量已缓存时 kNN 在进程内完成，_msearch 中的第二个子查询只按 id 取回命中的 chunk。
 
         Args:
             text_query: 用于全文检索的关键词或句子
             vector_query: 768维的查询向量
             top_k_text: 全文检索返回数量
             top_k_vector: 向量检索返回数量
+            rrf_k: RRF 平滑常数
+            include_vectors: 是否取回 embedding_vector（默认不取，避免每条命中回传 768 个浮点数）
+            doc_ids: 只在这些文档中检索，None 表示不限
+            source_includes / stored_fields: 见 _projection
 
         Returns:
-            {
-                "text_hits": [...],
-                "vector_hits": [...]
-            }
+            按 RRF 分数降序的候选列表，每项带有 chunk 字段（hit）、rrf_score，
+            以及在两路检索中各自的名次与原始得分（未命中为 None）
         """
-        # 临时加一行调试
-        print("Total chunks in index:", self.es.count(index=self._indices["chunk"])["count"])
-        # 1. 全文检索（BM25）
-        text_res = self.es.search(
-            index=self._indices["chunk"],
-            body={
-                "size": top_k_text,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"match": {"chunk_content": text_query}}
-                        ],
-                        "filter": [
-                            {"term": {"workspace_id": workspace_id}},
-                            {"term": {"user_username": username}}
-                        ]
-                    }
-                }
-            }
-        )
-        text_hits = [hit["_source"] for hit in text_res["hits"]["hits"]]
+        projection = self._chunk_projection(include_vectors, source_includes, stored_fields)
+        knn_body, scored = self.knn_leg(vector_query, workspace_id, username, top_k_vector, doc_ids, projection)
+        text_hits, vector_hits = self._msearch_hits([
+            {**self.bm25_chunk_body(text_query, workspace_id, username, top_k_text, doc_ids), **projection},
+            knn_body,
+        ], routing=self._routing(workspace_id))
+        return rrf_fuse(text_hits, self.knn_leg_hits(vector_hits, scored), k=rrf_k)
 
-        # 2. 向量检索（KNN）
-        vector_res = self.es.search(
-            index=self._indices["chunk"],
-            body={
-                "knn": {
-                    "field": "embedding_vector",
-                    "query_vector": vector_query,
-                    "k": top_k_vector,
-                    "num_candidates": max(10, top_k_vector * 2),
-                    "filter": [  # ✅ 新增过滤条件
-                        {"term": {"workspace_id": workspace_id}},
-                        {"term": {"user_username": username}}
-                    ]
-                }
-            }
-        )
-        vector_hits = [hit["_source"] for hit in vector_res["hits"]["hits"]]
-
-        return {
-            "text_hits": text_hits,
-            "vector_hits": vector_hits
-        }
+    def rerank_token_ids(self, chunk_ids: List[str], workspace_id) -> Dict[str, List[int]]:
+        if not chunk_ids:
+            return {}
+        return self._parse_token_ids(self.es.mget(**self.token_ids_request(chunk_ids, workspace_id)))
 
-    def search_images_by_vector(self, vector: List[float], k: int = 5) -> List[Dict]:
+    def search_images_by_vector(
+            self,
+            vector: List[float],
+            k: int = 5,
+            include_vectors: bool = False,
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> List[Dict]:
         res = self.es.search(
             index=self._indices["image"],
             body={
@@ -416,23 +943,168 @@ class SmallRAGDB:
                     "query_vector": vector,
                     "k": k,
                     "num_candidates": max(10, k * 2)
-                }
+                },
+                **self._projection("image", ["embedding_vector"] if include_vectors else [],
+                                   source_includes, stored_fields)
             }
         )
-        return [hit["_source"] for hit in res["hits"]["hits"]]
+        return self._hit_dicts(res)
 
+    @retry_on_layout_change
     @safe_es_call
     def bulk_create_chunks(self, chunks: List[Union[ChunkInfo, Dict]]) -> Dict:
         actions = []
         for chunk in chunks:
-            body = self._validate_and_serialize(ChunkInfo, chunk)
-            actions.append({
+            body = self._with_tenant_key(self._validate_and_serialize(ChunkInfo, chunk))
+            actions.append(self._routed({
                 "_op_type": "index",
                 "_index": self._indices["chunk"],
                 "_id": body["chunk_id"],
                 "_source": body
-            })
-        return bulk(self.es, actions)
+            }, self._routing(body["workspace_id"])))
+        res = bulk(self.es, actions)
+        doc_ids = {a["_source"]["doc_id"] for a in actions}
+        self._notify_chunks(ChunkChange(
+            "upsert",
+            [a["_id"] for a in actions],
+            doc_ids.pop() if len(doc_ids) == 1 else None,
+            {a["_source"]["workspace_id"] for a in actions},
+        ))
+        return res
+
+    @safe_es_call
+    def delete_chunks_by_doc(self, doc_id: str) -> Dict:
+        """删除某文档的全部 chunk（重新入库前清理残留）"""
+        res = self.es.delete_by_query(
+            index=self._indices["chunk"],
+            body={"query": {"term": {"doc_id": doc_id}}},
+            refresh=True,
+            conflicts="proceed",
+        )
+        self._notify_chunks(ChunkChange("delete", doc_id=doc_id))
+        return res
+
+    def iter_chunk_positions(self, doc_id: str):
+        """遍历某文档现有 chunk 的 (chunk_id, chunk_order, page_number)，不取正文和向量"""
+        for hit in scan(
+            self.es,
+            index=self._indices["chunk"],
+            query={"query": {"term": {"doc_id": doc_id}}},
+            _source=["chunk_id", "chunk_order", "page_number"],
+            size=1000,
+        ):
+            src = hit["_source"]
+            yield src["chunk_id"], src.get("chunk_order"), src.get("page_number")
+
+    def workspace_signature(self, workspace_id: str) -> Tuple[int, Optional[float]]:
+        """
+        工作区内容签名 (chunk 数, 最新 created_at)，供 vector_cache 探测其他进程的写入：
+        新增 chunk 会推高最新 created_at，删除会改变 chunk 数
+        """
+        res = self.es.search(index=self._indices["chunk"], routing=self._routing(workspace_id), body={
+            "size": 0,
+            "track_total_hits": True,
+            "query": {"term": {"workspace_id": workspace_id}},
+            "aggs": {"latest": {"max": {"field": "created_at"}}},
+        })
+        return res["hits"]["total"]["value"], res["aggregations"]["latest"]["value"]
+
+    def load_workspace_vectors(self, workspace_id: str, max_chunks: int):
+        """
+        读出工作区全部 chunk 的 (chunk_ids, 用户名, doc_ids, 向量矩阵)，供 vector_cache 常驻内存；
+        chunk 数超过 max_chunks 时返回 None。只读取已 refresh 可见的数据，不强制 refresh 整个索引
+        （vector_cache 在写入停止超过 refresh_interval 后才会加载）。
+        """
+        index = self._indices["chunk"]
+        query = {"term": {"workspace_id": workspace_id}}
+        routing = self._routing(workspace_id)
+        if self.es.count(index=index, query=query, routing=routing)["count"] > max_chunks:
+            return None
+        chunk_ids, users, doc_ids, vectors = [], [], [], []
+        for hit in scan(self.es, index=index, query={"query": query}, routing=routing,
+                        _source=["chunk_id", "user_username", "doc_id", "embedding_vector"], size=1000):
+            src = hit["_source"]
+            if not src.get("embedding_vector"):
+                continue
+            chunk_ids.append(src["chunk_id"])
+            users.append(src["user_username"])
+            doc_ids.append(src["doc_id"])
+            vectors.append(src["embedding_vector"])
+            if len(chunk_ids) > max_chunks:  # count 之后又有写入
+                return None
+        return chunk_ids, users, doc_ids, np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+
+    @retry_on_layout_change
+    def clone_document_chunks(self, src_doc_id: str, dst_doc_id: str, workspace_id: str,
+                              user_username: str, bulk_size: int = 500,
+                              should_stop: Optional[Callable[[], bool]] = None) -> int:
+        """
+        把已入库文档的 chunk（含向量）复制到新的文档/工作区/用户名下，无需重新解析和向量化。
+        ES 不允许 _reindex 读写同一索引，这里用 scan + bulk 完成。
+        """
+        prefix = f"{src_doc_id}_"
+        now = datetime.utcnow()
+
+        def actions():
+            for i, hit in enumerate(scan(self.es, index=self._indices["chunk"],
+                                         query={"query": {"term": {"doc_id": src_doc_id}}}, size=bulk_size)):
+                # 每满一批（bulk 发送一次）检查一次是否取消
+                if i % bulk_size == 0 and should_stop is not None and should_stop():
+                    return
+                src = hit["_source"]
+                suffix = src["chunk_id"][len(prefix):] if src["chunk_id"].startswith(prefix) else src["chunk_id"]
+                src.update(
+                    chunk_id=f"{dst_doc_id}_{suffix}",
+                    doc_id=dst_doc_id,
+                    workspace_id=workspace_id,
+                    user_username=user_username,
+                    tenant_key=tenant_key(workspace_id, user_username),
+                    created_at=now,
+                )
+                yield self._routed({"_op_type": "index", "_index": self._indices["chunk"], "_id": src["chunk_id"],
+                                    "_source": src}, self._routing(workspace_id))
+
+        success, _ = bulk(self.es, actions(), chunk_size=bulk_size)
+        self._notify_chunks(ChunkChange("upsert", doc_id=dst_doc_id, workspace_ids={workspace_id}))
+        return success
+
+    @retry_on_layout_change
+    @safe_es_call
+    def bulk_update_chunks(self, updates: List[Dict[str, Any]]) -> Any:
+        """
+        局部更新：每项需包含 chunk_id，其余字段写入 doc。
+        不能修改 workspace_id / user_username（租户布局下涉及 routing 与 tenant_key），跨工作区移动请用 update_chunk。
+        """
+        for item in updates:
+            if "workspace_id" in item or "user_username" in item:
+                raise ValueError(f"bulk_update_chunks 不能修改 chunk 的工作区或用户: {item['chunk_id']}")
+        routes = self._chunk_routes([item["chunk_id"] for item in updates])
+        actions = [self._routed({
+            "_op_type": "update",
+            "_index": self._indices["chunk"],
+            "_id": item["chunk_id"],
+            "doc": {k: v for k, v in item.items() if k != "chunk_id"},
+        }, routes[item["chunk_id"]]) for item in updates if item["chunk_id"] in routes]
+        res = bulk(self.es, actions)
+        self._notify_chunks(ChunkChange("upsert", [a["_id"] for a in actions],
+                                        workspace_ids=self._route_workspaces(routes)))
+        return res
+
+    @retry_on_layout_change
+    @safe_es_call
+    def bulk_delete_chunks(self, chunk_ids: List[str]) -> Any:
+        routes = self._chunk_routes(list(chunk_ids))
+        actions = [self._routed({
+            "_op_type": "delete",
+            "_index": self._indices["chunk"],
+            "_id": chunk_id,
+        }, routes[chunk_id]) for chunk_id in chunk_ids if chunk_id in routes]
+        res = bulk(self.es, actions, raise_on_error=False)
+        if res[1] and _is_routing_missing(Exception(res[1])):
+            # 不存在的 chunk 按未找到处理，但 routing_missing 说明布局已变，交给 retry_on_layout_change
+            raise BulkIndexError(f"{len(res[1])} document(s) failed to delete.", res[1])
+        self._notify_chunks(ChunkChange("delete", list(chunk_ids), workspace_ids=self._route_workspaces(routes)))
+        return res
 
     # 其他 bulk 方法可类似实现（qa, image 等）
 
@@ -457,8 +1129,8 @@ class SmallRAGDB:
                     }
                 }
             }
-        res = self.es.search(index=self._indices["image"], body=query, size=size)
-        return [hit["_source"] for hit in res["hits"]["hits"]]
+        res = self.es.search(index=self._indices["image"], body={**self._projection("image"), **query}, size=size)
+        return self._hit_dicts(res)
 
     # -------------------------
     # 其他方法保持不变（略），但建议也加上 @safe_es_call
@@ -466,4 +1138,144 @@ class SmallRAGDB:
 
     def refresh_all(self):
         for index in self._indices.values():
-            self.es.indices.refresh(index=index)
\ No newline at end of file
+            self.es.indices.refresh(index=index)
+
+
+# -------------------------
+# 异步客户端：供 FastAPI 的 async 接口使用，检索期间不阻塞事件循环
+# -------------------------
+
+class AsyncSmallRAGDB(_SearchRequests):
+    """
+    基于 AsyncElasticsearch 的只读检索接口，请求体与 SmallRAGDB 完全一致。
+    写入、索引管理与 chunk 变更通知仍由同步的 SmallRAGDB 负责（入库在后台线程中运行）。
+    tenant_routing 跟随 layout_source（同步客户端）检测到的索引布局，检索时按 ES_LAYOUT_CHECK_SECONDS 间隔让其重新检查。
+    """
+
+    # 提供 tenant_routing 的同步客户端，由 runtime 注入；None 时按旧布局检索
+    layout_source = None
+
+    @property
+    def tenant_routing(self) -> bool:
+        return self.layout_source is not None and self.layout_source.tenant_routing
+
+    def __init__(self, es_url: str = "http://localhost:9200", index_prefix: str = "smallrag", executor=None):
+        """executor: 运行向量缓存打分等 CPU 计算的执行器（需提供 async run(fn, *args)），None 时用 asyncio.to_thread"""
+        # 连接在首次请求时于当前事件循环中建立
+        self.es = AsyncElasticsearch(es_url, **_client_options())
+        self._indices = _index_names(index_prefix)
+        self.executor = executor
+
+    async def _offload(self, fn, *args):
+        if self.executor is not None:
+            return await self.executor.run(fn, *args)
+        return await asyncio.to_thread(fn, *args)
+
+    async def _aknn_leg(self, *args) -> Tuple[Dict, Optional[List[Tuple[str, float]]]]:
+        """向量缓存命中时的 numpy 打分不在事件循环线程上执行"""
+        if self.vector_cache is None:
+            return self.knn_leg(*args)
+        return await self._offload(self.knn_leg, *args)
+
+    async def _check_layout(self):
+        """chunk 别名可能已被 migrate_chunks.py 切换；检查是阻塞的 ES 调用，交给执行器"""
+        if self.layout_source is not None and self.layout_source.layout_check_due():
+            try:
+                await self._offload(self.layout_source.refresh_tenant_routing)
+            except Exception as e:
+                logger.warning(f"⚠️ 检查 chunk 索引布局失败: {e}")
+
+    async def close(self):
+        await self.es.close()
+
+    async def ping(self) -> bool:
+        try:
+            return bool(await self.es.ping())
+        except Exception:
+            return False
+
+    async def get_document(self, doc_id: str) -> Optional[Dict]:
+        try:
+            res = await self.es.get(index=self._indices["document"], id=doc_id)
+        except NotFoundError:
+            return None
+        return res["_source"]
+
+    async def search_documents(
+            self,
+            query: Dict,
+            size: int = 10,
+            include_full_content: bool = False,
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> List[Dict]:
+        projection = self._projection("document", ["full_content"] if include_full_content else [],
+                                      source_includes, stored_fields)
+        res = await self.es.search(index=self._indices["document"], body={**projection, **query}, size=size)
+        return self._hit_dicts(res)
+
+    async def bm25_search_chunks(
+            self,
+            text_query: str,
+            workspace_id,
+            username: str,
+            size: int = 5,
+            doc_ids: Optional[List[str]] = None,
+            include_vectors: bool = False,
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> List[Dict]:
+        """单独的全文检索，可与查询向量化并发执行；命中带 "_score"，可直接交给 rrf_fuse"""
+        await self._check_layout()
+        body = {**self.bm25_chunk_body(text_query, workspace_id, username, size, doc_ids),
+                **self._chunk_projection(include_vectors, source_includes, stored_fields)}
+        res = await self.es.search(index=self._indices["chunk"], body=body, routing=self._routing(workspace_id))
+        return self._hit_dicts(res, with_score=True)
+
+    async def knn_search_chunks(
+            self,
+            vector_query: List[float],
+            workspace_id,
+            username: str,
+            k: int = 5,
+            doc_ids: Optional[List[str]] = None,
+            include_vectors: bool = False,
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> List[Dict]:
+        await self._check_layout()
+        body, scored = await self._aknn_leg(vector_query, workspace_id, username, k, doc_ids,
+                                            self._chunk_projection(include_vectors, source_includes, stored_fields))
+        res = await self.es.search(index=self._indices["chunk"], body=body, routing=self._routing(workspace_id))
+        return self.knn_leg_hits(self._hit_dicts(res, with_score=True), scored)
+
+    async def hybrid_search_chunks(
+            self,
+            text_query: str,
+            vector_query: List[float],
+            workspace_id,
+            username: str,
+            top_k_text: int = 5,
+            top_k_vector: int = 5,
+            rrf_k: int = 60,
+            include_vectors: bool = False,
+            doc_ids: Optional[List[str]] = None,
+            source_includes: Optional[List[str]] = None,
+            stored_fields: Optional[List[str]] = None
+    ) -> List[Candidate]:
+        """与 SmallRAGDB.hybrid_search_chunks 相同：一次 _msearch 后按 RRF 融合"""
+        await self._check_layout()
+        projection = self._chunk_projection(include_vectors, source_includes, stored_fields)
+        knn_body, scored = await self._aknn_leg(vector_query, workspace_id, username, top_k_vector, doc_ids,
+                                                projection)
+        res = await self.es.msearch(searches=self._msearch_lines([
+            {**self.bm25_chunk_body(text_query, workspace_id, username, top_k_text, doc_ids), **projection},
+            knn_body,
+        ], routing=self._routing(workspace_id)))
+        text_hits, vector_hits = self._parse_msearch(res)
+        return rrf_fuse(text_hits, self.knn_leg_hits(vector_hits, scored), k=rrf_k)
+
+    async def rerank_token_ids(self, chunk_ids: List[str], workspace_id) -> Dict[str, List[int]]:
+        if not chunk_ids:
+            return {}
+        return self._parse_token_ids(await self.es.mget(**self.token_ids_request(chunk_ids, workspace_id)))
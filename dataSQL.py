@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, String, DateTime, ForeignKey, Text,Integer,JSON
+from sqlalchemy import create_engine, Column, String, DateTime, ForeignKey, Text,Integer,JSON,Boolean,inspect,text
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
 from datetime import datetime
 from werkzeug.security import generate_password_hash,check_password_hash
@@ -15,11 +15,13 @@ import json
 - Workspace: 用户创建的工作区（对应 ./uploads/ 下的子文件夹）
 - Document: 上传到 Workspace 中的具体文档
 - Conversation: 用户创建的对话
+- IngestJob: 文档入库任务（持久化队列，重启后可恢复）
 
 关系：
 - User 1 → N Workspace
 - Workspace 1 → N Document
 - User 1 → N Conversation
+- Document 1 → N IngestJob
 """
 
 
@@ -97,18 +99,57 @@ class Document(Base):
     file_path = Column(String, nullable=False)      # 相对路径，如 "uploads/project_docs/report.pdf"
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    embedding_status = Column(String, default="pending")  # "pending", "completed", "failed"
+    embedding_status = Column(String, default="pending")  # "pending", "processing", "completed", "failed", "cancelled"
     file_size = Column(Integer, default=0)          # 文件大小（字节）
     file_hash = Column(String, index=True)  # SHA256 哈希值
+    embedding_model = Column(String, nullable=True)  # 生成向量所用的模型 id，跨工作区去重时需一致
+    chunking_config = Column(String, nullable=True)  # 切分配置摘要（utills.chunking_signature），跨工作区去重时需一致
+    slow_pages = Column(JSON, nullable=True)  # 提取超时的页面：[{"page": 12, "mode": "fallback", "seconds": 30.0}, ...]
 
     # 外键：属于哪个 Workspace
     workspace_id = Column(Integer, ForeignKey('workspaces.id', ondelete="CASCADE"), nullable=False)
     workspace = relationship("Workspace", back_populates="documents")
 
+    # 一对多：入库任务
+    jobs = relationship(
+        "IngestJob",
+        back_populates="document",
+        cascade="all, delete-orphan"
+    )
+
     def __repr__(self):
         return f"<Document(id={self.id}, title='{self.title}', workspace_id={self.workspace_id})>"
 
 
+class IngestJob(Base):
+    __tablename__ = 'ingest_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    status = Column(String, default="pending", index=True)  # "pending", "processing", "completed", "failed", "cancelled"
+    file_path = Column(String, nullable=False)      # 待解析文件的磁盘路径
+    user_username = Column(String, nullable=False)
+    pages_total = Column(Integer, default=0)        # 文档总页数（开始处理时统计）
+    pages_done = Column(Integer, default=0)         # 已解析页数
+    chunks_done = Column(Integer, default=0)        # 已写入 ES 的 chunk 数
+    cancel_requested = Column(Boolean, default=False)
+    attempts = Column(Integer, default=0)           # 执行次数（重启恢复后会累加）
+    owner = Column(String, nullable=True)           # 领取该任务的进程（主机名:pid:随机后缀）
+    heartbeat_at = Column(DateTime, nullable=True)  # 持有进程最近一次续约时间，超过租约时长视为进程已退出
+    stats = Column(JSON, nullable=True)             # 入库统计（规范化前后的字符/chunk 数等）
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    # 外键：属于哪个文档
+    document_id = Column(Integer, ForeignKey('documents.id', ondelete="CASCADE"), nullable=False)
+    document = relationship("Document", back_populates="jobs")
+
+    def __repr__(self):
+        return f"<IngestJob(id={self.id}, document_id={self.document_id}, status='{self.status}')>"
+
+
 class Conversation(Base):
     __tablename__ = 'conversations'
 
@@ -127,8 +168,23 @@ class Conversation(Base):
     def __repr__(self):
         return f"<Conversation(id='{self.id}', user='{self.user_username}')>"
 
+def _ensure_columns():
+    """create_all 不会给已有表加列：对旧库补齐模型中新增的可空列"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    col_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {col_type}'))
+
+
 # 创建所有表
 Base.metadata.create_all(engine)
+_ensure_columns()
 dataSession = sessionmaker(bind=engine)
 def get_db():
     db = dataSession()
@@ -1,6 +1,7 @@
 from pydantic import BaseModel, Field, validator, field_validator,Json
 import re
 from datetime import datetime
+from typing import Optional
 
 
 
@@ -35,6 +36,8 @@ class FileItem(BaseModel):
     name: str          # 文件名，如 "report.pdf"
     size: int          # 文件大小（字节）
     modified: datetime # 最后修改时间
+    embedding_status: Optional[str] = None  # 入库状态
+    slow_pages: Optional[list] = None       # 提取超时的页面，便于定位拖慢入库的文件
 
 class WorkspaceResponse(BaseModel):
     name: str
@@ -62,6 +65,21 @@ class chatResponse(BaseModel):
     conversation_name: str
     # conversation_id: str
 
+class IngestJobResponse(BaseModel):
+    job_id: int
+    document_id: int
+    status: str          # pending / processing / completed / failed / cancelled
+    pages_total: int
+    pages_done: int
+    chunks_done: int
+    attempts: int
+    error: Optional[str] = None
+    stats: Optional[dict] = None  # 规范化前后的字符/chunk 数、识别出的页眉页脚
+    created_at: datetime
+    updated_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
 class ConversationsResponse(BaseModel):
     title: str
     updated_at: datetime
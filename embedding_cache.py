@@ -0,0 +1,148 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import config
+
+"""
+按内容寻址的持久化向量缓存
+
+key = (模型 id, SHA-256(规范化后的 chunk 文本))，value 为 float16 向量。
+存储在本地 SQLite 文件中，按最近访问时间做 LRU 淘汰，总大小不超过 max_bytes。
+同一文档反复上传（即使略有修改）时，未变化的 chunk 直接命中缓存，无需再跑模型。
+"""
+
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """全角/半角统一 + 空白折叠，使排版上的细微差异不影响缓存命中"""
+    return _WS_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        model_id: str,
+        path: str = config.EMBED_CACHE_PATH,
+        max_bytes: int = config.EMBED_CACHE_MAX_MB * 2**20,
+    ):
+        self.model_id = model_id
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache ("
+            " model_id TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_access REAL NOT NULL,"
+            " PRIMARY KEY (model_id, text_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_access ON embedding_cache(last_access)")
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embedding_cache"
+        ).fetchone()[0]
+
+    # -------------------------
+    # 读写
+    # -------------------------
+
+    def get_many(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        """返回命中的 {text_hash: float32 向量}，并刷新命中项的访问时间"""
+        found: Dict[str, np.ndarray] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            for start in range(0, len(unique), 500):  # SQLite 单条语句的参数个数有上限
+                part = unique[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embedding_cache WHERE model_id = ? "
+                    f"AND text_hash IN ({','.join('?' * len(part))})",
+                    [self.model_id, *part],
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embedding_cache SET last_access = ? WHERE model_id = ? AND text_hash = ?",
+                    [(now, self.model_id, h) for h in found],
+                )
+            hit = sum(1 for h in hashes if h in found)
+            self.hits += hit
+            self.misses += len(hashes) - hit
+        return found
+
+    def put_many(self, hashes: List[str], vectors: np.ndarray):
+        now = time.time()
+        rows = [(self.model_id, h, v.astype(np.float16).tobytes(), now) for h, v in zip(hashes, vectors)]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for row in rows:
+                cur = self._conn.execute(
+                    "INSERT OR IGNORE INTO embedding_cache (model_id, text_hash, vector, last_access) "
+                    "VALUES (?, ?, ?, ?)", row)
+                if cur.rowcount == 1:
+                    self._total_bytes += len(row[2])
+            self._conn.execute("COMMIT")
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """按 LRU 淘汰到容量上限的 90%，留出余量避免每次写入都触发淘汰"""
+        target = int(self.max_bytes * 0.9)
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                "SELECT model_id, text_hash, LENGTH(vector) FROM embedding_cache "
+                "ORDER BY last_access LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                return
+            self._conn.execute("BEGIN")
+            for model_id, h, size in rows:
+                self._conn.execute(
+                    "DELETE FROM embedding_cache WHERE model_id = ? AND text_hash = ?", (model_id, h))
+                self._total_bytes -= size
+                if self._total_bytes <= target:
+                    break
+            self._conn.execute("COMMIT")
+
+    # -------------------------
+    # 统计
+    # -------------------------
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": entries,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,319 @@
+import os
+import json
+import queue
+import socket
+import struct
+import logging
+import threading
+import socketserver
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+import config
+from scheduler import INTERACTIVE, BULK
+
+"""
+进程外共享推理服务
+
+多个 uvicorn worker 各自加载 bge-base 与 bge-reranker 会让内存随 worker 数线性增长。
+本模块提供一个本机推理进程：独占 Embedding / RankModel，经 Unix socket 对外提供 embed / rerank，
+API worker 通过 InferenceClient 调用，整个节点只保留一份模型。
+
+- 服务端：每个连接一个线程，请求统一提交给 InferenceScheduler，不同连接、不同 worker 的请求跨进程合批
+- 客户端：接口与 InferenceScheduler 一致（embed / embed_batch / rank / aembed / arank / stats），带连接池
+- 协议：紧凑的二进制帧，向量与分数直接以 little-endian float32 缓冲区传输，不做 JSON 序列化
+
+请求帧：  <B op><B priority><I length> + payload
+响应帧：  <B status><I length> + payload（status 非 0 时 payload 为 utf-8 错误信息）
+字符串列表：<I n> + n 个 <I 字节长度> + 依次拼接的 utf-8 字节
+id 列表：  <I n> + n 个 <I 元素个数> + 依次拼接的 int32
+
+启动：
+    python inference_server.py --socket /tmp/smallrag-inference.sock
+API 侧设置 INFERENCE_MODE=remote 即改为连接该服务。
+"""
+
+logger = logging.getLogger(__name__)
+
+OP_EMBED = 1   # payload: 字符串列表；响应: <I rows><I dim> + float32[rows * dim]
+OP_RANK = 2    # payload: 字符串列表 [question, *answers]；响应: float32[len(answers)]
+OP_INFO = 3    # 响应: JSON {model_id, rank_model_id, dimension}
+OP_STATS = 4   # 响应: JSON {scheduler, embedding_cache}
+OP_RANK_IDS = 5  # payload: 字符串列表 [question] + id 列表（候选的 rerank token id）；响应同 OP_RANK
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+_REQ_HEADER = struct.Struct("<BBI")
+_RESP_HEADER = struct.Struct("<BI")
+_U32 = struct.Struct("<I")
+_MAX_FRAME = 256 * 2**20  # 防止异常数据导致一次性分配超大内存
+
+
+# -------------------------
+# 编解码
+# -------------------------
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    got = 0
+    while got < size:
+        n = sock.recv_into(view[got:], size - got)
+        if n == 0:
+            raise ConnectionError("连接已关闭")
+        got += n
+    return bytes(buf)
+
+
+def pack_strings(texts: List[str]) -> bytes:
+    encoded = [t.encode("utf-8") for t in texts]
+    lengths = np.fromiter((len(e) for e in encoded), dtype="<u4", count=len(encoded))
+    return _U32.pack(len(encoded)) + lengths.tobytes() + b"".join(encoded)
+
+
+def _unpack_strings_at(payload: bytes, offset: int) -> Tuple[List[str], int]:
+    (n,) = _U32.unpack_from(payload, offset)
+    lengths = np.frombuffer(payload, dtype="<u4", count=n, offset=offset + _U32.size)
+    offset += _U32.size + 4 * n
+    texts = []
+    for length in lengths.tolist():
+        texts.append(payload[offset:offset + length].decode("utf-8"))
+        offset += length
+    return texts, offset
+
+
+def unpack_strings(payload: bytes) -> List[str]:
+    return _unpack_strings_at(payload, 0)[0]
+
+
+def pack_id_lists(id_lists: List[List[int]]) -> bytes:
+    lengths = np.fromiter((len(ids) for ids in id_lists), dtype="<u4", count=len(id_lists))
+    flat = np.fromiter((i for ids in id_lists for i in ids), dtype="<i4", count=int(lengths.sum()))
+    return _U32.pack(len(id_lists)) + lengths.tobytes() + flat.tobytes()
+
+
+def unpack_id_lists(payload: bytes, offset: int = 0) -> List[List[int]]:
+    (n,) = _U32.unpack_from(payload, offset)
+    lengths = np.frombuffer(payload, dtype="<u4", count=n, offset=offset + _U32.size)
+    flat = np.frombuffer(payload, dtype="<i4", count=int(lengths.sum()), offset=offset + _U32.size + 4 * n)
+    bounds = [0, *np.cumsum(lengths, dtype=np.int64).tolist()]
+    return [flat[bounds[i]:bounds[i + 1]].tolist() for i in range(n)]
+
+
+# -------------------------
+# 服务端
+# -------------------------
+
+class _Handler(socketserver.BaseRequestHandler):
+    """一个连接上可连续发送多个请求，直到客户端关闭"""
+
+    def handle(self):
+        sock: socket.socket = self.request
+        while True:
+            try:
+                op, priority, length = _REQ_HEADER.unpack(_recv_exact(sock, _REQ_HEADER.size))
+                if length > _MAX_FRAME:
+                    raise ConnectionError(f"请求帧过大: {length}")
+                payload = _recv_exact(sock, length)
+            except ConnectionError:
+                return
+            try:
+                body = self.server.dispatch(op, priority, payload)
+                status = STATUS_OK
+            except Exception as e:
+                logger.error(f"❌ 推理请求处理失败: {e}")
+                body, status = str(e).encode("utf-8"), STATUS_ERROR
+            sock.sendall(_RESP_HEADER.pack(status, len(body)) + body)
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, scheduler):
+        """scheduler: InferenceScheduler，服务端批处理与优先级调度都由它完成"""
+        self.scheduler = scheduler
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # 上次异常退出残留的 socket 文件
+        super().__init__(socket_path, _Handler)
+        self.socket_path = socket_path
+
+    def dispatch(self, op: int, priority: int, payload: bytes) -> bytes:
+        priority = BULK if priority == BULK else INTERACTIVE
+        if op == OP_EMBED:
+            vectors = np.ascontiguousarray(self.scheduler.embed_batch(unpack_strings(payload), priority), dtype="<f4")
+            rows, dim = vectors.shape if vectors.size else (0, 0)
+            return struct.pack("<II", rows, dim) + vectors.tobytes()
+        if op == OP_RANK:
+            question, *answers = unpack_strings(payload)
+            scores = self.scheduler.rank(question, answers, priority) if answers else np.empty((0,))
+            return np.asarray(scores, dtype="<f4").tobytes()
+        if op == OP_RANK_IDS:
+            (question,), offset = _unpack_strings_at(payload, 0)
+            answers = unpack_id_lists(payload, offset)
+            scores = self.scheduler.rank(question, answers, priority) if answers else np.empty((0,))
+            return np.asarray(scores, dtype="<f4").tobytes()
+        if op == OP_INFO:
+            embedder = self.scheduler.embedder
+            return json.dumps({
+                "model_id": embedder.model_id,
+                "rank_model_id": self.scheduler.rank_model_id,
+                "dimension": int(embedder.dimension),
+            }).encode("utf-8")
+        if op == OP_STATS:
+            return json.dumps({
+                "scheduler": self.scheduler.stats(),
+                "embedding_cache": self.scheduler.embedding_cache_stats(),
+            }).encode("utf-8")
+        raise ValueError(f"未知的操作码: {op}")
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+# -------------------------
+# 客户端
+# -------------------------
+
+class InferenceClient:
+    """
+    推理服务的客户端，可直接替代 InferenceScheduler。
+    连接按需创建、用完归还，最多保留 pool_size 条；连接失效时丢弃并重连一次。
+    """
+
+    # 模型在服务端，本地没有 Embedding 实例与向量缓存（BulkEmbedder 据此读取 cache）
+    embedder = None
+
+    def __init__(self, socket_path: str = config.INFERENCE_SOCKET, pool_size: int = config.INFERENCE_POOL_SIZE,
+                 timeout: float = 60.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._pool: "queue.LifoQueue[socket.socket]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._info: Optional[dict] = None
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+    def _call(self, op: int, payload: bytes = b"", priority: int = INTERACTIVE) -> bytes:
+        frame = _REQ_HEADER.pack(op, priority, len(payload)) + payload
+        with self._slots:
+            for attempt in range(2):
+                try:
+                    sock = self._pool.get_nowait()
+                    reused = True
+                except queue.Empty:
+                    sock, reused = self._connect(), False
+                try:
+                    sock.sendall(frame)
+                    status, length = _RESP_HEADER.unpack(_recv_exact(sock, _RESP_HEADER.size))
+                    body = _recv_exact(sock, length)
+                except (ConnectionError, OSError):
+                    sock.close()
+                    if reused and attempt == 0:  # 池中的连接可能因服务端重启已失效
+                        continue
+                    raise
+                self._pool.put(sock)
+                if status != STATUS_OK:
+                    raise RuntimeError(f"推理服务错误: {body.decode('utf-8', 'replace')}")
+                return body
+        raise ConnectionError("推理服务不可用")
+
+    # -------------------------
+    # 与 InferenceScheduler 一致的接口
+    # -------------------------
+
+    @property
+    def model_id(self) -> str:
+        return self.info()["model_id"]
+
+    @property
+    def rank_model_id(self) -> str:
+        return self.info()["rank_model_id"]
+
+    def info(self) -> dict:
+        if self._info is None:
+            self._info = json.loads(self._call(OP_INFO))
+        return self._info
+
+    def ping(self) -> bool:
+        try:
+            self._info = json.loads(self._call(OP_INFO))
+            return True
+        except Exception:
+            return False
+
+    def embed(self, text: str, priority: int = INTERACTIVE) -> np.ndarray:
+        return self.embed_batch([text], priority)[0]
+
+    def embed_batch(self, texts: List[str], priority: int = INTERACTIVE) -> np.ndarray:
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        body = self._call(OP_EMBED, pack_strings(texts), priority)
+        rows, dim = struct.unpack_from("<II", body, 0)
+        return np.frombuffer(body, dtype="<f4", offset=8).reshape(rows, dim)
+
+    def rank(self, question: str, answers: List[Union[str, List[int]]], priority: int = INTERACTIVE) -> np.ndarray:
+        """answers 全为文本，或全为预先计算的 rerank token id"""
+        if not answers:
+            return np.empty((0,), dtype=np.float32)
+        if isinstance(answers[0], str):
+            body = self._call(OP_RANK, pack_strings([question, *answers]), priority)
+        else:
+            body = self._call(OP_RANK_IDS, pack_strings([question]) + pack_id_lists(answers), priority)
+        return np.frombuffer(body, dtype="<f4")
+
+    # 阻塞的 socket 调用交给 runtime 的有界执行器，与其他阻塞调用共用同一线程上限
+    # （runtime 创建本客户端，在方法内导入以避免循环导入）
+
+    async def aembed(self, text: str) -> np.ndarray:
+        from runtime import run_blocking
+        return await run_blocking(self.embed, text)
+
+    async def arank(self, question: str, answers: List[Union[str, List[int]]]) -> np.ndarray:
+        from runtime import run_blocking
+        return await run_blocking(self.rank, question, answers)
+
+    def _server_stats(self) -> dict:
+        return json.loads(self._call(OP_STATS))
+
+    def stats(self) -> dict:
+        return self._server_stats()["scheduler"]
+
+    def embedding_cache_stats(self) -> Optional[dict]:
+        return self._server_stats()["embedding_cache"]
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def serve(socket_path: str = config.INFERENCE_SOCKET):
+    from model import create_embedding, create_rank_model
+    from scheduler import InferenceScheduler
+
+    scheduler = InferenceScheduler(create_embedding(), create_rank_model())
+    server = InferenceServer(socket_path, scheduler)
+    logger.info(f"🚀 推理服务已启动: {socket_path}，模型 {scheduler.embedder.model_id}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="SmallRAG 共享推理服务")
+    parser.add_argument("--socket", default=config.INFERENCE_SOCKET)
+    serve(parser.parse_args().socket)
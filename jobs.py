@@ -0,0 +1,274 @@
+import os
+import socket
+import threading
+import time
+import uuid
+import logging
+import traceback
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import update, exists
+from sqlalchemy.orm import aliased
+
+import config
+from dataSQL import dataSession, Document, IngestJob
+from pipeline import IngestCancelled
+
+"""
+进程内的文档入库任务池
+
+- 任务持久化在 SQLite 的 ingest_jobs 表中，上传接口只负责写入一条 pending 任务后立即返回
+- 后台 N 个工作线程轮询领取 pending 任务，执行 process_fn
+- 状态流转：pending → processing → completed / failed / cancelled，并同步到 Document.embedding_status
+- 同一文档的任务串行执行：该文档已有 processing 任务（例如正在退出的旧版本任务）时，新任务等它结束后再领取
+- 进度（页数 / chunk 数）在执行过程中节流写回数据库，供接口轮询或推送
+- 领取任务时记录持有进程与心跳时间，持有进程定期续约；多个 worker 进程共享同一任务表时，
+  只有租约过期（持有进程已退出）的 processing 任务才会被重置为 pending 重新执行
+"""
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+
+class JobContext:
+    """传给 process_fn 的任务句柄：上报进度、检查取消"""
+
+    def __init__(self, job_id: int, document_id: int, flush_interval: float = 0.5):
+        self.job_id = job_id
+        self.document_id = document_id
+        self._flush_interval = flush_interval
+        self._last_flush = 0.0
+        self._last_cancel_check = 0.0
+        self._cancelled = False
+
+    def set_total_pages(self, pages_total: int):
+        with dataSession() as db:
+            db.execute(update(IngestJob).where(IngestJob.id == self.job_id).values(pages_total=pages_total))
+            db.commit()
+
+    def set_stats(self, stats: Dict):
+        with dataSession() as db:
+            db.execute(update(IngestJob).where(IngestJob.id == self.job_id).values(stats=stats))
+            db.commit()
+
+    def report(self, pages_done: int, chunks_done: int, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_flush < self._flush_interval:
+            return
+        self._last_flush = now
+        with dataSession() as db:
+            db.execute(update(IngestJob).where(IngestJob.id == self.job_id).values(
+                pages_done=pages_done, chunks_done=chunks_done, updated_at=datetime.utcnow()))
+            db.commit()
+
+    def cancelled(self) -> bool:
+        now = time.monotonic()
+        if self._cancelled or now - self._last_cancel_check < self._flush_interval:
+            return self._cancelled
+        self._last_cancel_check = now
+        with dataSession() as db:
+            job = db.get(IngestJob, self.job_id)
+            self._cancelled = bool(job is None or job.cancel_requested)
+        return self._cancelled
+
+    def superseded(self) -> bool:
+        """同一文档是否已有更新的任务（文档再次上传时旧任务会被取消）"""
+        with dataSession() as db:
+            return db.query(IngestJob.id).filter(
+                IngestJob.document_id == self.document_id,
+                IngestJob.id > self.job_id
+            ).first() is not None
+
+
+class IngestWorkerPool:
+    def __init__(
+        self,
+        process_fn: Callable[[IngestJob, JobContext], None],
+        num_workers: int = config.INGEST_WORKERS,
+        poll_interval: float = 1.0,
+        lease_seconds: float = config.INGEST_LEASE_SECONDS,
+    ):
+        """
+        process_fn(job, ctx): 执行单个任务；抛出 IngestCancelled 视为取消，其他异常视为失败
+        """
+        self.process_fn = process_fn
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Condition()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    # -------------------------
+    # 生命周期
+    # -------------------------
+
+    def start(self):
+        self._reclaim_expired()
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self._worker_loop, name=f"ingest-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._heartbeat_loop, name="ingest-heartbeat", daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _reclaim_expired(self) -> int:
+        """租约过期的 processing 任务（持有进程已退出）重置为 pending；已被要求取消的直接标记为取消"""
+        deadline = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        with dataSession() as db:
+            jobs = db.query(IngestJob).filter(
+                IngestJob.status == "processing",
+                (IngestJob.heartbeat_at == None) | (IngestJob.heartbeat_at < deadline)  # noqa: E711
+            ).all()
+            for job in jobs:
+                job.status = "cancelled" if job.cancel_requested else "pending"
+                job.owner = None
+                if job.status == "cancelled":
+                    job.finished_at = datetime.utcnow()
+                superseded = db.query(IngestJob.id).filter(
+                    IngestJob.document_id == job.document_id, IngestJob.id > job.id).first() is not None
+                if not superseded:
+                    job.document.embedding_status = job.status
+            db.commit()
+        if jobs:
+            logger.info(f"🔁 回收 {len(jobs)} 个租约过期的入库任务")
+        return len(jobs)
+
+    def _heartbeat_loop(self):
+        """为本进程持有的任务续约，并顺带回收其他进程遗留的过期任务"""
+        interval = max(self.lease_seconds / 3, 0.1)
+        while not self._stopping.wait(interval):
+            try:
+                with dataSession() as db:
+                    db.execute(update(IngestJob).where(
+                        IngestJob.owner == self.owner, IngestJob.status == "processing"
+                    ).values(heartbeat_at=datetime.utcnow()))
+                    db.commit()
+                self._reclaim_expired()
+            except Exception as e:
+                logger.error(f"❌ 入库任务续约失败: {e}")
+
+    # -------------------------
+    # 对外接口
+    # -------------------------
+
+    def enqueue(self, db, document: Document, file_path: str, user_username: str) -> IngestJob:
+        """在调用方的 session 中创建任务并唤醒工作线程；同一文档尚未结束的旧任务会被取消"""
+        for old in db.query(IngestJob).filter(
+            IngestJob.document_id == document.id,
+            IngestJob.status.in_(("pending", "processing"))
+        ).all():
+            old.cancel_requested = True
+            if old.status == "pending":
+                old.status = "cancelled"
+                old.finished_at = datetime.utcnow()
+        job = IngestJob(
+            document_id=document.id,
+            file_path=file_path,
+            user_username=user_username,
+            status="pending",
+        )
+        document.embedding_status = "pending"
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        with self._wakeup:
+            self._wakeup.notify()
+        return job
+
+    @staticmethod
+    def cancel(db, job: IngestJob) -> IngestJob:
+        """pending 任务直接取消；processing 任务打上标记，由执行线程在下一个检查点退出"""
+        if job.status in TERMINAL_STATUSES:
+            return job
+        job.cancel_requested = True
+        if job.status == "pending":
+            job.status = "cancelled"
+            job.finished_at = datetime.utcnow()
+            job.document.embedding_status = "cancelled"
+        db.commit()
+        db.refresh(job)
+        return job
+
+    # -------------------------
+    # 工作线程
+    # -------------------------
+
+    def _claim(self) -> Optional[int]:
+        """
+        领取最早的 pending 任务；用条件更新保证同一任务只会被一个线程/进程领取，
+        且同一文档已有 processing 任务时不领取（条件写在同一条 UPDATE 中，不存在检查与领取之间的竞争）
+        """
+        running = aliased(IngestJob)
+        idle = ~exists().where(running.document_id == IngestJob.document_id, running.status == "processing")
+        with dataSession() as db:
+            candidates = db.query(IngestJob.id).filter(
+                IngestJob.status == "pending", idle
+            ).order_by(IngestJob.id).limit(8).all()
+            for (job_id,) in candidates:
+                res = db.execute(update(IngestJob).where(
+                    IngestJob.id == job_id, IngestJob.status == "pending", idle
+                ).values(status="processing", started_at=datetime.utcnow(), owner=self.owner,
+                         heartbeat_at=datetime.utcnow(), attempts=IngestJob.attempts + 1, error=None))
+                if res.rowcount == 1:
+                    job = db.get(IngestJob, job_id)
+                    job.document.embedding_status = "processing"
+                    db.commit()
+                    return job_id
+            db.commit()
+        return None
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                job_id = self._claim()
+            except Exception as e:
+                logger.error(f"❌ 领取入库任务失败: {e}")
+                job_id = None
+            if job_id is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+            self._run(job_id)
+
+    def _run(self, job_id: int):
+        with dataSession() as db:
+            job = db.get(IngestJob, job_id)
+            _ = job.document  # 预先加载，session 关闭后 process_fn 仍可读取
+        ctx = JobContext(job_id, job.document_id)
+        try:
+            self.process_fn(job, ctx)
+            status, error = "completed", None
+        except IngestCancelled:
+            status, error = "cancelled", None
+        except Exception as e:
+            traceback.print_exc()
+            status, error = "failed", str(e)
+
+        with dataSession() as db:
+            job = db.get(IngestJob, job_id)
+            if job is None:  # 文档已被删除
+                return
+            if job.owner != self.owner:  # 租约过期后已被其他进程回收，结果以新的持有者为准
+                logger.warning(f"⚠️ 入库任务 {job_id} 已被 {job.owner} 接管，丢弃本次结果")
+                return
+            job.status = status
+            job.error = error
+            job.finished_at = datetime.utcnow()
+            # 已被同一文档的新任务取代时，文档状态由新任务维护
+            if not ctx.superseded():
+                job.document.embedding_status = status
+            db.commit()
+        logger.info(f"📌 入库任务 {job_id} 结束：{status}")
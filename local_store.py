@@ -0,0 +1,748 @@
+import json
+import math
+import os
+import re
+import heapq
+import shutil
+import sqlite3
+import threading
+import logging
+import unicodedata
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import quote
+
+import numpy as np
+
+import config
+from dataES import RAGStore, ChunkChange, ChunkInfo, DocumentMeta
+
+"""
+嵌入式存储后端：开发机、测试与小规模部署无需 Elasticsearch + IK 插件即可入库和问答
+
+- 文档元数据、chunk 正文与倒排索引存放在一个 SQLite 文件中（WAL 模式）
+- 向量按工作区存放为 float32 内存映射文件 vectors/<工作区>.<代数>.f32，每行一个 L2 归一化后的向量，
+  行号记录在 chunks.vec_slot；删除只释放行号，空洞超过一半时写出下一代文件并切换
+- 向量检索默认精确计算（对整个文件做一次矩阵-向量乘）；LOCAL_VECTOR_INDEX=hnsw 且工作区足够大时
+  改用 hnswlib 近似索引（可选依赖，未安装时退回精确计算）
+- 全文检索为 BM25（k1=1.2, b=0.75，与 ES 默认一致）；中文按字二元组切分，LOCAL_TOKENIZER=jieba 时用 jieba 搜索模式分词
+- 得分口径与 ES 对齐：向量得分为 (1 + cos) / 2；BM25 的 IDF 按工作区统计（ES 按分片统计，数值不完全相同）
+
+所有操作在一把进程内锁下串行执行，只适合单进程使用。
+"""
+
+logger = logging.getLogger(__name__)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, source TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_id TEXT PRIMARY KEY,
+    doc_id TEXT NOT NULL,
+    workspace_id TEXT NOT NULL,
+    user_username TEXT NOT NULL,
+    chunk_order INTEGER,
+    page_number INTEGER,
+    length INTEGER NOT NULL,
+    vec_slot INTEGER NOT NULL,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks(doc_id);
+CREATE INDEX IF NOT EXISTS idx_chunks_ws ON chunks(workspace_id, user_username);
+CREATE TABLE IF NOT EXISTS postings (
+    workspace_id TEXT NOT NULL,
+    term TEXT NOT NULL,
+    chunk_id TEXT NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (workspace_id, term, chunk_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings(chunk_id);
+CREATE TABLE IF NOT EXISTS vector_files (
+    workspace_id TEXT PRIMARY KEY,
+    dim INTEGER NOT NULL,
+    next_slot INTEGER NOT NULL,
+    generation INTEGER NOT NULL  -- 整理文件时递增，新旧文件并存直到元数据提交
+);
+"""
+
+
+# -------------------------
+# 分词
+# -------------------------
+
+_CJK = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_TOKEN_RE = re.compile(rf"[{_CJK}]+|[A-Za-z0-9_]+")
+
+
+def tokenize(text: str, mode: str = config.LOCAL_TOKENIZER) -> List[str]:
+    """
+    bigram：连续汉字切成重叠的字二元组（单字保留），英文/数字按词并转小写
+    jieba：jieba 搜索模式分词，只保留含汉字或字母数字的词
+    """
+    text = unicodedata.normalize("NFKC", text)
+    if mode == "jieba":
+        import jieba  # type: ignore
+        return [t.lower() for t in jieba.lcut_for_search(text) if _TOKEN_RE.search(t)]
+    tokens = []
+    for run in _TOKEN_RE.findall(text):
+        if run.isascii():
+            tokens.append(run.lower())
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+# -------------------------
+# 向量文件
+# -------------------------
+
+class _VectorFile:
+    """单个工作区的向量文件：float32 [capacity, dim]，容量不足时按倍数扩展"""
+
+    MIN_CAPACITY = 1024
+
+    def __init__(self, path: str, dim: int):
+        self.path = path
+        self.dim = dim
+        self._view: Optional[np.memmap] = None
+
+    def capacity(self) -> int:
+        return os.path.getsize(self.path) // (4 * self.dim) if os.path.exists(self.path) else 0
+
+    def write(self, slots: np.ndarray, vectors: np.ndarray):
+        needed = int(slots.max()) + 1
+        capacity = self.capacity()
+        if needed > capacity:
+            capacity = max(needed, capacity * 2, self.MIN_CAPACITY)
+            with open(self.path, "ab") as f:
+                f.truncate(capacity * 4 * self.dim)
+            self._view = None  # 文件变长，旧映射需重建
+        mm = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        mm[slots] = vectors
+        mm.flush()
+        del mm
+
+    def view(self) -> np.ndarray:
+        """只读映射；与写入共享页缓存，写入后无需重新映射"""
+        if self._view is None:
+            self._view = np.memmap(self.path, dtype=np.float32, mode="r", shape=(self.capacity(), self.dim))
+        return self._view
+
+    def close(self):
+        self._view = None
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"无法序列化 {type(value)}")
+
+
+def _dumps(source: Dict) -> str:
+    return json.dumps(source, ensure_ascii=False, default=_json_default)
+
+
+def _placeholders(n: int) -> str:
+    return ",".join("?" * n)
+
+
+# -------------------------
+# 存储后端
+# -------------------------
+
+class LocalStore(RAGStore):
+    def __init__(
+            self,
+            path: str = config.LOCAL_STORE_DIR,
+            vector_index: str = config.LOCAL_VECTOR_INDEX,
+            tokenizer: str = config.LOCAL_TOKENIZER
+    ):
+        super().__init__()
+        self.path = path
+        self.vector_index = vector_index
+        self.tokenizer = tokenizer
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._vectors: Dict[str, _VectorFile] = {}
+        self._versions: Dict[str, int] = defaultdict(int)     # 工作区向量的写入版本，HNSW 索引据此失效
+        self._hnsw: Dict[str, Tuple[int, Any]] = {}
+        self._slot_tables: Dict[str, Tuple[int, Dict[str, np.ndarray]]] = {}
+        self._hnsw_unavailable = False
+        self._open()
+
+    # -------------------------
+    # 生命周期
+    # -------------------------
+
+    def _open(self):
+        os.makedirs(os.path.join(self.path, "vectors"), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(self.path, "store.sqlite3"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        row = self._conn.execute("SELECT value FROM meta WHERE key='tokenizer'").fetchone()
+        if row is not None and row[0] != self.tokenizer:
+            self._rebuild_postings()
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (self.tokenizer,))
+
+    def init_indices(self, overwrite: bool = False) -> bool:
+        """overwrite=True 时清空全部数据"""
+        if overwrite:
+            with self._lock:
+                self.close()
+                shutil.rmtree(self.path, ignore_errors=True)
+                self._versions.clear()
+                self._open()
+            logger.info(f"🔄 已清空本地存储: {self.path}")
+        return True
+
+    def ping(self) -> bool:
+        with self._lock:
+            try:
+                self._conn.execute("SELECT 1")
+                return True
+            except Exception:
+                return False
+
+    def refresh_all(self):
+        """写入即可见，无需刷新"""
+
+    def close(self):
+        with self._lock:
+            for vf in self._vectors.values():
+                vf.close()
+            self._vectors.clear()
+            self._hnsw.clear()
+            self._slot_tables.clear()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # -------------------------
+    # 文档
+    # -------------------------
+
+    def create_document(self, doc_id: str, data: Union[DocumentMeta, Dict[str, Any]]) -> Dict:
+        body = self._validate_and_serialize(DocumentMeta, data)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO documents VALUES (?, ?)", (doc_id, _dumps(body)))
+        return {"_id": doc_id, "result": "created"}
+
+    def get_document(self, doc_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT source FROM documents WHERE doc_id=?", (doc_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_document(self, doc_id: str, update_data: Union[DocumentMeta, Dict[str, Any]]) -> Optional[Dict]:
+        body = self._validate_and_serialize(DocumentMeta, update_data)
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT source FROM documents WHERE doc_id=?", (doc_id,)).fetchone()
+            if row is None:
+                return None
+            source = {**json.loads(row[0]), **json.loads(_dumps(body))}
+            self._conn.execute("UPDATE documents SET source=? WHERE doc_id=?", (_dumps(source), doc_id))
+        return {"_id": doc_id, "result": "updated"}
+
+    def delete_document(self, doc_id: str) -> Optional[Dict]:
+        with self._lock, self._conn:
+            deleted = self._conn.execute("DELETE FROM documents WHERE doc_id=?", (doc_id,)).rowcount
+        return {"_id": doc_id, "result": "deleted"} if deleted else None
+
+    # -------------------------
+    # chunk 写入
+    # -------------------------
+
+    def _vector_path(self, workspace_id: str, generation: int) -> str:
+        return os.path.join(self.path, "vectors", f"{quote(str(workspace_id), safe='')}.{generation}.f32")
+
+    def _vector_file(self, workspace_id: str, dim: Optional[int] = None) -> Optional[_VectorFile]:
+        vf = self._vectors.get(workspace_id)
+        if vf is None:
+            row = self._conn.execute("SELECT dim, generation FROM vector_files WHERE workspace_id=?",
+                                     (workspace_id,)).fetchone()
+            if row is None:
+                if dim is None:
+                    return None
+                generation = 0
+                self._conn.execute("INSERT INTO vector_files VALUES (?, ?, 0, 0)", (workspace_id, dim))
+            else:
+                dim, generation = row
+            vf = self._vectors[workspace_id] = _VectorFile(self._vector_path(workspace_id, generation), dim)
+        return vf
+
+    def _allocate_slots(self, workspace_id: str, n: int) -> np.ndarray:
+        start = self._conn.execute("SELECT next_slot FROM vector_files WHERE workspace_id=?",
+                                   (workspace_id,)).fetchone()[0]
+        self._conn.execute("UPDATE vector_files SET next_slot=? WHERE workspace_id=?", (start + n, workspace_id))
+        return np.arange(start, start + n, dtype=np.int64)
+
+    def _read_vector(self, workspace_id: str, slot: int) -> np.ndarray:
+        return np.array(self._vector_file(workspace_id).view()[slot])
+
+    def _rebuild_postings(self):
+        """分词方式变化后按新分词器重建全部倒排"""
+        logger.info(f"🔄 分词方式变为 {self.tokenizer}，重建倒排索引")
+        with self._conn:
+            self._conn.execute("DELETE FROM postings")
+            rows = self._conn.execute("SELECT chunk_id, workspace_id, source FROM chunks").fetchall()
+            for chunk_id, ws, source in rows:
+                postings = []
+                length = self._postings(chunk_id, ws, json.loads(source)["chunk_content"], postings)
+                self._conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)", postings)
+                self._conn.execute("UPDATE chunks SET length=? WHERE chunk_id=?", (length, chunk_id))
+
+    def _postings(self, chunk_id: str, workspace_id: str, content: str, out: List[Tuple]) -> int:
+        """把 chunk 的倒排记录追加到 out，返回词数（BM25 的文档长度）"""
+        terms = Counter(tokenize(content, self.tokenizer))
+        out.extend((workspace_id, t, chunk_id, tf) for t, tf in terms.items())
+        return sum(terms.values())
+
+    def _write_chunks(self, bodies: List[Dict], vectors: List[Optional[np.ndarray]], reindex_text: List[bool]):
+        """
+        写入（新增或覆盖）chunk，需在锁与事务内调用。
+        vectors[i] 为 None 表示沿用原向量；reindex_text[i] 为 False 且工作区未变时不重建倒排。
+        """
+        ids = [b["chunk_id"] for b in bodies]
+        existing = {}
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            existing.update((r[0], (r[1], r[2], r[3])) for r in self._conn.execute(
+                f"SELECT chunk_id, workspace_id, vec_slot, length FROM chunks WHERE chunk_id IN ({_placeholders(len(part))})",
+                part))
+
+        pending: Dict[str, List[Tuple[int, int, np.ndarray]]] = defaultdict(list)  # 工作区 -> [(第几条, 行号, 向量)]
+        fresh: Dict[str, List[int]] = defaultdict(list)
+        slot_kept: Dict[int, int] = {}
+        reindexed: List[str] = []
+        postings: List[Tuple] = []
+        rows = []
+        for i, body in enumerate(bodies):
+            ws = str(body["workspace_id"])
+            old = existing.get(body["chunk_id"])
+            vector = vectors[i]
+            if vector is None and old is None:
+                raise ValueError(f"chunk {body['chunk_id']} 不存在且未提供向量")
+            if old is not None and old[0] == ws:
+                if vector is None:  # 向量与所在文件都不变
+                    slot_kept[i] = old[1]
+                else:
+                    pending[ws].append((i, old[1], vector))
+            else:
+                if vector is None:  # 换了工作区：从原文件读出向量，写入新工作区
+                    vector = self._read_vector(old[0], old[1])
+                fresh[ws].append(i)
+                pending[ws].append((i, -1, vector))
+            if old is not None and old[0] != ws:
+                self._versions[old[0]] += 1
+            if reindex_text[i] or old is None or old[0] != ws:
+                if old is not None:
+                    reindexed.append(body["chunk_id"])
+                length = self._postings(body["chunk_id"], ws, body["chunk_content"], postings)
+            else:
+                length = old[2]
+            source = {k: v for k, v in body.items() if k != "embedding_vector"}
+            rows.append([body["chunk_id"], body["doc_id"], ws, body["user_username"],
+                         body.get("chunk_order"), body.get("page_number"), length, slot_kept.get(i), _dumps(source)])
+
+        for ws, items in pending.items():
+            dim = len(items[0][2])
+            vf = self._vector_file(ws, dim)
+            if vf.dim != dim:
+                raise ValueError(f"工作区 {ws} 的向量维度为 {vf.dim}，收到 {dim}")
+            new_slots = iter(self._allocate_slots(ws, len(fresh[ws])).tolist()) if fresh[ws] else iter(())
+            slots = np.array([slot if slot >= 0 else next(new_slots) for _, slot, _ in items], dtype=np.int64)
+            matrix = _normalize_rows(np.asarray([v for _, _, v in items], dtype=np.float32))
+            vf.write(slots, matrix)
+            for (i, _, _), slot in zip(items, slots.tolist()):
+                rows[i][7] = slot
+
+        for start in range(0, len(reindexed), 500):
+            part = reindexed[start:start + 500]
+            self._conn.execute(f"DELETE FROM postings WHERE chunk_id IN ({_placeholders(len(part))})", part)
+        # 按主键顺序插入，B 树页写入更集中
+        postings.sort()
+        self._conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)", postings)
+        self._conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        for ws in {row[2] for row in rows}:
+            self._versions[ws] += 1
+
+    def _delete_rows(self, where: str, params: Tuple) -> List[Tuple[str, str]]:
+        """删除满足条件的 chunk，返回 [(chunk_id, workspace_id)]；需在锁与事务内调用"""
+        removed = self._conn.execute(f"SELECT chunk_id, workspace_id FROM chunks WHERE {where}", params).fetchall()
+        for start in range(0, len(removed), 500):
+            part = [cid for cid, _ in removed[start:start + 500]]
+            marks = _placeholders(len(part))
+            self._conn.execute(f"DELETE FROM postings WHERE chunk_id IN ({marks})", part)
+            self._conn.execute(f"DELETE FROM chunks WHERE chunk_id IN ({marks})", part)
+        for ws in {ws for _, ws in removed}:
+            self._versions[ws] += 1
+        return removed
+
+    def _maybe_compact(self, workspace_ids):
+        """
+        空洞超过一半时把存活的行写入下一代文件，元数据提交后再删除旧文件；
+        中途崩溃时元数据仍指向完整的旧文件
+        """
+        for ws in workspace_ids:
+            row = self._conn.execute("SELECT next_slot, generation FROM vector_files WHERE workspace_id=?",
+                                     (ws,)).fetchone()
+            if row is None:
+                continue
+            next_slot, generation = row
+            live = self._conn.execute("SELECT chunk_id, vec_slot FROM chunks WHERE workspace_id=? ORDER BY vec_slot",
+                                      (ws,)).fetchall()
+            if next_slot < _VectorFile.MIN_CAPACITY or len(live) * 2 > next_slot:
+                continue
+            old = self._vector_file(ws)
+            new = _VectorFile(self._vector_path(ws, generation + 1), old.dim)
+            if live:
+                new.write(np.arange(len(live), dtype=np.int64),
+                          np.asarray(old.view()[np.array([slot for _, slot in live], dtype=np.int64)]))
+            with self._conn:
+                self._conn.execute("UPDATE vector_files SET next_slot=?, generation=? WHERE workspace_id=?",
+                                   (len(live), generation + 1, ws))
+                self._conn.executemany("UPDATE chunks SET vec_slot=? WHERE chunk_id=?",
+                                       [(i, cid) for i, (cid, _) in enumerate(live)])
+            old.close()
+            self._vectors[ws] = new
+            if os.path.exists(old.path):
+                os.remove(old.path)
+            self._versions[ws] += 1
+            logger.info(f"🧹 整理向量文件 {ws}: {next_slot} -> {len(live)} 行")
+
+    def create_chunk(self, chunk_id: str, data: Union[ChunkInfo, Dict[str, Any]]) -> Dict:
+        body = self._validate_and_serialize(ChunkInfo, data)
+        with self._lock:
+            with self._conn:
+                self._write_chunks([body], [np.asarray(body["embedding_vector"], dtype=np.float32)], [True])
+        self._notify_chunks(ChunkChange("upsert", [chunk_id], body["doc_id"], {body["workspace_id"]}))
+        return {"_id": chunk_id, "result": "created"}
+
+    def update_chunk(self, chunk_id: str, update_data: Union[ChunkInfo, Dict[str, Any]]) -> Optional[Dict]:
+        body = self._validate_and_serialize(ChunkInfo, update_data)
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM chunks WHERE chunk_id=?", (chunk_id,)).fetchone() is None:
+                return None
+            with self._conn:
+                self._write_chunks([body], [np.asarray(body["embedding_vector"], dtype=np.float32)], [True])
+        self._notify_chunks(ChunkChange("upsert", [chunk_id], body.get("doc_id")))
+        return {"_id": chunk_id, "result": "updated"}
+
+    def delete_chunk(self, chunk_id: str) -> Optional[Dict]:
+        with self._lock:
+            with self._conn:
+                removed = self._delete_rows("chunk_id=?", (chunk_id,))
+            self._maybe_compact({ws for _, ws in removed})
+        if not removed:
+            return None
+        self._notify_chunks(ChunkChange("delete", [chunk_id], workspace_ids={ws for _, ws in removed}))
+        return {"_id": chunk_id, "result": "deleted"}
+
+    def bulk_create_chunks(self, chunks: List[Union[ChunkInfo, Dict]]) -> Tuple[int, list]:
+        bodies = [self._validate_and_serialize(ChunkInfo, c) for c in chunks]
+        if not bodies:
+            return 0, []
+        with self._lock:
+            with self._conn:
+                self._write_chunks(bodies, [np.asarray(b["embedding_vector"], dtype=np.float32) for b in bodies],
+                                   [True] * len(bodies))
+        doc_ids = {b["doc_id"] for b in bodies}
+        self._notify_chunks(ChunkChange(
+            "upsert",
+            [b["chunk_id"] for b in bodies],
+            doc_ids.pop() if len(doc_ids) == 1 else None,
+            {b["workspace_id"] for b in bodies},
+        ))
+        return len(bodies), []
+
+    def bulk_update_chunks(self, updates: List[Dict[str, Any]]) -> Tuple[int, list]:
+        if not updates:
+            return 0, []
+        with self._lock:
+            ids = [u["chunk_id"] for u in updates]
+            sources = dict(self._conn.execute(
+                f"SELECT chunk_id, source FROM chunks WHERE chunk_id IN ({_placeholders(len(ids))})", ids))
+            missing = [cid for cid in ids if cid not in sources]
+            if missing:
+                raise ValueError(f"chunk 不存在: {missing[:5]}")
+            bodies, vectors, reindex = [], [], []
+            for item in updates:
+                fields = {k: v for k, v in item.items() if k != "chunk_id"}
+                bodies.append({**json.loads(sources[item["chunk_id"]]), **fields})
+                vector = fields.get("embedding_vector")
+                vectors.append(None if vector is None else np.asarray(vector, dtype=np.float32))
+                reindex.append("chunk_content" in fields)
+            with self._conn:
+                self._write_chunks(bodies, vectors, reindex)
+        self._notify_chunks(ChunkChange("upsert", ids))
+        return len(updates), []
+
+    def bulk_delete_chunks(self, chunk_ids: List[str]) -> Tuple[int, list]:
+        chunk_ids = list(chunk_ids)
+        removed = []
+        with self._lock:
+            with self._conn:
+                for start in range(0, len(chunk_ids), 500):
+                    part = chunk_ids[start:start + 500]
+                    removed += self._delete_rows(f"chunk_id IN ({_placeholders(len(part))})", tuple(part))
+            self._maybe_compact({ws for _, ws in removed})
+        if removed:
+            self._notify_chunks(ChunkChange("delete", chunk_ids, workspace_ids={ws for _, ws in removed}))
+        return len(removed), []
+
+    def delete_chunks_by_doc(self, doc_id: str) -> Dict:
+        with self._lock:
+            with self._conn:
+                removed = self._delete_rows("doc_id=?", (doc_id,))
+            self._maybe_compact({ws for _, ws in removed})
+        if removed:
+            self._notify_chunks(ChunkChange("delete", doc_id=doc_id, workspace_ids={ws for _, ws in removed}))
+        return {"deleted": len(removed)}
+
+    def iter_chunk_positions(self, doc_id: str) -> Iterator[Tuple[str, Optional[int], Optional[int]]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT chunk_id, chunk_order, page_number FROM chunks WHERE doc_id=?",
+                                      (doc_id,)).fetchall()
+        yield from rows
+
+    def clone_document_chunks(self, src_doc_id: str, dst_doc_id: str, workspace_id: str,
+                              user_username: str, bulk_size: int = 500,
+                              should_stop: Optional[Callable[[], bool]] = None) -> int:
+        """复制已入库文档的 chunk（含向量）到新的文档/工作区/用户名下"""
+        prefix = f"{src_doc_id}_"
+        now = datetime.utcnow().isoformat()
+        with self._lock:
+            rows = self._conn.execute("SELECT source, workspace_id, vec_slot FROM chunks WHERE doc_id=?",
+                                      (src_doc_id,)).fetchall()
+            bodies, vectors = [], []
+            for source, ws, slot in rows:
+                src = json.loads(source)
+                suffix = src["chunk_id"][len(prefix):] if src["chunk_id"].startswith(prefix) else src["chunk_id"]
+                src.update(
+                    chunk_id=f"{dst_doc_id}_{suffix}",
+                    doc_id=dst_doc_id,
+                    workspace_id=workspace_id,
+                    user_username=user_username,
+                    created_at=now,
+                )
+                bodies.append(src)
+                vectors.append(self._read_vector(ws, slot))
+            copied = 0
+            with self._conn:
+                for start in range(0, len(bodies), bulk_size):
+                    if should_stop is not None and should_stop():
+                        break
+                    batch = bodies[start:start + bulk_size]
+                    self._write_chunks(batch, vectors[start:start + bulk_size], [True] * len(batch))
+                    copied += len(batch)
+        self._notify_chunks(ChunkChange("upsert", doc_id=dst_doc_id, workspace_ids={workspace_id}))
+        return copied
+
+    def get_chunk(self, chunk_id: str) -> Optional[Dict]:
+        """与 ES 的 get 一致，返回含 embedding_vector 的完整字段"""
+        with self._lock:
+            row = self._conn.execute("SELECT source, workspace_id, vec_slot FROM chunks WHERE chunk_id=?",
+                                     (chunk_id,)).fetchone()
+            if row is None:
+                return None
+            return {**json.loads(row[0]), "embedding_vector": self._read_vector(row[1], row[2]).tolist()}
+
+    # -------------------------
+    # 检索
+    # -------------------------
+
+    def _filter_sql(self, workspace_id, username: str, doc_ids: Optional[List[str]]) -> Tuple[str, List]:
+        where = "c.workspace_id=? AND c.user_username=?"
+        params: List[Any] = [str(workspace_id), username]
+        if doc_ids is not None:
+            where += f" AND c.doc_id IN ({_placeholders(len(doc_ids))})"
+            params += list(doc_ids)
+        return where, params
+
+    def _load_hits(self, workspace_id: str, scored: List[Tuple[str, float]], include_vectors: bool) -> List[Dict]:
+        if not scored:
+            return []
+        ids = [cid for cid, _ in scored]
+        rows = {r[0]: (r[1], r[2]) for r in self._conn.execute(
+            f"SELECT chunk_id, source, vec_slot FROM chunks WHERE chunk_id IN ({_placeholders(len(ids))})", ids)}
+        view = self._vector_file(workspace_id).view() if include_vectors else None
+        hits = []
+        for cid, score in scored:
+            source, slot = rows[cid]
+            hit = json.loads(source)
+            hit.pop("rerank_token_ids", None)  # 与 ES 后端一致，由 rerank_token_ids() 按需取回
+            if view is not None:
+                hit["embedding_vector"] = view[slot].tolist()
+            hit["_score"] = float(score)
+            hits.append(hit)
+        return hits
+
+    def bm25_search_chunks(self, text_query: str, workspace_id, username: str, size: int = 5,
+                           doc_ids: Optional[List[str]] = None, include_vectors: bool = False) -> List[Dict]:
+        query_terms = Counter(tokenize(text_query, self.tokenizer))
+        if not query_terms or size <= 0:
+            return []
+        ws = str(workspace_id)
+        terms = list(query_terms)
+        marks = _placeholders(len(terms))
+        where, params = self._filter_sql(ws, username, doc_ids)
+        with self._lock:
+            n_docs, avg_len = self._conn.execute(
+                "SELECT COUNT(*), AVG(length) FROM chunks WHERE workspace_id=?", (ws,)).fetchone()
+            if not n_docs:
+                return []
+            df = dict(self._conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE workspace_id=? AND term IN ({marks}) GROUP BY term",
+                [ws, *terms]))
+            postings = self._conn.execute(
+                f"SELECT p.chunk_id, p.term, p.tf, c.length FROM postings p JOIN chunks c ON c.chunk_id = p.chunk_id "
+                f"WHERE p.workspace_id=? AND p.term IN ({marks}) AND {where}",
+                [ws, *terms, *params]).fetchall()
+
+            idf = {t: math.log(1 + (n_docs - d + 0.5) / (d + 0.5)) for t, d in df.items()}
+            avg_len = avg_len or 1.0
+            scores: Dict[str, float] = defaultdict(float)
+            for cid, term, tf, length in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_len)
+                scores[cid] += query_terms[term] * idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+            top = heapq.nlargest(size, scores.items(), key=lambda item: item[1])
+            return self._load_hits(ws, top, include_vectors)
+
+    def _hnsw_index(self, workspace_id: str, vf: _VectorFile, live: int):
+        """工作区向量数达到阈值时构建（并缓存）HNSW 索引；未启用、规模不足或缺少 hnswlib 时返回 None"""
+        if self.vector_index != "hnsw" or live < config.LOCAL_HNSW_MIN_SIZE or self._hnsw_unavailable:
+            return None
+        version = self._versions[workspace_id]
+        cached = self._hnsw.get(workspace_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        try:
+            import hnswlib  # type: ignore
+        except ImportError:
+            logger.warning("⚠️ 未安装 hnswlib，向量检索退回精确计算")
+            self._hnsw_unavailable = True
+            return None
+        slots = self._slot_table(workspace_id)["slots"]
+        index = hnswlib.Index(space="ip", dim=vf.dim)
+        index.init_index(max_elements=len(slots), ef_construction=200, M=16)
+        index.add_items(np.asarray(vf.view()[slots]), slots)
+        self._hnsw[workspace_id] = (version, index)
+        logger.info(f"✅ 工作区 {workspace_id} 的 HNSW 索引已构建：{len(slots)} 个向量")
+        return index
+
+    def _slot_table(self, workspace_id: str) -> Dict[str, np.ndarray]:
+        """工作区内 chunk 的行号与过滤字段（numpy 数组），按写入版本缓存，向量检索时免去逐次查询 SQLite"""
+        version = self._versions[workspace_id]
+        cached = self._slot_tables.get(workspace_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        rows = self._conn.execute("SELECT chunk_id, vec_slot, user_username, doc_id FROM chunks WHERE workspace_id=?",
+                                  (workspace_id,)).fetchall()
+        columns = list(zip(*rows)) if rows else [(), (), (), ()]
+        table = {
+            "chunk_ids": np.array(columns[0], dtype=object),
+            "slots": np.array(columns[1], dtype=np.int64),
+            "users": np.array(columns[2], dtype=object),
+            "docs": np.array(columns[3], dtype=object),
+        }
+        self._slot_tables[workspace_id] = (version, table)
+        return table
+
+    def knn_search_chunks(self, vector_query: List[float], workspace_id, username: str, k: int = 5,
+                          doc_ids: Optional[List[str]] = None, include_vectors: bool = False) -> List[Dict]:
+        if k <= 0:
+            return []
+        ws = str(workspace_id)
+        query = np.asarray(vector_query, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            vf = self._vector_file(ws)
+            if vf is None:
+                return []
+            table = self._slot_table(ws)
+            mask = table["users"] == username
+            if doc_ids is not None:
+                mask &= np.isin(table["docs"], list(doc_ids))
+            slots, chunk_ids = table["slots"][mask], table["chunk_ids"][mask]
+            if len(slots) == 0:
+                return []
+            index = self._hnsw_index(ws, vf, len(table["slots"]))
+            if index is not None:
+                by_slot = dict(zip(slots.tolist(), chunk_ids.tolist()))
+                index.set_ef(max(64, k * 4))
+                labels, distances = index.knn_query(query, k=min(k, len(by_slot)),
+                                                    filter=lambda label: label in by_slot)
+                sims = 1.0 - distances[0]
+                top = [(by_slot[int(label)], (1.0 + float(sim)) / 2) for label, sim in zip(labels[0], sims)]
+            else:
+                # 对文件中已用的全部行做一次矩阵-向量乘（顺序读取映射页，避免按行拷贝），再取出过滤后的行
+                used = int(table["slots"].max()) + 1
+                sims = (vf.view()[:used] @ query)[slots]
+                kk = min(k, len(slots))
+                order = np.argpartition(-sims, kk - 1)[:kk]
+                order = order[np.argsort(-sims[order])]
+                top = [(chunk_ids[i], (1.0 + float(sims[i])) / 2) for i in order]
+            return self._load_hits(ws, top, include_vectors)
+
+    def rerank_token_ids(self, chunk_ids: List[str], workspace_id) -> Dict[str, List[int]]:
+        if not chunk_ids:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT chunk_id, source FROM chunks WHERE chunk_id IN ({_placeholders(len(chunk_ids))})",
+                list(chunk_ids)).fetchall()
+        result = {}
+        for cid, source in rows:
+            ids = json.loads(source).get("rerank_token_ids")
+            if ids:
+                result[cid] = ids
+        return result
+
+
+# -------------------------
+# 异步包装：供 async 接口使用，阻塞调用交给有界执行器
+# -------------------------
+
+class AsyncLocalStore:
+    """提供与 AsyncSmallRAGDB 相同的检索方法，内部在 BlockingExecutor 中调用 LocalStore"""
+
+    def __init__(self, store: LocalStore, executor):
+        self.store = store
+        self.executor = executor
+
+    async def close(self):
+        """底层 LocalStore 由同步端持有，这里无需关闭"""
+
+    async def ping(self) -> bool:
+        return await self.executor.run(self.store.ping)
+
+    async def get_document(self, doc_id: str) -> Optional[Dict]:
+        return await self.executor.run(self.store.get_document, doc_id)
+
+    async def bm25_search_chunks(self, text_query: str, workspace_id, username: str, size: int = 5,
+                                 doc_ids: Optional[List[str]] = None, include_vectors: bool = False) -> List[Dict]:
+        return await self.executor.run(self.store.bm25_search_chunks, text_query, workspace_id, username,
+                                       size, doc_ids, include_vectors)
+
+    async def knn_search_chunks(self, vector_query: List[float], workspace_id, username: str, k: int = 5,
+                                doc_ids: Optional[List[str]] = None, include_vectors: bool = False) -> List[Dict]:
+        return await self.executor.run(self.store.knn_search_chunks, vector_query, workspace_id, username,
+                                       k, doc_ids, include_vectors)
+
+    async def hybrid_search_chunks(self, *args, **kwargs):
+        return await self.executor.run(self.store.hybrid_search_chunks, *args, **kwargs)
+
+    async def rerank_token_ids(self, chunk_ids: List[str], workspace_id) -> Dict[str, List[int]]:
+        return await self.executor.run(self.store.rerank_token_ids, chunk_ids, workspace_id)
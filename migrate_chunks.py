@@ -0,0 +1,136 @@
+import argparse
+import time
+import logging
+from datetime import datetime, timedelta
+
+import config
+from dataES import SmallRAGDB
+
+"""
+chunk 索引迁移到租户布局：按 workspace_id routing，并写入 tenant_key（workspace_id:user_username）
+
+步骤：
+1. 新建实体索引 {chunk 索引名}_v{n}（租户布局的 mapping，--shards 个主分片）
+2. _reindex 旧数据，脚本为每条 chunk 写入 tenant_key，并以 workspace_id 作为 routing
+3. 核对新旧文档数，不一致时保留旧索引并退出
+4. 一次 update_aliases 原子切换：别名指向新索引；旧布局的同名实体索引在同一请求中删除（remove_index）
+
+已是租户布局时同样可用于调整分片数（新建下一个版本后切换别名）。
+_reindex 开始后写入旧索引的 chunk 不会被迁移，因此 SQLite 中还有待处理或租约未过期的入库任务时拒绝运行
+（--force 跳过检查）。切换别名后运行中的服务会在 ES_LAYOUT_CHECK_SECONDS 内（或下一次写入遇到
+routing_missing 时）自动检测到新布局，无需重启。
+
+用法：
+    python migrate_chunks.py
+    python migrate_chunks.py --shards 8 --delete-old
+"""
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# workspace_id 在旧数据中可能是数字，统一转成字符串
+REINDEX_SCRIPT = (
+    "String ws = String.valueOf(ctx._source.workspace_id);"
+    "ctx._source.tenant_key = ws + ':' + ctx._source.user_username;"
+    "ctx._routing = ws;"
+)
+
+
+def _next_index_name(db: SmallRAGDB, alias: str) -> str:
+    version = 1
+    while db.es.indices.exists(index=f"{alias}_v{version}"):
+        version += 1
+    return f"{alias}_v{version}"
+
+
+def _wait_for_task(db: SmallRAGDB, task_id: str, poll_seconds: float) -> dict:
+    while True:
+        task = db.es.tasks.get(task_id=task_id)
+        status = task["task"]["status"]
+        if task["completed"]:
+            return task.get("response", {})
+        logger.info(f"⏳ reindex 进度: {status.get('created', 0) + status.get('updated', 0)} / {status.get('total', 0)}")
+        time.sleep(poll_seconds)
+
+
+def _active_ingest_jobs() -> int:
+    """待处理或租约未过期（仍有进程在写入）的入库任务数"""
+    from dataSQL import dataSession, IngestJob
+    deadline = datetime.utcnow() - timedelta(seconds=config.INGEST_LEASE_SECONDS)
+    with dataSession() as session:
+        return session.query(IngestJob).filter(
+            (IngestJob.status == "pending")
+            | ((IngestJob.status == "processing") & (IngestJob.heartbeat_at >= deadline))
+        ).count()
+
+
+def migrate(db: SmallRAGDB, shards: int, delete_old: bool = False, poll_seconds: float = 5.0) -> bool:
+    es = db.es
+    alias = db._indices["chunk"]
+    if not es.indices.exists(index=alias):
+        logger.error(f"❌ 索引不存在: {alias}")
+        return False
+    is_alias = bool(es.indices.exists_alias(name=alias))
+    sources = db.concrete_indices(alias)
+    target = _next_index_name(db, alias)
+    mapping = db._get_mappings()["chunk"]
+
+    logger.info(f"🚚 {alias}（{', '.join(sources)}）-> {target}，{shards} 个主分片")
+    es.indices.create(index=target, body={**mapping, "settings": {"number_of_shards": shards}})
+    start = time.perf_counter()
+    task = es.reindex(
+        source={"index": alias},
+        dest={"index": target},
+        script={"source": REINDEX_SCRIPT, "lang": "painless"},
+        slices="auto",
+        wait_for_completion=False,
+    )
+    response = _wait_for_task(db, task["task"], poll_seconds)
+    if response.get("failures"):
+        logger.error(f"❌ reindex 失败，保留旧索引，新索引 {target} 需手动删除: {response['failures'][:3]}")
+        return False
+
+    es.indices.refresh(index=target)
+    old_count = es.count(index=alias)["count"]
+    new_count = es.count(index=target)["count"]
+    if old_count != new_count:
+        logger.error(f"❌ 文档数不一致（旧 {old_count} / 新 {new_count}），保留旧索引，新索引 {target} 需手动删除")
+        return False
+
+    actions = [{"add": {"index": target, "alias": alias}}]
+    if is_alias:
+        actions += [{"remove": {"index": index, "alias": alias}} for index in sources]
+    else:
+        # 旧布局下 chunk 索引名本身是实体索引，删掉它才能把同名别名指向新索引
+        actions.append({"remove_index": {"index": alias}})
+    es.indices.update_aliases(actions=actions)
+    logger.info(f"✅ 已迁移 {new_count} 个 chunk，耗时 {time.perf_counter() - start:.1f}s；{alias} 现指向 {target}")
+
+    if is_alias and delete_old:
+        es.indices.delete(index=",".join(sources))
+        logger.info(f"🗑️ 已删除旧索引: {', '.join(sources)}")
+    elif is_alias:
+        logger.info(f"ℹ️ 旧索引 {', '.join(sources)} 仍保留，确认无误后可加 --delete-old 或手动删除")
+    logger.info(f"ℹ️ 运行中的服务将在 {config.ES_LAYOUT_CHECK_SECONDS:.0f}s 内切换到新布局")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="chunk 索引迁移到按工作区 routing 的租户布局")
+    parser.add_argument("--es-url", default=config.ES_URL)
+    parser.add_argument("--index-prefix", default="smallrag")
+    parser.add_argument("--shards", type=int, default=config.ES_CHUNK_SHARDS, help="新索引的主分片数")
+    parser.add_argument("--delete-old", action="store_true", help="切换别名后删除旧的实体索引（旧布局的同名索引总会被删除）")
+    parser.add_argument("--poll-seconds", type=float, default=5.0)
+    parser.add_argument("--force", action="store_true", help="不检查是否有正在进行的入库任务")
+    args = parser.parse_args()
+
+    if not args.force:
+        active = _active_ingest_jobs()
+        if active:
+            raise SystemExit(f"❌ 还有 {active} 个入库任务待处理或正在运行，迁移期间的写入会丢失；"
+                             f"请等待完成或暂停入库后重试（--force 跳过检查）")
+    db = SmallRAGDB(es_url=args.es_url, index_prefix=args.index_prefix)
+    if not db.ping():
+        raise SystemExit(f"❌ 无法连接 Elasticsearch: {args.es_url}")
+    raise SystemExit(0 if migrate(db, args.shards, args.delete_old, args.poll_seconds) else 1)
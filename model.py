@@ -1,45 +1,273 @@
 import os
 
 import numpy as np
-import torch
 
 os.environ["OPENAI_API_KEY"] = "sk-ea07bf0880504b75a31b1bce38437fcf"
 os.environ["OPENAI_BASE_URL"] = "https://dashscope.aliyuncs.com/compatible-mode/v1"
 import openai
-from typing import Optional,List,Dict
-from transformers import AutoTokenizer, AutoModelForSequenceClassification  # type: ignore
-from sentence_transformers import SentenceTransformer  # type: ignore
+import logging
+import threading
+from typing import Optional,List,Dict,Tuple,Set,Union
+import config
+from embedding_cache import EmbeddingCache, text_hash
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cpu_list(spec: str) -> Optional[Set[int]]:
+    """解析 "0-3,8,10-11" 形式的 CPU 列表，空字符串表示不绑核"""
+    if not spec.strip():
+        return None
+    cpus: Set[int] = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.update(range(int(lo), int(hi) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+class ThreadBudget:
+    """
+    单个模型的 CPU 线程预算。
+    - intra_op：单个算子内并行的线程数；torch 在每次前向前按调用线程设置，ONNX 对应 session 参数
+    - inter_op：算子间并行的线程数；torch 中为进程级设置（取各模型的最大值，只能在首次推理前设置一次），ONNX 为 session 级
+    - cpus：执行推理的线程绑定到这些核上（Linux），其后创建的计算线程继承该亲和性
+    0 / 空表示沿用框架默认值
+    """
+
+    _torch_inter_op_set = False
+    _torch_lock = threading.Lock()
+
+    def __init__(self, name: str, intra_op: int = 0, inter_op: int = 0, cpus: Optional[Set[int]] = None):
+        self.name = name
+        self.intra_op = intra_op
+        self.inter_op = inter_op
+        self.cpus = cpus
+        self._local = threading.local()
+
+    @classmethod
+    def for_model(cls, name: str) -> "ThreadBudget":
+        """name: embed / rank，读取 config 中对应前缀的设置"""
+        prefix = name.upper()
+        return cls(
+            name,
+            intra_op=getattr(config, f"{prefix}_INTRA_OP_THREADS"),
+            inter_op=getattr(config, f"{prefix}_INTER_OP_THREADS"),
+            cpus=parse_cpu_list(getattr(config, f"{prefix}_CPU_AFFINITY")),
+        )
+
+    def apply_torch_process_settings(self):
+        """torch 的 inter-op 线程池是进程级的，且必须在首次推理前设置"""
+        import torch
+        with ThreadBudget._torch_lock:
+            inter_op = max(config.EMBED_INTER_OP_THREADS, config.RANK_INTER_OP_THREADS)
+            if inter_op > 0 and not ThreadBudget._torch_inter_op_set:
+                try:
+                    torch.set_num_interop_threads(inter_op)
+                except RuntimeError as e:  # 已经执行过推理，无法再修改
+                    logger.warning(f"⚠️ 无法设置 torch inter-op 线程数: {e}")
+                ThreadBudget._torch_inter_op_set = True
+
+    def enter(self):
+        """在执行推理的线程中调用：首次调用时绑核，每次确保 torch intra-op 线程数为本模型的预算"""
+        if not getattr(self._local, "pinned", False):
+            self._local.pinned = True
+            if self.cpus and hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, self.cpus)  # Linux 上 pid=0 只作用于调用线程
+        if self.intra_op > 0:
+            import torch
+            if torch.get_num_threads() != self.intra_op:
+                torch.set_num_threads(self.intra_op)
+
+    def describe(self, backend: str) -> str:
+        cpus = sorted(self.cpus) if self.cpus else "all"
+        if backend == "torch":
+            import torch
+            intra = self.intra_op or torch.get_num_threads()
+            inter = torch.get_num_interop_threads()
+        else:
+            intra, inter = self.intra_op or "auto", self.inter_op or "auto"
+        return (f"🧵 {self.name} 推理线程[{backend}]: intra_op={intra} inter_op={inter} cpus={cpus} "
+                f"(os.cpu_count={os.cpu_count()}, OMP_NUM_THREADS={os.getenv('OMP_NUM_THREADS', '-')})")
+
 
 class Embedding:
-    def __init__(self):
-        self.model_path = "/home/dzl/PycharmProjects/SmallRag/BAAI/bge-base-zh-v1.5"
+    def __init__(self, batch_size: int = config.EMBED_BATCH_SIZE, cache: Optional[EmbeddingCache] = None):
+        self.model_path = config.EMBEDDING_MODEL_PATH
+        self.model_id = os.path.basename(os.path.normpath(self.model_path))
+        self.threads = ThreadBudget.for_model("embed")
+        self.threads.apply_torch_process_settings()
+        # torch / transformers 等重量级依赖延迟到构造时导入，import 本模块不再触发模型框架加载
+        from sentence_transformers import SentenceTransformer  # type: ignore
         self.model = SentenceTransformer(self.model_path)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        logger.info(self.threads.describe("torch"))
+        self.batch_size = batch_size
+        if cache is None and config.EMBED_CACHE_ENABLED:
+            cache = EmbeddingCache(self.model_id)
+        self.cache = cache
 
     def embed(self,text:str)->np.ndarray:
+        self.threads.enter()
         return self.model.encode(text)
 
+    def embed_batch(self, texts: List[str], batch_size: Optional[int] = None, use_cache: bool = True) -> np.ndarray:
+        """
+        批量向量化，返回 shape 为 (len(texts), dim) 的 float32 矩阵，行顺序与输入一致。
+        启用缓存时先按内容哈希查缓存，只对未命中的文本跑模型并回写缓存。
+        use_cache=False 跳过缓存：在线查询几乎不重复，读写 SQLite 只会增加延迟并挤占入库的缓存容量。
+        """
+        if self.cache is None or not use_cache or not texts:
+            return self._encode_batch(texts, batch_size)
+
+        hashes = [text_hash(t) for t in texts]
+        cached = self.cache.get_many(hashes)
+        miss_idx = [i for i, h in enumerate(hashes) if h not in cached]
+
+        result = np.empty((len(texts), self.dimension), dtype=np.float32)
+        if miss_idx:
+            vectors = self._encode_batch([texts[i] for i in miss_idx], batch_size)
+            result[miss_idx] = vectors
+            self.cache.put_many([hashes[i] for i in miss_idx], vectors)
+        for i, h in enumerate(hashes):
+            if h in cached:
+                result[i] = cached[h]
+        return result
+
+    def _encode_batch(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        """
+        先按文本长度排序再分桶，使同一批次内长度接近，减少 padding 带来的无效计算。
+        """
+        batch_size = batch_size or self.batch_size
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+
+        order = np.argsort([len(t) for t in texts], kind="stable")[::-1]  # 长文本在前，显存/内存峰值可提前暴露
+        result = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            idx = order[start:start + batch_size]
+            result[idx] = self._encode([texts[i] for i in idx]).astype(np.float32, copy=False)
+        return result
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """对一个桶内的文本做一次前向，子类（如 ONNX 后端）只需覆盖这一步"""
+        self.threads.enter()
+        return self.model.encode(
+            texts,
+            batch_size=len(texts),
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+
     def check_similarity(self,embedding1,embedding2):
         similarity = self.model.similarity(embedding1, embedding2)
         return similarity.numpy()
 
+RERANK_MAX_LENGTH = 512
+
+
+def _truncate_longest_first(a: List[int], b: List[int], budget: int) -> Tuple[List[int], List[int]]:
+    """与 transformers 的 truncation="longest_first" 相同：先削较长的一段至等长，剩余部分两段平分"""
+    remove = len(a) + len(b) - budget
+    if remove <= 0:
+        return a, b
+    first = min(abs(len(a) - len(b)), remove)
+    second = remove - first
+    if len(a) > len(b):
+        remove_a, remove_b = first + second // 2, second - second // 2
+    else:
+        remove_a, remove_b = second // 2, first + second - second // 2
+    return a[:len(a) - remove_a], b[:len(b) - remove_b]
+
+
 class RankModel:
     def __init__(self):
-        self.model_path = "/home/dzl/PycharmProjects/SmallRag/BAAI/bge-reranker-base"
+        import torch
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification  # type: ignore
+
+        self.model_path = config.RERANK_MODEL_PATH
+        self.model_id = os.path.basename(os.path.normpath(self.model_path))
+        self.threads = ThreadBudget.for_model("rank")
+        self.threads.apply_torch_process_settings()
         self.model = AutoModelForSequenceClassification.from_pretrained(self.model_path)
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
         self.model.eval()
         self.model.to("cuda" if torch.cuda.is_available() else "cpu")
+        logger.info(self.threads.describe("torch"))
 
     def rank(self,question,answers:list[str])->np.ndarray:
-        pairs = [[question, c] for c in answers]
+        scores = self.rank_pairs([(question, c) for c in answers])
+        print(scores)
+        return scores
+
+    def _pretokenized_inputs(self, pairs: List[Tuple[str, Union[str, List[int]]]]) -> Dict[str, np.ndarray]:
+        """
+        answer 为入库时预先计算的 token id（不含特殊符号）时，只对问题分词，
+        再用 build_inputs_with_special_tokens 拼成 [CLS] q [SEP] chunk [SEP]（XLM-R 为 <s> q </s></s> chunk </s>）
+        """
+        tok = self.tokenizer
+        questions = list(dict.fromkeys(q for q, _ in pairs))
+        q_ids = dict(zip(questions, tok(questions, add_special_tokens=False)["input_ids"]))
+        budget = RERANK_MAX_LENGTH - tok.num_special_tokens_to_add(pair=True)
+        with_types = "token_type_ids" in tok.model_input_names
+        seqs, types = [], []
+        for q, a in pairs:
+            a_ids = tok(a, add_special_tokens=False)["input_ids"] if isinstance(a, str) else list(a)
+            qi, ai = _truncate_longest_first(q_ids[q], a_ids, budget)
+            seqs.append(tok.build_inputs_with_special_tokens(qi, ai))
+            if with_types:
+                types.append(tok.create_token_type_ids_from_sequences(qi, ai))
+
+        width = max(len(s) for s in seqs)
+        input_ids = np.full((len(seqs), width), tok.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(seqs), width), dtype=np.int64)
+        token_type_ids = np.zeros((len(seqs), width), dtype=np.int64)
+        for i, seq in enumerate(seqs):
+            input_ids[i, :len(seq)] = seq
+            attention_mask[i, :len(seq)] = 1
+            if with_types:
+                token_type_ids[i, :len(seq)] = types[i]
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if with_types:
+            inputs["token_type_ids"] = token_type_ids
+        return inputs
+
+    def rank_pairs(self, pairs: List[Tuple[str, Union[str, List[int]]]]) -> np.ndarray:
+        """
+        对任意 (question, answer) 对打分，允许不同问题的候选混在同一批次中一次前向。
+        answer 可以是文本，也可以是入库时保存的 rerank token id（见 utills.encode_for_rerank）
+        """
+        if not pairs:
+            return np.empty((0,), dtype=np.float32)
+        import torch
+        self.threads.enter()
         with torch.no_grad():
-            inputs = self.tokenizer(pairs, padding=True, truncation=True, return_tensors='pt', max_length=512)
+            if all(isinstance(a, str) for _, a in pairs):
+                inputs = self.tokenizer([list(p) for p in pairs], padding=True, truncation=True, return_tensors='pt', max_length=RERANK_MAX_LENGTH)
+            else:
+                inputs = {k: torch.from_numpy(v) for k, v in self._pretokenized_inputs(pairs).items()}
             inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
             scores = self.model(**inputs, return_dict=True).logits.view(-1, ).float()
-            print(scores)
             return scores.cpu().numpy()
 
 
+def create_embedding(batch_size: int = config.EMBED_BATCH_SIZE, cache: Optional[EmbeddingCache] = None) -> Embedding:
+    """按 config.INFERENCE_BACKEND 选择推理后端：torch（默认）或 onnx（int8 量化，CPU 部署）"""
+    if config.INFERENCE_BACKEND == "onnx":
+        from onnx_backend import OnnxEmbedding
+        return OnnxEmbedding(batch_size, cache)
+    return Embedding(batch_size, cache)
+
+
+def create_rank_model() -> RankModel:
+    if config.INFERENCE_BACKEND == "onnx":
+        from onnx_backend import OnnxRankModel
+        return OnnxRankModel()
+    return RankModel()
+
 
 class ChatCompletion:
     def __init__(self):
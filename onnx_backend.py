@@ -0,0 +1,212 @@
+import os
+import time
+import logging
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+import config
+from embedding_cache import EmbeddingCache
+from model import Embedding, RankModel, ThreadBudget, RERANK_MAX_LENGTH
+
+"""
+ONNX Runtime CPU 推理后端
+
+- 首次使用时把 PyTorch 模型导出为 ONNX，并用 quantize_dynamic 把权重量化为 int8
+- bge-base-zh 的 CLS 池化 + L2 归一化直接导出进计算图，推理时只需分词 + session.run
+- 推理阶段不依赖 torch，适合无 GPU 的部署；与 torch 后端的一致性用 benchmark.py onnx 检查
+
+预先导出（避免服务首次启动时等待）：
+    python onnx_backend.py export
+"""
+
+logger = logging.getLogger(__name__)
+
+MAX_LENGTH = RERANK_MAX_LENGTH
+_INPUT_ORDER = ("input_ids", "attention_mask", "token_type_ids")
+
+
+# -------------------------
+# 导出与量化（需要 torch / transformers，仅在导出时导入）
+# -------------------------
+
+def _onnx_paths(model_path: str) -> Tuple[str, str]:
+    name = os.path.basename(os.path.normpath(model_path))
+    base = os.path.join(config.ONNX_MODEL_DIR, name)
+    return f"{base}.onnx", f"{base}.int8.onnx"
+
+
+def _export(model_path: str, kind: str, fp32_path: str):
+    import torch
+    from transformers import AutoModel, AutoModelForSequenceClassification, AutoTokenizer  # type: ignore
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if kind == "embedding":
+        model = AutoModel.from_pretrained(model_path)
+        dummy = tokenizer(["导出用的示例文本"], return_tensors="pt")
+        output_name = "sentence_embedding"
+    else:
+        model = AutoModelForSequenceClassification.from_pretrained(model_path)
+        dummy = tokenizer([["示例问题", "示例候选段落"]], return_tensors="pt")
+        output_name = "logits"
+    model.eval()
+    input_names = [n for n in _INPUT_ORDER if n in dummy]
+
+    class _Wrapper(torch.nn.Module):
+        """固定输入顺序，并把池化/归一化（embedding）或 squeeze（rerank）放进计算图"""
+
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, *tensors):
+            out = self.inner(**dict(zip(input_names, tensors)), return_dict=True)
+            if kind == "embedding":
+                cls = out.last_hidden_state[:, 0]
+                return torch.nn.functional.normalize(cls, p=2, dim=1)
+            return out.logits.view(-1)
+
+    dynamic_axes = {n: {0: "batch", 1: "seq"} for n in input_names}
+    dynamic_axes[output_name] = {0: "batch"}
+    os.makedirs(os.path.dirname(os.path.abspath(fp32_path)), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            _Wrapper(model),
+            tuple(dummy[n] for n in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=[output_name],
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+        )
+
+
+def ensure_onnx_model(model_path: str, kind: str, quantize: bool = config.ONNX_QUANTIZE) -> str:
+    """
+    返回可加载的 ONNX 模型路径，缺失时导出（并按需量化）
+    kind: embedding / rerank
+    """
+    fp32_path, int8_path = _onnx_paths(model_path)
+    target = int8_path if quantize else fp32_path
+    if os.path.exists(target):
+        return target
+
+    start = time.perf_counter()
+    if not os.path.exists(fp32_path):
+        logger.info(f"📦 导出 ONNX 模型: {model_path} -> {fp32_path}")
+        _export(model_path, kind, fp32_path)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic  # type: ignore
+        logger.info(f"📦 int8 动态量化: {int8_path}")
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    logger.info(f"✅ ONNX 模型就绪: {target}，耗时 {time.perf_counter() - start:.1f}s")
+    return target
+
+
+def _create_session(onnx_path: str, threads: ThreadBudget):
+    import onnxruntime as ort  # type: ignore
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads.intra_op > 0:
+        options.intra_op_num_threads = threads.intra_op
+    if threads.inter_op > 1:  # inter-op 线程只在并行执行模式下生效
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        options.inter_op_num_threads = threads.inter_op
+    if not threads.cpus or not hasattr(os, "sched_setaffinity"):
+        return ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+    # session 的线程池在创建时生成并继承创建线程的亲和性：临时绑核后创建，再恢复
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, threads.cpus)
+    try:
+        return ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+    finally:
+        os.sched_setaffinity(0, previous)
+
+
+def _backend_suffix(onnx_path: str) -> str:
+    return "-onnx-int8" if onnx_path.endswith(".int8.onnx") else "-onnx"
+
+
+def _feed(session, encoded) -> Dict[str, np.ndarray]:
+    return {i.name: encoded[i.name].astype(np.int64, copy=False) for i in session.get_inputs()}
+
+
+# -------------------------
+# 推理
+# -------------------------
+
+class OnnxEmbedding(Embedding):
+    """接口与 Embedding 一致；缓存、按长度分桶逻辑沿用父类，只替换单桶前向"""
+
+    def __init__(self, batch_size: int = config.EMBED_BATCH_SIZE, cache: Optional[EmbeddingCache] = None):
+        from transformers import AutoTokenizer  # type: ignore
+
+        self.model_path = config.EMBEDDING_MODEL_PATH
+        self.onnx_path = ensure_onnx_model(self.model_path, "embedding")
+        # 量化后的向量与原模型存在微小差异，缓存按后端区分，避免与 torch 后端的向量混用
+        self.model_id = os.path.basename(os.path.normpath(self.model_path)) + _backend_suffix(self.onnx_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        self.threads = ThreadBudget.for_model("embed")
+        self.session = _create_session(self.onnx_path, self.threads)
+        logger.info(self.threads.describe("onnx"))
+        self.dimension = self.session.get_outputs()[0].shape[-1]
+        if not isinstance(self.dimension, int):  # 输出维度未被静态推断时跑一次得到
+            self.dimension = self._encode(["维度探测"]).shape[1]
+        self.batch_size = batch_size
+        if cache is None and config.EMBED_CACHE_ENABLED:
+            cache = EmbeddingCache(self.model_id)
+        self.cache = cache
+
+    def embed(self, text: str) -> np.ndarray:
+        return self._encode([text])[0]
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=MAX_LENGTH, return_tensors="np")
+        return self.session.run(None, _feed(self.session, encoded))[0]
+
+    def check_similarity(self, embedding1, embedding2):
+        a = np.atleast_2d(np.asarray(embedding1, dtype=np.float32))
+        b = np.atleast_2d(np.asarray(embedding2, dtype=np.float32))
+        a = a / np.linalg.norm(a, axis=1, keepdims=True)
+        b = b / np.linalg.norm(b, axis=1, keepdims=True)
+        return a @ b.T
+
+
+class OnnxRankModel(RankModel):
+    """接口与 RankModel 一致，rank() 沿用父类"""
+
+    def __init__(self):
+        from transformers import AutoTokenizer  # type: ignore
+
+        self.model_path = config.RERANK_MODEL_PATH
+        self.onnx_path = ensure_onnx_model(self.model_path, "rerank")
+        self.model_id = os.path.basename(os.path.normpath(self.model_path)) + _backend_suffix(self.onnx_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        self.threads = ThreadBudget.for_model("rank")
+        self.session = _create_session(self.onnx_path, self.threads)
+        logger.info(self.threads.describe("onnx"))
+
+    def rank_pairs(self, pairs: List[Tuple[str, Union[str, List[int]]]]) -> np.ndarray:
+        if not pairs:
+            return np.empty((0,), dtype=np.float32)
+        if all(isinstance(a, str) for _, a in pairs):
+            encoded = self.tokenizer([list(p) for p in pairs], padding=True, truncation=True,
+                                     max_length=MAX_LENGTH, return_tensors="np")
+        else:
+            encoded = self._pretokenized_inputs(pairs)
+        scores = self.session.run(None, _feed(self.session, encoded))[0]
+        return scores.reshape(-1).astype(np.float32, copy=False)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="导出 ONNX 推理模型")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--no-quantize", action="store_true", help="只导出 fp32 模型")
+    args = parser.parse_args()
+
+    for path, kind in ((config.EMBEDDING_MODEL_PATH, "embedding"), (config.RERANK_MODEL_PATH, "rerank")):
+        print(ensure_onnx_model(path, kind, quantize=not args.no_quantize))
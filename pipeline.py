@@ -0,0 +1,310 @@
+import queue
+import threading
+import time
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List, Tuple, Optional, Iterator, Callable, Dict, Set
+
+import config
+from dataES import ChunkInfo, RAGStore
+from embedding_cache import text_hash
+from model import Embedding
+from utills import iter_chunks_with_pages, NormalizeStats, encode_for_rerank, RERANK_TOKENIZER_ID
+
+"""
+流式入库流水线：页 → chunk → 向量批次 → ES bulk
+
+    [解析线程] --chunk 批次--> [向量化线程] --ChunkInfo 批次--> [调用线程：bulk 写入]
+
+三个阶段通过有界队列衔接，上游过快时自动阻塞，
+因此任意时刻内存中最多只有 (queue_size + 2) 个批次，与文档大小无关；
+解析、向量化、写 ES 三者并行，总耗时约等于最慢阶段而不是三者之和。
+
+chunk_id 由 (doc_id, 内容哈希, 同内容出现序号) 决定，与位置无关。
+入库前先读取该文档已有的 chunk，解析阶段逐个比对：
+- 已存在且位置未变：跳过
+- 已存在但 chunk_order/page_number 变化：只做局部更新，不重新向量化
+- 不存在：向量化并写入
+- 本次未出现的旧 chunk：结束后删除
+因此文档原地更新（以及中断后恢复）的开销与改动量成正比。
+"""
+
+logger = logging.getLogger(__name__)
+
+_END = object()  # 队列结束标记
+
+
+class IngestCancelled(Exception):
+    """任务在入库过程中被取消；created_chunk_ids 为本次新写入的 chunk（不含入库前已存在的）"""
+
+    def __init__(self, message: str = "", created_chunk_ids: Optional[List[str]] = None):
+        super().__init__(message)
+        self.created_chunk_ids = created_chunk_ids or []
+
+
+def make_chunk_id(doc_id: str, content_hash: str, occurrence: int) -> str:
+    """确定性 chunk id：同一文档内相同内容按出现顺序编号"""
+    return f"{doc_id}_{content_hash[:16]}_{occurrence}"
+
+
+@dataclass
+class IngestResult:
+    pages: int = 0
+    chunks: int = 0          # 本次实际向量化并写入的 chunk 数
+    total_chunks: int = 0    # 新版本文档的 chunk 总数
+    unchanged: int = 0
+    moved: int = 0
+    deleted: int = 0
+    abstract: str = ""
+    full_content: str = ""
+    seconds: float = 0.0
+    normalize: NormalizeStats = field(default_factory=NormalizeStats)  # 版面空白/页眉页脚清理统计
+    slow_pages: List[Dict] = field(default_factory=list)  # 提取超时被降级或跳过的页面
+
+
+@dataclass
+class _Pending:
+    """单个待向量化的 chunk"""
+    chunk_id: str
+    content_hash: str
+    chunk_order: int
+    page_number: int
+    content: str
+
+
+class IngestPipeline:
+    def __init__(
+        self,
+        embedder: Embedding,
+        db: RAGStore,
+        embed_batch_size: int = config.EMBED_BATCH_SIZE,
+        bulk_size: int = config.ES_BULK_SIZE,
+        queue_size: int = config.PIPELINE_QUEUE_SIZE,
+    ):
+        self.embedder = embedder
+        self.db = db
+        self.embed_batch_size = embed_batch_size
+        self.bulk_size = bulk_size
+        self.queue_size = queue_size
+
+    # -------------------------
+    # 队列工具：带停止信号的 put/get，任一阶段失败时其余阶段能及时退出
+    # -------------------------
+
+    @staticmethod
+    def _put(q: queue.Queue, item, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    @staticmethod
+    def _check_stop(should_stop: Optional[Callable[[], bool]], doc_id: str):
+        if should_stop is not None and should_stop():
+            raise IngestCancelled(f"文档 {doc_id} 入库已取消")
+
+    @classmethod
+    def _iter_queue(cls, q: queue.Queue, stop: threading.Event, should_stop: Optional[Callable[[], bool]] = None,
+                    doc_id: str = "") -> Iterator:
+        """等待期间也检查 should_stop：文档未变时上游可能长时间不产出批次"""
+        while not stop.is_set():
+            cls._check_stop(should_stop, doc_id)
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            yield item
+
+    # -------------------------
+    # 各阶段
+    # -------------------------
+
+    def _extract_stage(self, pdf_path: str, doc_id: str, existing: Dict[str, Tuple[Optional[int], Optional[int]]],
+                       seen: Set[str], moved: List[Dict], out_q: queue.Queue, stop: threading.Event,
+                       result: IngestResult, errors: list, should_stop: Optional[Callable[[], bool]] = None):
+        try:
+            batch: List[_Pending] = []
+            occurrences: Dict[str, int] = {}
+            last_page = None
+            content_size = 0
+            for chunk_order, (chunk, page_number) in enumerate(iter_chunks_with_pages(
+                    pdf_path, stats=result.normalize, slow_pages=result.slow_pages)):
+                if stop.is_set():
+                    return
+                # 重新入库且内容未变时不会产出待向量化的批次，取消只能在这里及时发现
+                self._check_stop(should_stop, doc_id)
+                if page_number != last_page:
+                    result.pages += 1
+                    last_page = page_number
+                # 摘要与全文只保留前缀，避免把整本文档拼接进内存
+                if len(result.abstract) < 500:
+                    result.abstract += chunk[:500 - len(result.abstract)]
+                if content_size < config.DOC_FULL_CONTENT_MAX_CHARS:
+                    piece = chunk[:config.DOC_FULL_CONTENT_MAX_CHARS - content_size]
+                    result.full_content += ("\n\n" if result.full_content else "") + piece
+                    content_size += len(piece)
+
+                content_hash = text_hash(chunk)
+                occurrence = occurrences.get(content_hash, 0)
+                occurrences[content_hash] = occurrence + 1
+                chunk_id = make_chunk_id(doc_id, content_hash, occurrence)
+                result.total_chunks += 1
+
+                if chunk_id in existing:
+                    seen.add(chunk_id)
+                    if existing[chunk_id] != (chunk_order, page_number):
+                        moved.append({"chunk_id": chunk_id, "chunk_order": chunk_order, "page_number": page_number})
+                    else:
+                        result.unchanged += 1
+                    continue
+
+                batch.append(_Pending(chunk_id, content_hash, chunk_order, page_number, chunk))
+                if len(batch) >= self.embed_batch_size:
+                    self._put(out_q, batch, stop)
+                    batch = []
+            if batch:
+                self._put(out_q, batch, stop)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            self._put(out_q, _END, stop)
+
+    def _embed_stage(self, in_q: queue.Queue, out_q: queue.Queue, stop: threading.Event,
+                     doc_id: str, workspace_id: str, user_username: str, errors: list,
+                     should_stop: Optional[Callable[[], bool]] = None):
+        try:
+            for batch in self._iter_queue(in_q, stop, should_stop, doc_id):
+                contents = [p.content for p in batch]
+                vectors = self.embedder.embed_batch(contents, batch_size=self.embed_batch_size)
+                token_ids = encode_for_rerank(contents) if config.RERANK_PRETOKENIZE else [None] * len(batch)
+                tokenizer_id = RERANK_TOKENIZER_ID if config.RERANK_PRETOKENIZE else None
+                now = datetime.utcnow()
+                infos = []
+                for p, vector, ids in zip(batch, vectors, token_ids):
+                    infos.append(ChunkInfo(
+                        chunk_id=p.chunk_id,
+                        doc_id=doc_id,
+                        workspace_id=workspace_id,
+                        user_username=user_username,
+                        chunk_content=p.content,
+                        page_number=p.page_number,
+                        content_hash=p.content_hash,
+                        rerank_token_ids=ids,
+                        rerank_tokenizer=tokenizer_id,
+                        created_at=now,
+                        embedding_vector=vector.tolist(),
+                        chunk_order=p.chunk_order,
+                    ))
+                self._put(out_q, infos, stop)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            self._put(out_q, _END, stop)
+
+    def _apply_diff(self, existing: Dict, seen: Set[str], moved: List[Dict], result: IngestResult):
+        """写入位置变化，删除新版本中已不存在的旧 chunk"""
+        for start in range(0, len(moved), self.bulk_size):
+            self.db.bulk_update_chunks(moved[start:start + self.bulk_size])
+        result.moved = len(moved)
+
+        vanished = [cid for cid in existing if cid not in seen]
+        for start in range(0, len(vanished), self.bulk_size):
+            self.db.bulk_delete_chunks(vanished[start:start + self.bulk_size])
+        result.deleted = len(vanished)
+
+    # -------------------------
+    # 入口
+    # -------------------------
+
+    def run(
+        self,
+        pdf_path: str,
+        doc_id: str,
+        workspace_id: str,
+        user_username: str,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> IngestResult:
+        """
+        on_progress(pages, chunks): 每次 bulk 写入后回调，参数为已处理页数与已写入 chunk 数
+        should_stop(): 返回 True 时中止流水线并抛出 IngestCancelled
+        """
+        start = time.perf_counter()
+        result = IngestResult()
+        errors: list = []
+        stop = threading.Event()
+
+        # 已有 chunk 只取 id 与位置，内存占用与正文/向量无关
+        existing = {cid: (order, page) for cid, order, page in self.db.iter_chunk_positions(doc_id)}
+        seen: Set[str] = set()
+        moved: List[Dict] = []
+        chunk_q: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        info_q: queue.Queue = queue.Queue(maxsize=self.queue_size)
+
+        workers = [
+            threading.Thread(target=self._extract_stage, name="ingest-extract", daemon=True,
+                             args=(pdf_path, doc_id, existing, seen, moved, chunk_q, stop, result, errors,
+                                   should_stop)),
+            threading.Thread(target=self._embed_stage, name="ingest-embed", daemon=True,
+                             args=(chunk_q, info_q, stop, doc_id, workspace_id, user_username, errors,
+                                   should_stop)),
+        ]
+        for t in workers:
+            t.start()
+
+        # 写入阶段在调用线程执行：攒够 bulk_size 条就 flush 一次
+        buffer: List[ChunkInfo] = []
+        created: List[str] = []  # 本次新写入的 chunk_id，取消时供调用方只清理这部分
+        try:
+            for infos in self._iter_queue(info_q, stop, should_stop, doc_id):
+                buffer.extend(infos)
+                if len(buffer) >= self.bulk_size:
+                    self.db.bulk_create_chunks(buffer)
+                    created.extend(c.chunk_id for c in buffer)
+                    result.chunks += len(buffer)
+                    buffer = []
+                    if on_progress is not None:
+                        on_progress(result.pages, result.chunks)
+            if buffer and not errors:
+                self.db.bulk_create_chunks(buffer)
+                created.extend(c.chunk_id for c in buffer)
+                result.chunks += len(buffer)
+            if not errors:
+                self._check_stop(should_stop, doc_id)
+                self._apply_diff(existing, seen, moved, result)
+            if on_progress is not None and not errors:
+                on_progress(result.pages, result.chunks)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            for t in workers:
+                t.join()
+
+        if errors:
+            if isinstance(errors[0], IngestCancelled):
+                errors[0].created_chunk_ids = created
+            raise errors[0]
+
+        result.seconds = time.perf_counter() - start
+        logger.info(f"📄 文档 {doc_id} 入库完成：{result.pages} 页，共 {result.total_chunks} 个 chunk，"
+                    f"新增 {result.chunks}，移动 {result.moved}，删除 {result.deleted}，未变 {result.unchanged}，"
+                    f"耗时 {result.seconds:.2f}s")
+        norm = result.normalize.as_dict()
+        # raw_chunks 仅在 NORMALIZE_COUNT_RAW_CHUNKS 开启时统计，否则 chunk_reduction 为 None
+        chunk_note = (f"，chunk {norm['raw_chunks']} → {norm['clean_chunks']}（-{norm['chunk_reduction']:.1%}）"
+                      if norm['chunk_reduction'] is not None else "")
+        logger.info(f"🧹 文档 {doc_id} 文本规范化：字符 {norm['raw_chars']} → {norm['clean_chars']}"
+                    f"（-{norm['char_reduction']:.1%}）{chunk_note}，删除页眉页脚 {norm['removed_lines']} 行")
+        if result.slow_pages:
+            logger.warning(f"⏱️ 文档 {doc_id} 有 {len(result.slow_pages)} 页提取超时：{result.slow_pages}")
+        if getattr(self.embedder, "cache", None) is not None:
+            logger.info(f"🗄️ 向量缓存统计：{self.embedder.cache.stats()}")
+        return result
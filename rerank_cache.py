@@ -0,0 +1,172 @@
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+import config
+from dataES import ChunkChange
+from embedding_cache import normalize_text, text_hash
+from utills import RERANK_TOKENIZER_ID
+
+"""
+rerank 分数的进程内 LRU 缓存
+
+key = (rerank 模型 id, 规范化后的问题, chunk_id, chunk 内容哈希)，value 为交叉编码器打分。
+同一工作区内重复提问（或仅空白、标点、大小写不同）时，命中的 (问题, chunk) 对不再跑 rerank 模型，
+只有未命中的对才批量送入模型。
+
+key 中包含内容哈希，chunk 被改写后旧分数天然不会命中；
+ES 中 chunk 删除/重新入库时通过 SmallRAGDB 的变更回调主动清理，及时释放容量。
+"""
+
+_TRAILING_PUNCT = "?？。.!！~～ "
+
+_Key = Tuple[str, str, str, str]
+
+
+def normalize_question(question: str) -> str:
+    """空白/全半角统一、忽略大小写与句末标点，使轻微改写的同一问题命中缓存"""
+    return normalize_text(question).casefold().rstrip(_TRAILING_PUNCT)
+
+
+class RerankCache:
+    def __init__(self, max_entries: int = config.RERANK_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self._entries: "OrderedDict[_Key, float]" = OrderedDict()
+        self._by_chunk: Dict[str, Set[_Key]] = {}
+        self._lock = threading.Lock()
+
+    # -------------------------
+    # 读写
+    # -------------------------
+
+    def get_many(self, model_id: str, question: str, chunks: List[Tuple[str, str]]) -> List[Optional[float]]:
+        """chunks: [(chunk_id, content_hash)]，返回与之对齐的分数，未命中为 None"""
+        q = normalize_question(question)
+        result: List[Optional[float]] = []
+        with self._lock:
+            for chunk_id, content_hash in chunks:
+                key = (model_id, q, chunk_id, content_hash)
+                score = self._entries.get(key)
+                if score is not None:
+                    self._entries.move_to_end(key)
+                result.append(score)
+            hit = sum(1 for s in result if s is not None)
+            self.hits += hit
+            self.misses += len(result) - hit
+        return result
+
+    def put_many(self, model_id: str, question: str, chunks: List[Tuple[str, str]], scores):
+        q = normalize_question(question)
+        with self._lock:
+            for (chunk_id, content_hash), score in zip(chunks, scores):
+                key = (model_id, q, chunk_id, content_hash)
+                self._entries[key] = float(score)
+                self._entries.move_to_end(key)
+                self._by_chunk.setdefault(chunk_id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                key, _ = self._entries.popitem(last=False)
+                self._unindex(key)
+
+    def _unindex(self, key: _Key):
+        keys = self._by_chunk.get(key[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_chunk[key[2]]
+
+    # -------------------------
+    # 失效
+    # -------------------------
+
+    def invalidate_chunks(self, chunk_ids: List[str]):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                for key in self._by_chunk.pop(chunk_id, ()):
+                    self._entries.pop(key, None)
+                    self.invalidated += 1
+
+    def invalidate_doc(self, doc_id: str):
+        """chunk_id 以 "{doc_id}_" 开头（见 pipeline.make_chunk_id）"""
+        prefix = f"{doc_id}_"
+        with self._lock:
+            chunk_ids = [cid for cid in self._by_chunk if cid.startswith(prefix)]
+        self.invalidate_chunks(chunk_ids)
+
+    def on_chunk_change(self, change: ChunkChange):
+        """注册到 SmallRAGDB.add_chunk_listener"""
+        if change.chunk_ids:
+            self.invalidate_chunks(change.chunk_ids)
+        elif change.doc_id is not None:
+            self.invalidate_doc(change.doc_id)
+
+    # -------------------------
+    # 统计
+    # -------------------------
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "invalidated": self.invalidated,
+            }
+
+
+def rerank_inputs(hits: List[Dict]) -> List[Union[str, List[int]]]:
+    """
+    送入 rerank 模型的候选：全部 chunk 都带有当前 rerank 分词器生成的 token id 时直接使用 id（免去分词），
+    否则（早期入库或更换过 rerank 模型）退回原文
+    """
+    if hits and all(hit.get("rerank_token_ids") and hit.get("rerank_tokenizer") == RERANK_TOKENIZER_ID
+                    for hit in hits):
+        return [hit["rerank_token_ids"] for hit in hits]
+    return [hit["chunk_content"] for hit in hits]
+
+
+TokenIdFetcher = Callable[[List[str]], Awaitable[Dict[str, List[int]]]]
+
+
+async def _with_token_ids(hits: List[Dict], fetch_token_ids: Optional[TokenIdFetcher]) -> List[Dict]:
+    """
+    检索结果默认不含 rerank_token_ids：只有全部候选都由当前 rerank 分词器入库时才按 id 取回
+    （否则 rerank_inputs 反正退回原文），合并进 hit 的副本
+    """
+    if fetch_token_ids is None or not hits or not all(
+            hit.get("rerank_tokenizer") == RERANK_TOKENIZER_ID for hit in hits):
+        return hits
+    token_ids = await fetch_token_ids([hit["chunk_id"] for hit in hits])
+    return [{**hit, "rerank_token_ids": token_ids[hit["chunk_id"]]} if hit["chunk_id"] in token_ids else hit
+            for hit in hits]
+
+
+async def arank_with_cache(inference, cache: Optional[RerankCache], question: str, hits: List[Dict],
+                           fetch_token_ids: Optional[TokenIdFetcher] = None) -> np.ndarray:
+    """
+    对检索命中的 chunk 打分：先查缓存，只把未命中的 (问题, chunk) 对交给 inference.arank。
+    hits 为 ES 返回的 chunk _source；早期入库的 chunk 没有 content_hash 时按正文现算。
+    fetch_token_ids: 按 chunk_id 取回 rerank_token_ids（如 aesdb.rerank_token_ids），只对未命中缓存的候选调用
+    """
+    if cache is None or not hits:
+        return await inference.arank(question, rerank_inputs(await _with_token_ids(hits, fetch_token_ids)))
+
+    model_id = inference.rank_model_id
+    keys = [(hit["chunk_id"], hit.get("content_hash") or text_hash(hit["chunk_content"])) for hit in hits]
+    cached = cache.get_many(model_id, question, keys)
+    miss_idx = [i for i, score in enumerate(cached) if score is None]
+
+    scores = np.array([0.0 if s is None else s for s in cached], dtype=np.float32)
+    if miss_idx:
+        misses = await _with_token_ids([hits[i] for i in miss_idx], fetch_token_ids)
+        fresh = await inference.arank(question, rerank_inputs(misses))
+        scores[miss_idx] = fresh
+        cache.put_many(model_id, question, [keys[i] for i in miss_idx], fresh)
+    return scores
@@ -0,0 +1,131 @@
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import config
+
+"""
+检索结果融合与 rerank 级联策略
+
+RRF 融合 BM25 与向量检索的命中后，并非每次都值得跑交叉编码器：
+- 候选太少：rerank 只是对两三条结果重新排序，对最终上下文几乎没有影响
+- 两路检索的前 k 名完全一致：融合结果已经足够可信
+- 向量相似度明显过低的候选：先剪掉，既减少 rerank 计算量，也避免无关内容进入上下文
+RerankCascade 依次应用这些规则，决定是否 rerank 以及送入 rerank 的候选，并统计各分支的触发次数。
+"""
+
+
+@dataclass
+class Candidate:
+    chunk_id: str
+    hit: Dict                          # ES 返回的 chunk 字段
+    rrf_score: float
+    bm25_rank: Optional[int] = None    # 在 BM25 结果中的名次（从 1 开始），未命中为 None
+    bm25_score: Optional[float] = None
+    knn_rank: Optional[int] = None
+    knn_score: Optional[float] = None  # ES cosine 相似度得分 (1 + cos) / 2
+
+
+def rrf_fuse(bm25_hits: List[Dict], knn_hits: List[Dict], k: int = 60, top_n: Optional[int] = None) -> List[Candidate]:
+    """
+    按 chunk_id 做 Reciprocal Rank Fusion：score = Σ 1 / (k + rank)，按分数降序返回。
+    hits 中的 "_score" 为对应检索的原始得分（若有）。
+    """
+    fused: Dict[str, Candidate] = {}
+    for field, hits in (("bm25", bm25_hits), ("knn", knn_hits)):
+        for rank, hit in enumerate(hits, start=1):
+            cid = hit["chunk_id"]
+            cand = fused.get(cid)
+            if cand is None:
+                cand = fused[cid] = Candidate(chunk_id=cid, hit=hit, rrf_score=0.0)
+            cand.rrf_score += 1.0 / (k + rank)
+            setattr(cand, f"{field}_rank", rank)
+            setattr(cand, f"{field}_score", hit.get("_score"))
+    ranked = sorted(fused.values(), key=lambda c: c.rrf_score, reverse=True)
+    return ranked[:top_n] if top_n else ranked
+
+
+@dataclass
+class CascadeDecision:
+    candidates: List[Candidate]  # 剪枝后的候选（RRF 顺序）
+    rerank: bool                 # 是否需要交叉编码器重排
+    branch: str                  # 命中的规则，对应 stats() 中的计数
+
+
+class RerankCascade:
+    BRANCHES = ("no_candidates", "few_candidates", "agreement", "all_pruned", "reranked")
+
+    def __init__(
+        self,
+        enabled: bool = config.CASCADE_ENABLED,
+        min_candidates: int = config.CASCADE_MIN_CANDIDATES,
+        agreement_top_k: int = config.CASCADE_AGREEMENT_TOP_K,
+        min_vector_score: float = config.CASCADE_MIN_VECTOR_SCORE,
+        max_rerank: int = config.CASCADE_MAX_RERANK,
+    ):
+        """
+        min_candidates: 剪枝后候选数少于该值时不 rerank
+        agreement_top_k: BM25 与向量检索前 k 名（含顺序）完全一致时不 rerank，0 关闭该规则
+        min_vector_score: 向量得分低于该值的候选在 rerank 前剪掉（只作用于向量检索命中的候选），0 关闭
+        max_rerank: 送入 rerank 的候选上限
+        """
+        self.enabled = enabled
+        self.min_candidates = min_candidates
+        self.agreement_top_k = agreement_top_k
+        self.min_vector_score = min_vector_score
+        self.max_rerank = max_rerank
+        self._lock = threading.Lock()
+        self._counts = {b: 0 for b in self.BRANCHES}
+        self._pruned = 0
+        self._reranked_candidates = 0
+
+    def _agree(self, candidates: List[Candidate]) -> bool:
+        k = self.agreement_top_k
+        if k <= 0:
+            return False
+        bm25 = sorted((c for c in candidates if c.bm25_rank is not None), key=lambda c: c.bm25_rank)[:k]
+        knn = sorted((c for c in candidates if c.knn_rank is not None), key=lambda c: c.knn_rank)[:k]
+        return len(bm25) == k and [c.chunk_id for c in bm25] == [c.chunk_id for c in knn]
+
+    def decide(self, candidates: List[Candidate]) -> CascadeDecision:
+        candidates = candidates[:self.max_rerank]
+        if not self.enabled:
+            decision = CascadeDecision(candidates, bool(candidates), "reranked" if candidates else "no_candidates")
+            self._record(decision, 0)
+            return decision
+
+        if not candidates:
+            decision = CascadeDecision([], False, "no_candidates")
+        elif self._agree(candidates):
+            decision = CascadeDecision(candidates, False, "agreement")
+        else:
+            kept = candidates
+            if self.min_vector_score > 0:
+                kept = [c for c in candidates if c.knn_score is None or c.knn_score >= self.min_vector_score]
+            if not kept:
+                decision = CascadeDecision([], False, "all_pruned")
+            elif len(kept) < self.min_candidates:
+                decision = CascadeDecision(kept, False, "few_candidates")
+            else:
+                decision = CascadeDecision(kept, True, "reranked")
+        self._record(decision, len(candidates) - len(decision.candidates))
+        return decision
+
+    def _record(self, decision: CascadeDecision, pruned: int):
+        with self._lock:
+            self._counts[decision.branch] += 1
+            self._pruned += pruned
+            if decision.rerank:
+                self._reranked_candidates += len(decision.candidates)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = sum(self._counts.values())
+            reranked = self._counts["reranked"]
+            return {
+                "queries": total,
+                "branches": dict(self._counts),
+                "rerank_rate": reranked / total if total else 0.0,
+                "pruned_candidates": self._pruned,
+                "avg_reranked_candidates": self._reranked_candidates / reranked if reranked else 0.0,
+            }
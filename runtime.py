@@ -0,0 +1,361 @@
+import asyncio
+import functools
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Generic, Optional, TypeVar
+
+import config
+
+"""
+后端运行时依赖的延迟初始化
+
+ChatCompletion / Embedding / RankModel / SmallRAGDB / InferenceScheduler 不再在 import backend 时构造，
+而是首次调用 get_xxx() 时创建，多线程并发首次访问时只会构造一次。
+- 服务进程秒级启动，ES 暂不可用也不会导致启动失败（下次访问时重试）
+- 可选的后台预热：启动后在后台线程依次初始化各依赖，并对模型跑一次空前向
+- status() 汇总各依赖的就绪情况，供 /readyz 使用
+- INFERENCE_MODE=remote 时 get_inference() 返回共享推理服务的客户端，本进程不加载任何模型
+- async 接口通过 get_aesdb()（AsyncElasticsearch）检索，其余阻塞调用经 run_blocking() 交给有界线程池；
+  async 接口中用 aget_xxx() 获取单例，首次初始化在线程池中进行
+- STORAGE_BACKEND=local 时 get_esdb() 返回嵌入式存储 LocalStore，无需 ES
+- ES 后端下同步/异步客户端共享同一个热点工作区向量缓存（vector_cache.py），由 chunk 变更回调失效
+"""
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Lazy(Generic[T]):
+    """线程安全的延迟单例；构造失败时不缓存异常，下次访问重新尝试"""
+
+    def __init__(self, name: str, factory: Callable[[], T]):
+        self.name = name
+        self._factory = factory
+        self._instance: Optional[T] = None
+        self._lock = threading.Lock()
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+
+    def get(self) -> T:
+        instance = self._instance
+        if instance is not None:
+            return instance
+        with self._lock:
+            if self._instance is None:
+                start = time.perf_counter()
+                try:
+                    self._instance = self._factory()
+                except Exception as e:
+                    self.error = str(e)
+                    logger.error(f"❌ 初始化 {self.name} 失败: {e}")
+                    raise
+                self.error = None
+                self.load_seconds = time.perf_counter() - start
+                logger.info(f"✅ {self.name} 初始化完成，耗时 {self.load_seconds:.1f}s")
+            return self._instance
+
+    def peek(self) -> Optional[T]:
+        """已初始化则返回实例，否则返回 None（不触发初始化）"""
+        return self._instance
+
+    @property
+    def loaded(self) -> bool:
+        return self._instance is not None
+
+
+def _create_llm():
+    from model import ChatCompletion
+    return ChatCompletion()
+
+
+def _create_embed():
+    from model import create_embedding
+    return create_embedding()
+
+
+def _create_ranker():
+    from model import create_rank_model
+    return create_rank_model()
+
+
+def _create_inference():
+    if config.INFERENCE_MODE == "remote":
+        # 模型由共享推理服务持有，本进程只保留客户端连接池
+        from inference_server import InferenceClient
+        client = InferenceClient(config.INFERENCE_SOCKET)
+        client.info()  # 服务不可达时初始化失败，下次访问重试
+        return client
+    from scheduler import InferenceScheduler
+    # 在线查询的 embed / rerank 统一经调度器跨请求合批
+    return InferenceScheduler(get_embed(), get_ranker())
+
+
+def _create_rerank_cache():
+    from rerank_cache import RerankCache
+    return RerankCache()
+
+
+def _create_vector_cache():
+    from vector_cache import WorkspaceVectorCache
+    # 后台加载线程在首次未命中时才调用 loader，此时 SmallRAGDB 已构造完成
+    return WorkspaceVectorCache(loader=lambda ws, max_chunks: get_esdb().load_workspace_vectors(ws, max_chunks),
+                                probe=lambda ws: get_esdb().workspace_signature(ws))
+
+
+def _create_aesdb():
+    if config.STORAGE_BACKEND == "local":
+        # 本地存储没有异步客户端，检索经有界执行器调用同步实现
+        from local_store import AsyncLocalStore
+        return AsyncLocalStore(get_esdb(), blocking)
+    # 索引由同步客户端初始化；这里只建立异步连接池
+    from dataES import AsyncSmallRAGDB
+    aesdb = AsyncSmallRAGDB(es_url=config.ES_URL, executor=blocking)
+    aesdb.layout_source = get_esdb()  # chunk 索引布局跟随同步客户端（别名切换后自动重新检测）
+    aesdb.vector_cache = get_vector_cache()
+    return aesdb
+
+
+def _create_esdb():
+    if config.STORAGE_BACKEND == "local":
+        from local_store import LocalStore
+        esdb = LocalStore(config.LOCAL_STORE_DIR)
+    else:
+        from dataES import SmallRAGDB
+        esdb = SmallRAGDB(es_url=config.ES_URL)
+        if not esdb.init_indices(overwrite=False):
+            raise RuntimeError(f"Elasticsearch 不可用或索引初始化失败: {config.ES_URL}")
+        esdb.vector_cache = get_vector_cache()
+        if esdb.vector_cache is not None:
+            esdb.add_chunk_listener(esdb.vector_cache.on_chunk_change)
+    # chunk 删除/重新入库时清理进程内缓存
+    if config.RERANK_CACHE_ENABLED:
+        esdb.add_chunk_listener(get_rerank_cache().on_chunk_change)
+    return esdb
+
+
+llm = Lazy("ChatCompletion", _create_llm)
+embed = Lazy("Embedding", _create_embed)
+ranker = Lazy("RankModel", _create_ranker)
+inference = Lazy("InferenceScheduler", _create_inference)
+esdb = Lazy("SmallRAGDB", _create_esdb)
+aesdb = Lazy("AsyncSmallRAGDB", _create_aesdb)
+rerank_cache = Lazy("RerankCache", _create_rerank_cache)
+vector_cache = Lazy("WorkspaceVectorCache", _create_vector_cache)
+
+
+def get_llm():
+    return llm.get()
+
+
+def get_embed():
+    return embed.get()
+
+
+def get_ranker():
+    return ranker.get()
+
+
+def get_inference():
+    return inference.get()
+
+
+def get_esdb():
+    return esdb.get()
+
+
+def get_aesdb():
+    return aesdb.get()
+
+
+def get_rerank_cache():
+    """未启用时返回 None"""
+    return rerank_cache.get() if config.RERANK_CACHE_ENABLED else None
+
+
+def get_vector_cache():
+    """未启用或使用本地存储时返回 None"""
+    if not config.VECTOR_CACHE_ENABLED or config.STORAGE_BACKEND == "local":
+        return None
+    return vector_cache.get()
+
+
+# -------------------------
+# 阻塞调用的有界执行器
+# -------------------------
+
+class BlockingExecutor:
+    """
+    在线程池中执行阻塞调用（同步 OpenAI 客户端、同步 ES 客户端、首次加载模型等），不占用事件循环。
+    max_workers 限制同时运行的线程数；max_pending 限制排队的调用数，超出后调用方在协程中等待，
+    避免突发流量在线程池队列里无限堆积。
+    """
+
+    def __init__(self, max_workers: int = config.BLOCKING_EXECUTOR_WORKERS,
+                 max_pending: int = config.BLOCKING_EXECUTOR_QUEUE):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="blocking")
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        if self._slots is None:  # 信号量需在事件循环中创建
+            self._slots = asyncio.Semaphore(self.max_workers + self.max_pending)
+        async with self._slots:
+            with self._lock:
+                self.in_flight += 1
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                    self.completed += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+blocking = BlockingExecutor()
+
+
+async def run_blocking(fn: Callable[..., T], *args, **kwargs) -> T:
+    return await blocking.run(fn, *args, **kwargs)
+
+
+# -------------------------
+# async 接口中获取延迟单例：未初始化时在执行器中构造（加载模型、连接 ES 都是阻塞调用），不占用事件循环
+# -------------------------
+
+async def aget(lazy: Lazy[T]) -> T:
+    instance = lazy.peek()
+    return instance if instance is not None else await run_blocking(lazy.get)
+
+
+async def aget_inference():
+    return await aget(inference)
+
+
+async def aget_aesdb():
+    return await aget(aesdb)
+
+
+async def aget_rerank_cache():
+    """未启用时返回 None"""
+    return await aget(rerank_cache) if config.RERANK_CACHE_ENABLED else None
+
+
+async def aclose():
+    """关闭异步 ES 连接池与阻塞执行器（服务 shutdown 时调用）"""
+    instance = aesdb.peek()
+    if instance is not None:
+        await instance.close()
+    blocking.shutdown()
+
+
+# -------------------------
+# 预热与就绪检查
+# -------------------------
+
+_warmed: Dict[str, bool] = {"embed": False, "ranker": False}
+
+
+def _remote() -> bool:
+    return config.INFERENCE_MODE == "remote"
+
+
+def warmup():
+    """依次初始化各依赖并跑一次空前向，使首个真实请求不承担模型加载与首次推理的开销"""
+    steps = [("esdb", lambda: get_esdb())]
+    if not _remote():  # 远程模式下模型预热由推理服务自己负责
+        steps += [
+            ("embed", lambda: get_embed().embed("预热")),
+            ("ranker", lambda: get_ranker().rank_pairs([("预热", "预热")])),
+        ]
+    steps += [("inference", lambda: get_inference()), ("llm", lambda: get_llm())]
+    start = time.perf_counter()
+    for name, step in steps:
+        try:
+            step()
+            if name in _warmed:
+                _warmed[name] = True
+        except Exception as e:
+            logger.warning(f"⚠️ 预热 {name} 失败，将在首次请求时重试: {e}")
+    logger.info(f"🔥 预热结束，耗时 {time.perf_counter() - start:.1f}s")
+
+
+def start_warmup() -> threading.Thread:
+    t = threading.Thread(target=warmup, name="runtime-warmup", daemon=True)
+    t.start()
+    return t
+
+
+def _storage_name() -> str:
+    return "local_store" if config.STORAGE_BACKEND == "local" else "elasticsearch"
+
+
+def _es_reachable() -> bool:
+    instance = esdb.peek()
+    if instance is None:
+        try:
+            instance = get_esdb()
+        except Exception:
+            return False
+    return instance.ping()
+
+
+def _inference_reachable() -> bool:
+    instance = inference.peek()
+    if instance is None:
+        try:
+            instance = get_inference()
+        except Exception:
+            return False
+    return instance.ping()
+
+
+def status() -> Dict[str, Dict]:
+    """
+    各依赖的就绪情况；存储后端每次实时 ping，未初始化时顺带尝试初始化。
+    远程推理模式下不列出本地模型，改为检查推理服务是否可达。
+    """
+    result = {}
+    if _remote():
+        result["inference_server"] = {
+            "ready": _inference_reachable(),
+            "socket": config.INFERENCE_SOCKET,
+            "error": inference.error,
+        }
+    local = (("llm", llm),) if _remote() else (("embed", embed), ("ranker", ranker), ("inference", inference), ("llm", llm))
+    for name, lazy in local:
+        result[name] = {
+            "ready": lazy.loaded,
+            "warmed": _warmed.get(name, lazy.loaded),
+            "load_seconds": lazy.load_seconds,
+            "error": lazy.error,
+        }
+    result[_storage_name()] = {
+        "ready": _es_reachable(),
+        "load_seconds": esdb.load_seconds,
+        "error": esdb.error,
+    }
+    return result
+
+
+def required_dependencies():
+    """/readyz 判定就绪所需的依赖"""
+    return ("inference_server", _storage_name()) if _remote() else ("embed", "ranker", _storage_name())
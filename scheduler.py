@@ -0,0 +1,212 @@
+import asyncio
+import threading
+import time
+import logging
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+import config
+
+"""
+跨请求的动态微批调度器
+
+多个 /chat 请求并发时，各自的单条 embed / rerank 调用先进入队列，
+后台线程在 max_wait_ms 内或凑满 max_batch 条后合并成一次前向推理，再通过 Future 把结果分发回各调用方。
+负载越高批次越满，吞吐随批处理效率提升，而不是随请求数线性劣化；
+低负载时单个请求最多额外等待 max_wait_ms。
+
+请求分两个优先级通道：
+- INTERACTIVE：在线查询，凑批时最多等待 max_wait_ms，永远优先执行
+- BULK：后台入库，只在没有交互请求时执行。交互通道持续空闲时每批条数从 max_bulk_batch 逐批翻倍，
+  直到 max_bulk_batch_idle（向量化为 EMBED_BATCH_SIZE），保持入库吞吐；一旦有交互请求排队即回落到
+  max_bulk_batch，之后交互请求最多等待一个小批的前向时间即可插队
+"""
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BULK = 1
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        name: str,
+        batch_fn: Callable[[List[Any]], Sequence[Any]],
+        max_batch: int,
+        max_wait_ms: float,
+        max_bulk_batch: Optional[int] = None,
+        bulk_batch_fn: Optional[Callable[[List[Any]], Sequence[Any]]] = None,
+        max_bulk_batch_idle: Optional[int] = None,
+    ):
+        """
+        batch_fn: 接收一批输入，返回等长的结果序列
+        bulk_batch_fn: BULK 通道的批处理函数，默认与 batch_fn 相同
+        max_bulk_batch_idle: 交互通道空闲时 BULK 批次可增长到的上限，默认不增长
+        """
+        self.name = name
+        self.batch_fn = batch_fn
+        self.bulk_batch_fn = bulk_batch_fn or batch_fn
+        self.max_batch = max_batch
+        self.max_bulk_batch = max_bulk_batch or max_batch
+        self.max_bulk_batch_idle = max(max_bulk_batch_idle or self.max_bulk_batch, self.max_bulk_batch)
+        self.bulk_limit = self.max_bulk_batch  # 当前 BULK 每批上限
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = {INTERACTIVE: 0, BULK: 0}
+        self.items = {INTERACTIVE: 0, BULK: 0}
+        self._lanes: Dict[int, Deque[Tuple[Any, Future]]] = {INTERACTIVE: deque(), BULK: deque()}
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name=f"batcher-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any, priority: int = INTERACTIVE) -> Future:
+        future: Future = Future()
+        with self._cond:
+            self._lanes[priority].append((item, future))
+            self._cond.notify()
+        return future
+
+    def submit_many(self, items: Sequence[Any], priority: int = INTERACTIVE) -> List[Future]:
+        futures = [Future() for _ in items]
+        with self._cond:
+            self._lanes[priority].extend(zip(items, futures))
+            self._cond.notify()
+        return futures
+
+    def _collect(self) -> Tuple[int, List[Tuple[Any, Future]]]:
+        with self._cond:
+            while not self._lanes[INTERACTIVE] and not self._lanes[BULK]:
+                self._cond.wait()
+            if self._lanes[INTERACTIVE]:
+                # 交互通道：等待 max_wait 让并发请求凑成一批；后台批次回落为小批，缩短之后的插队等待
+                self.bulk_limit = self.max_bulk_batch
+                lane, limit = INTERACTIVE, self.max_batch
+                deadline = time.monotonic() + self.max_wait
+                while len(self._lanes[lane]) < limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            else:
+                # 后台通道：不等待，取现有的最多 bulk_limit 条；交互通道持续空闲时下一批翻倍
+                lane, limit = BULK, self.bulk_limit
+                self.bulk_limit = min(self.bulk_limit * 2, self.max_bulk_batch_idle)
+            pending = self._lanes[lane]
+            return lane, [pending.popleft() for _ in range(min(limit, len(pending)))]
+
+    def _loop(self):
+        while True:
+            lane, batch = self._collect()
+            batch = [(item, fut) for item, fut in batch if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                batch_fn = self.bulk_batch_fn if lane == BULK else self.batch_fn
+                results = batch_fn([item for item, _ in batch])
+                for (_, fut), res in zip(batch, results):
+                    fut.set_result(res)
+            except Exception as e:
+                logger.error(f"❌ {self.name} 批处理失败: {e}")
+                for _, fut in batch:
+                    fut.set_exception(e)
+            self.batches[lane] += 1
+            self.items[lane] += len(batch)
+
+    def stats(self) -> dict:
+        result = {}
+        for lane, name in ((INTERACTIVE, "interactive"), (BULK, "bulk")):
+            batches, items = self.batches[lane], self.items[lane]
+            result[name] = {
+                "batches": batches,
+                "items": items,
+                "avg_batch": items / batches if batches else 0.0,
+                "queued": len(self._lanes[lane]),
+            }
+        result["bulk"]["limit"] = self.bulk_limit
+        return result
+
+
+class InferenceScheduler:
+    """Embedding 与 RankModel 前面的调度层，接口与二者保持一致，另提供 async 版本供事件循环中 await"""
+
+    def __init__(
+        self,
+        embedder,
+        ranker,
+        max_batch_embed: int = config.SCHED_MAX_BATCH_EMBED,
+        max_batch_rank: int = config.SCHED_MAX_BATCH_RANK,
+        max_wait_ms: float = config.SCHED_MAX_WAIT_MS,
+        max_bulk_batch: int = config.SCHED_MAX_BATCH_BULK,
+        max_bulk_batch_idle: int = config.EMBED_BATCH_SIZE,
+    ):
+        self.embedder = embedder
+        self.ranker = ranker
+        # 持久化向量缓存只服务入库（BULK）：重新入库的文档大量重复，在线查询则几乎不会命中
+        self._embed = MicroBatcher("embed", lambda texts: list(embedder.embed_batch(texts, use_cache=False)),
+                                   max_batch_embed, max_wait_ms, max_bulk_batch,
+                                   bulk_batch_fn=lambda texts: list(embedder.embed_batch(texts)),
+                                   max_bulk_batch_idle=max_bulk_batch_idle)
+        # rerank 以 (question, answer) 对为单位合批，不同问题的候选可以共用一次前向
+        self._rank = MicroBatcher("rank", ranker.rank_pairs, max_batch_rank, max_wait_ms, max_bulk_batch,
+                                  max_bulk_batch_idle=max_batch_rank)
+
+    # -------------------------
+    # 同步接口（线程中调用）
+    # -------------------------
+
+    def embed(self, text: str, priority: int = INTERACTIVE) -> np.ndarray:
+        return self._embed.submit(text, priority).result()
+
+    def embed_batch(self, texts: List[str], priority: int = INTERACTIVE) -> np.ndarray:
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([f.result() for f in self._embed.submit_many(texts, priority)])
+
+    def rank(self, question: str, answers: List[Union[str, List[int]]], priority: int = INTERACTIVE) -> np.ndarray:
+        """answers 可以是文本，也可以是入库时保存的 rerank token id"""
+        futures = self._rank.submit_many([(question, a) for a in answers], priority)
+        return np.array([f.result() for f in futures], dtype=np.float32)
+
+    # -------------------------
+    # 异步接口（在事件循环中 await，不阻塞其他请求）
+    # -------------------------
+
+    async def aembed(self, text: str) -> np.ndarray:
+        return await asyncio.wrap_future(self._embed.submit(text))
+
+    async def arank(self, question: str, answers: List[Union[str, List[int]]]) -> np.ndarray:
+        futures = self._rank.submit_many([(question, a) for a in answers])
+        scores = await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+        return np.array(scores, dtype=np.float32)
+
+    @property
+    def model_id(self) -> str:
+        return self.embedder.model_id
+
+    @property
+    def rank_model_id(self) -> str:
+        return self.ranker.model_id
+
+    def stats(self) -> dict:
+        return {"embed": self._embed.stats(), "rank": self._rank.stats()}
+
+    def embedding_cache_stats(self) -> Optional[dict]:
+        cache = getattr(self.embedder, "cache", None)
+        return cache.stats() if cache is not None else None
+
+
+class BulkEmbedder:
+    """
+    供入库流水线使用的 Embedding 替身：接口同 Embedding.embed_batch，
+    但经调度器以 BULK 优先级执行，不会阻塞在线查询
+    """
+
+    def __init__(self, scheduler: InferenceScheduler):
+        self.scheduler = scheduler
+        self.cache = getattr(scheduler.embedder, "cache", None)  # 远程推理（InferenceClient）时为 None
+
+    def embed_batch(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        return self.scheduler.embed_batch(texts, priority=BULK)
@@ -0,0 +1,260 @@
+import os
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from dataES import SmallRAGDB, DocumentMeta, ChunkChange, tenant_key
+from local_store import LocalStore, tokenize
+from migrate_chunks import migrate
+
+"""
+存储后端一致性测试：LocalStore 与 SmallRAGDB（ES）跑同一套用例
+ES 不可达时跳过 ES 用例（REQUIRE_ES=1 时改为失败，CI 中使用）；ES 用例使用随机前缀的临时索引，结束后删除
+
+    python -m pytest -q test_store.py
+    ES_URL=http://localhost:9200 REQUIRE_ES=1 python -m pytest -q test_store.py
+"""
+
+DIM = 768
+WS = "ws_test"
+USER = "alice"
+
+
+def _unit(seed: int) -> np.ndarray:
+    v = np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+def _chunk(doc_id: str, i: int, content: str, vector: np.ndarray, workspace_id: str = WS, user: str = USER):
+    return {
+        "chunk_id": f"{doc_id}_{i}",
+        "doc_id": doc_id,
+        "workspace_id": workspace_id,
+        "user_username": user,
+        "chunk_content": content,
+        "embedding_vector": vector.tolist(),
+        "chunk_order": i,
+        "page_number": i // 2 + 1,
+        "created_at": datetime.now(timezone.utc),
+    }
+
+
+CONTENTS = [
+    "检索增强生成将外部知识库与大语言模型结合",
+    "向量检索使用余弦相似度比较查询与文档片段",
+    "BM25 是经典的全文检索打分函数",
+    "Elasticsearch 支持 dense_vector 字段和 kNN 检索",
+    "倒排索引记录每个词出现在哪些文档中",
+    "重排序模型对候选片段进行精细打分",
+]
+
+
+def _es_unavailable(reason: str):
+    if os.getenv("REQUIRE_ES") == "1":
+        pytest.fail(reason)
+    pytest.skip(reason)
+
+
+def _es_db() -> SmallRAGDB:
+    db = SmallRAGDB(es_url=os.getenv("ES_URL", "http://localhost:9200"), index_prefix=f"test_{uuid.uuid4().hex[:8]}")
+    if not db.ping():
+        _es_unavailable("Elasticsearch 不可达")
+    return db
+
+
+@pytest.fixture(params=["local", "es"])
+def store(request, tmp_path):
+    if request.param == "local":
+        db = LocalStore(path=str(tmp_path / "store"))
+        yield db
+        db.close()
+        return
+    db = _es_db()
+    try:
+        assert db.init_indices(overwrite=True)
+    except Exception as e:  # 例如未安装 IK 分词插件
+        _es_unavailable(f"ES 索引初始化失败: {e}")
+    yield db
+    db.delete_indices()
+
+
+@pytest.fixture
+def loaded(store):
+    """两个文档共 6 个 chunk，另有一个其他用户的 chunk"""
+    chunks = [_chunk("doc_a" if i < 3 else "doc_b", i, text, _unit(i)) for i, text in enumerate(CONTENTS)]
+    chunks.append(_chunk("doc_c", 0, CONTENTS[0], _unit(0), user="bob"))
+    store.bulk_create_chunks(chunks)
+    store.refresh_all()
+    return store
+
+
+def test_document_crud(store):
+    now = datetime.now(timezone.utc)
+    meta = DocumentMeta(doc_id="d1", workspace_id=WS, user_username=USER, title="测试文档", file_name="t.pdf",
+                        abstract="摘要", full_content="全文", file_size=1, file_hash="h", created_at=now, updated_at=now)
+    store.create_document("d1", meta)
+    store.refresh_all()
+    assert store.get_document("d1")["title"] == "测试文档"
+    store.delete_document("d1")
+    store.refresh_all()
+    assert store.get_document("d1") is None
+
+
+def test_knn_exact_match_first(loaded):
+    hits = loaded.knn_search_chunks(_unit(4).tolist(), WS, USER, k=3)
+    assert hits[0]["chunk_id"] == "doc_b_4"
+    assert hits[0]["_score"] == pytest.approx(1.0, abs=1e-3)
+    assert "embedding_vector" not in hits[0]
+    assert [h["_score"] for h in hits] == sorted((h["_score"] for h in hits), reverse=True)
+
+
+def test_knn_include_vectors(loaded):
+    hit = loaded.knn_search_chunks(_unit(1).tolist(), WS, USER, k=1, include_vectors=True)[0]
+    assert np.allclose(hit["embedding_vector"], _unit(1), atol=1e-5)
+
+
+def test_bm25_finds_chinese_text(loaded):
+    hits = loaded.bm25_search_chunks("倒排索引", WS, USER, size=3)
+    assert hits and hits[0]["chunk_id"] == "doc_b_4"
+    assert hits[0]["_score"] > 0
+
+
+def test_filters_user_and_doc(loaded):
+    hits = loaded.knn_search_chunks(_unit(0).tolist(), WS, USER, k=10)
+    assert {h["user_username"] for h in hits} == {USER}
+    assert len(hits) == 6
+    hits = loaded.bm25_search_chunks("检索", WS, USER, size=10, doc_ids=["doc_b"])
+    assert hits and {h["doc_id"] for h in hits} == {"doc_b"}
+    assert loaded.knn_search_chunks(_unit(0).tolist(), "other_ws", USER, k=5) == []
+
+
+def test_hybrid_search_fuses_both(loaded):
+    candidates = loaded.hybrid_search_chunks("倒排索引", _unit(4).tolist(), WS, USER, 5, 5)
+    assert candidates[0].chunk_id == "doc_b_4"
+    assert candidates[0].bm25_rank == 1 and candidates[0].knn_rank == 1
+
+
+def test_rerank_token_ids_fetched_on_demand(store):
+    chunks = [_chunk("doc_t", i, text, _unit(i)) for i, text in enumerate(CONTENTS[:2])]
+    chunks[0].update(rerank_token_ids=[11, 12, 13], rerank_tokenizer="tok")
+    store.bulk_create_chunks(chunks)
+    store.refresh_all()
+    hits = store.knn_search_chunks(_unit(0).tolist(), WS, USER, k=2)
+    assert hits[0]["rerank_tokenizer"] == "tok" and "rerank_token_ids" not in hits[0]
+    assert store.rerank_token_ids(["doc_t_0", "doc_t_1", "missing"], WS) == {"doc_t_0": [11, 12, 13]}
+
+
+def test_bulk_update_and_positions(loaded):
+    loaded.bulk_update_chunks([{"chunk_id": "doc_a_0", "chunk_order": 10, "page_number": 7}])
+    loaded.refresh_all()
+    positions = {cid: (order, page) for cid, order, page in loaded.iter_chunk_positions("doc_a")}
+    assert positions["doc_a_0"] == (10, 7)
+    assert len(positions) == 3
+    # 未改写的向量保持不变
+    hit = loaded.knn_search_chunks(_unit(0).tolist(), WS, USER, k=1)[0]
+    assert hit["chunk_id"] == "doc_a_0"
+
+
+def test_deletes(loaded):
+    loaded.bulk_delete_chunks(["doc_a_0"])
+    loaded.delete_chunks_by_doc("doc_b")
+    loaded.refresh_all()
+    ids = {h["chunk_id"] for h in loaded.knn_search_chunks(_unit(0).tolist(), WS, USER, k=10)}
+    assert ids == {"doc_a_1", "doc_a_2"}
+    assert loaded.bm25_search_chunks("倒排索引", WS, USER, size=5) == []
+
+
+def test_clone_document_chunks(loaded):
+    copied = loaded.clone_document_chunks("doc_a", "doc_x", "ws_other", "carol")
+    loaded.refresh_all()
+    assert copied == 3
+    hits = loaded.knn_search_chunks(_unit(2).tolist(), "ws_other", "carol", k=1)
+    assert hits[0]["chunk_id"] == "doc_x_2"
+
+
+def test_clone_document_chunks_stops(loaded):
+    checks = []
+    copied = loaded.clone_document_chunks("doc_a", "doc_y", "ws_other", "carol", bulk_size=2,
+                                          should_stop=lambda: checks.append(1) or len(checks) > 1)
+    loaded.refresh_all()
+    assert copied == 2
+    assert len(loaded.knn_search_chunks(_unit(0).tolist(), "ws_other", "carol", k=10)) == 2
+
+
+def test_update_chunk_moves_workspace(loaded):
+    # 租户布局下换工作区意味着换 routing，文档需要迁到新分片
+    loaded.update_chunk("doc_a_0", _chunk("doc_a", 0, CONTENTS[0], _unit(0), workspace_id="ws_moved"))
+    loaded.refresh_all()
+    assert loaded.get_chunk("doc_a_0")["workspace_id"] == "ws_moved"
+    assert [h["chunk_id"] for h in loaded.knn_search_chunks(_unit(0).tolist(), "ws_moved", USER, k=5)] == ["doc_a_0"]
+    assert "doc_a_0" not in {h["chunk_id"] for h in loaded.knn_search_chunks(_unit(0).tolist(), WS, USER, k=10)}
+
+
+def test_chunk_listeners(store):
+    changes = []
+    store.add_chunk_listener(changes.append)
+    store.bulk_create_chunks([_chunk("doc_a", 0, CONTENTS[0], _unit(0))])
+    store.delete_chunks_by_doc("doc_a")
+    assert [c.action for c in changes] == ["upsert", "delete"]
+    assert isinstance(changes[0], ChunkChange) and changes[0].chunk_ids == ["doc_a_0"]
+    store.bulk_create_chunks([_chunk("doc_b", 1, CONTENTS[1], _unit(1))])
+    store.bulk_delete_chunks(["doc_b_1"])
+    assert changes[-1].action == "delete" and changes[-1].workspace_ids == {WS}
+
+
+def test_bigram_tokenizer():
+    assert tokenize("检索增强 RAG", "bigram") == ["检索", "索增", "增强", "rag"]
+    assert tokenize("库", "bigram") == ["库"]
+
+
+def test_local_store_compaction_and_reopen(tmp_path):
+    path = str(tmp_path / "store")
+    db = LocalStore(path=path)
+    db.bulk_create_chunks([_chunk("doc", i, f"文本 {i}", _unit(i)) for i in range(1100)])
+    db.bulk_delete_chunks([f"doc_{i}" for i in range(800)])
+    db.close()
+
+    db = LocalStore(path=path)  # 重新打开后数据与整理后的向量行号一致
+    hit = db.knn_search_chunks(_unit(900).tolist(), WS, USER, k=1)[0]
+    assert hit["chunk_id"] == "doc_900"
+    assert hit["_score"] == pytest.approx(1.0, abs=1e-3)
+    db.close()
+
+
+@pytest.fixture
+def legacy_es():
+    """迁移前的旧布局：chunk 索引名即实体索引，mapping 不要求 routing"""
+    db = _es_db()
+    mappings = {k: v for k, v in db._get_mappings()["chunk"]["mappings"].items() if k != "_routing"}
+    try:
+        db.es.indices.create(index=db._indices["chunk"], body={"mappings": mappings})
+        assert db.init_indices(overwrite=False)
+    except Exception as e:
+        _es_unavailable(f"ES 索引初始化失败: {e}")
+    yield db
+    db.delete_indices()
+
+
+def test_migrate_to_tenant_layout(legacy_es):
+    chunks = [_chunk("doc_a", i, text, _unit(i)) for i, text in enumerate(CONTENTS)]
+    chunks.append(_chunk("doc_c", 0, CONTENTS[0], _unit(0), user="bob"))
+    legacy_es.bulk_create_chunks(chunks)
+    legacy_es.refresh_all()
+    assert not legacy_es.tenant_routing
+
+    # migrate() 不修改传入实例的 tenant_routing，legacy_es 此后相当于一个未重启的服务
+    assert migrate(legacy_es, shards=2, poll_seconds=0.1)
+    alias = legacy_es._indices["chunk"]
+    assert legacy_es.es.indices.exists_alias(name=alias)
+    assert legacy_es.concrete_indices(alias) == [f"{alias}_v1"]
+
+    # 运行中的客户端仍认为是旧布局：写入遇到 routing_missing 后重新检测并重试
+    legacy_es.bulk_create_chunks([_chunk("doc_b", 0, "迁移后写入的片段", _unit(42))])
+    assert legacy_es.tenant_routing
+    legacy_es.refresh_all()
+    hits = legacy_es.knn_search_chunks(_unit(0).tolist(), WS, USER, k=10)
+    assert len(hits) == len(CONTENTS) + 1
+    assert {h["tenant_key"] for h in hits} == {tenant_key(WS, USER)}
+    assert legacy_es.get_chunk("doc_b_0")["chunk_content"] == "迁移后写入的片段"
@@ -1,26 +1,178 @@
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import pdfplumber  # pip install pdfplumber
-from typing import List,Tuple
+from typing import List,Tuple,Iterator,Optional,Dict
+from collections import deque, Counter
+from dataclasses import dataclass, field, asdict
+import math
+import re
+import signal
+import time
+import logging
+from functools import lru_cache
+import os
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+import config
+
+logger = logging.getLogger(__name__)
 
 # 推荐：显式指定适合中文的分隔符序列（从粗到细）
+SEPARATORS = [
+    "\n\n",              # 段落分隔（优先尝试）
+    "\n",                # 换行
+    "。", "！", "？",     # 中文句末标点
+    "；", "：", "，",     # 中文句中停顿标点
+    " ",                 # 空格
+    ""                   # 最后 fallback 到任意位置切分（避免超长）
+]
+
 text_splitter = RecursiveCharacterTextSplitter(
     chunk_size=500,          # 每个 chunk 的最大长度（单位由 length_function 决定）
     chunk_overlap=50,        # 相邻 chunk 之间的重叠长度（建议 10%~20% 的 chunk_size）
     length_function=len,     # 当前按字符数计算（对中文基本可用，但非最精确）
-    separators=[
-        "\n\n",              # 段落分隔（优先尝试）
-        "\n",                # 换行
-        "。", "！", "？",     # 中文句末标点
-        "；", "：", "，",     # 中文句中停顿标点
-        " ",                 # 空格
-        ""                   # 最后 fallback 到任意位置切分（避免超长）
-    ],
+    separators=SEPARATORS,
     is_separator_regex=False,  # separators 是普通字符串，非正则表达式
     keep_separator=True,       # 保留分隔符（如句号）在 chunk 末尾，更自然
 )
 
+
+@lru_cache(maxsize=4)
+def get_fast_tokenizer(model_path: str):
+    """加载并缓存 Rust 实现的 tokenizers.Tokenizer，只用于计数，不加载模型权重"""
+    tokenizer_file = os.path.join(model_path, "tokenizer.json")
+    if os.path.exists(tokenizer_file):
+        from tokenizers import Tokenizer
+        return Tokenizer.from_file(tokenizer_file)
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_path, use_fast=True).backend_tokenizer
+
+
+RERANK_TOKENIZER_ID = os.path.basename(os.path.normpath(config.RERANK_MODEL_PATH))
+
+
+def encode_for_rerank(texts: List[str], max_tokens: int = 510) -> List[List[int]]:
+    """
+    入库时预先计算 chunk 在 rerank 模型词表下的 token id（不含特殊符号），
+    在线 rerank 时只需对问题分词，再与之拼接成模型输入
+    """
+    tokenizer = get_fast_tokenizer(config.RERANK_MODEL_PATH)
+    return [enc.ids[:max_tokens] for enc in tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+
+class TokenTextSplitter:
+    """
+    与 text_splitter 相同的中文分隔符层级与重叠策略，但按模型 token 数计算长度，
+    保证每个 chunk 都落在 embedding / rerank 模型的 512 token 窗口内，不会被静默截断。
+
+    各片段长度用 encode_batch 一次性批量计数后直接相加（BERT 类分词对中文按字切分，
+    片段边界处的误差可以忽略），避免对每个候选 chunk 反复整体分词。
+    """
+
+    def __init__(
+        self,
+        model_path: str = config.EMBEDDING_MODEL_PATH,
+        chunk_size: int = config.CHUNK_SIZE_TOKENS,
+        chunk_overlap: int = config.CHUNK_OVERLAP_TOKENS,
+        separators: Optional[List[str]] = None,
+    ):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap({chunk_overlap}) 必须小于 chunk_size({chunk_size})")
+        self.model_path = model_path
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = separators or SEPARATORS
+
+    def _token_lengths(self, pieces: List[str]) -> List[int]:
+        encodings = get_fast_tokenizer(self.model_path).encode_batch(pieces, add_special_tokens=False)
+        return [len(e.ids) for e in encodings]
+
+    @staticmethod
+    def _split_keep_separator(text: str, separator: str) -> List[str]:
+        if separator == "":
+            return list(text)
+        parts = text.split(separator)
+        pieces = [part + separator for part in parts[:-1]]
+        pieces.append(parts[-1])
+        return [p for p in pieces if p]
+
+    def split_text(self, text: str) -> List[str]:
+        return [c for c in (chunk.strip() for chunk in self._split(text, self.separators)) if c]
+
+    def _split(self, text: str, separators: List[str]) -> List[str]:
+        # 选择文本中出现的第一个（最粗的）分隔符
+        separator, rest = separators[-1], []
+        for i, sep in enumerate(separators):
+            if sep == "" or sep in text:
+                separator, rest = sep, separators[i + 1:]
+                break
+
+        pieces = self._split_keep_separator(text, separator)
+        lengths = self._token_lengths(pieces)
+
+        chunks: List[str] = []
+        good: List[str] = []
+        good_lengths: List[int] = []
+        for piece, length in zip(pieces, lengths):
+            if length <= self.chunk_size:
+                good.append(piece)
+                good_lengths.append(length)
+                continue
+            if good:
+                chunks.extend(self._merge(good, good_lengths))
+                good, good_lengths = [], []
+            # 单个片段仍然超长：用更细的分隔符递归切分
+            chunks.extend(self._split(piece, rest) if rest else [piece])
+        if good:
+            chunks.extend(self._merge(good, good_lengths))
+        return chunks
+
+    def _merge(self, pieces: List[str], lengths: List[int]) -> List[str]:
+        """贪心合并小片段；输出一个 chunk 后从窗口头部弹出片段，直到剩余部分不超过 chunk_overlap 作为重叠"""
+        chunks: List[str] = []
+        window: deque = deque()
+        total = 0
+        for piece, length in zip(pieces, lengths):
+            if window and total + length > self.chunk_size:
+                chunks.append("".join(p for p, _ in window))
+                while window and (total > self.chunk_overlap or total + length > self.chunk_size):
+                    total -= window.popleft()[1]
+            window.append((piece, length))
+            total += length
+        if window:
+            chunks.append("".join(p for p, _ in window))
+        return chunks
+
+
+_token_splitter: Optional[TokenTextSplitter] = None
+
+
+def get_text_splitter():
+    """按 config.TEXT_SPLITTER 选择切分器：token（按模型 token 计长）或 char（按字符计长）"""
+    global _token_splitter
+    if config.TEXT_SPLITTER == "char":
+        return text_splitter
+    if _token_splitter is None:
+        _token_splitter = TokenTextSplitter()
+    return _token_splitter
+
+
+def chunking_signature() -> str:
+    """
+    决定切分结果的配置摘要（切分器、chunk 长度与重叠、文本规范化），记录在 Document.chunking_config 上；
+    跨文档复用 chunk 时除向量模型外这一项也需一致，配置改动后重新上传会重新切分
+    """
+    if config.TEXT_SPLITTER == "char":
+        splitter = f"char:{text_splitter._chunk_size}/{text_splitter._chunk_overlap}"
+    else:
+        model = os.path.basename(os.path.normpath(config.EMBEDDING_MODEL_PATH))
+        splitter = f"token:{model}:{config.CHUNK_SIZE_TOKENS}/{config.CHUNK_OVERLAP_TOKENS}"
+    normalize = f"normalize:{config.HEADER_FOOTER_WINDOW}" if config.NORMALIZE_TEXT else "raw"
+    return f"{splitter};{normalize}"
+
+
 def split_text(text: str)->list[str]:
-    return text_splitter.split_text(text)
+    return get_text_splitter().split_text(text)
 
 def extract_with_pdfplumber(pdf_path: str) -> tuple[list[str], list[int]]:
     """适合含表格/复杂布局的 PDF"""
@@ -41,34 +193,331 @@ def extract_with_pdfplumber(pdf_path: str) -> tuple[list[str], list[int]]:
     return texts, pages
 
 
-def extract_and_split_with_pages(pdf_path: str) -> Tuple[List[List[str]], List[int]]:
+def _extract_page_text(page, layout: bool = True) -> str:
+    if layout:
+        page_text = page.extract_text(
+            layout=True,
+            x_tolerance=2,
+            y_tolerance=2
+        )
+    else:
+        # 非 layout 模式不做逐字符的坐标对齐计算，病态页面上快一个数量级
+        page_text = page.extract_text(x_tolerance=2, y_tolerance=2)
+    # 释放 pdfplumber 对该页缓存的字符/图形对象，否则大文档会持续累积
+    page.flush_cache()
+    return page_text
+
+
+class _PageTimeout(Exception):
+    pass
+
+
+def _raise_page_timeout(signum, frame):
+    raise _PageTimeout()
+
+
+def _run_with_budget(fn, budget: float):
+    """用 SIGALRM 限制单次调用耗时；pdfplumber 是纯 Python，可在字节码间被打断。只能在进程主线程中使用"""
+    signal.setitimer(signal.ITIMER_REAL, budget)
+    try:
+        return fn()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _extract_page_with_budget(page, budget: float, on_timeout: str) -> Tuple[str, str, float]:
+    """
+    返回 (page_text, mode, seconds)，mode 为：
+    - layout:   正常的 layout 提取
+    - fallback: layout 超时，改用非 layout 模式提取成功
+    - skipped:  超时后跳过（on_timeout="skip"，或降级模式也超时）
+    """
+    start = time.perf_counter()
+    try:
+        return _run_with_budget(lambda: _extract_page_text(page), budget), "layout", time.perf_counter() - start
+    except _PageTimeout:
+        page.flush_cache()
+    if on_timeout == "fallback":
+        try:
+            text = _run_with_budget(lambda: _extract_page_text(page, layout=False), budget)
+            return text, "fallback", time.perf_counter() - start
+        except _PageTimeout:
+            page.flush_cache()
+    return "", "skipped", time.perf_counter() - start
+
+
+def _extract_page_range(pdf_path: str, start: int, end: int, budget: float = 0.0,
+                        on_timeout: str = "fallback") -> List[Tuple[int, str, str, float]]:
+    """子进程任务：自行打开文件，提取 [start, end] 页（从 1 开始，含两端），budget > 0 时限制单页耗时"""
+    use_budget = budget > 0 and hasattr(signal, "setitimer")
+    if use_budget:
+        signal.signal(signal.SIGALRM, _raise_page_timeout)
+    results = []
+    with pdfplumber.open(pdf_path, pages=list(range(start, end + 1))) as pdf:
+        for page in pdf.pages:
+            if use_budget:
+                results.append((page.page_number, *_extract_page_with_budget(page, budget, on_timeout)))
+            else:
+                t0 = time.perf_counter()
+                text = _extract_page_text(page)
+                results.append((page.page_number, text, "layout", time.perf_counter() - t0))
+    return results
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """进程池全局复用，避免每个文档都付出一次进程启动开销"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn：父进程里已有 torch/推理线程，fork 容易死锁
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+
+def _iter_page_texts_parallel(pdf_path: str, workers: int, shard_pages: int, budget: float,
+                              on_timeout: str) -> Iterator[Tuple[int, str, str, float]]:
+    """按页段分片到进程池并行提取，按页码顺序产出"""
+    page_count = count_pages(pdf_path)
+    shards = deque((start, min(start + shard_pages - 1, page_count))
+                   for start in range(1, page_count + 1, shard_pages))
+
+    pool = _get_pool(workers)
+    pending: deque = deque()
+    # 最多同时挂起 2*workers 个分片：既让每个进程都有活干，又不会在消费方较慢时堆积整本文档
+    while shards or pending:
+        while shards and len(pending) < workers * 2:
+            start, end = shards.popleft()
+            pending.append(pool.submit(_extract_page_range, pdf_path, start, end, budget, on_timeout))
+        yield from pending.popleft().result()
+
+
+def iter_page_texts(
+    pdf_path: str,
+    workers: Optional[int] = None,
+    slow_pages: Optional[List[Dict]] = None,
+) -> Iterator[Tuple[int, str]]:
+    """
+    逐页提取文本的生成器，产出 (page_number, page_text)，跳过空白页。
+    workers > 1 时按页段分片到进程池并行提取，结果仍按页码顺序产出；
+    默认取 config.PDF_EXTRACT_WORKERS。
+
+    config.PAGE_TIME_BUDGET > 0（默认关闭）时单页提取超过预算会被打断，按 config.PAGE_TIMEOUT_ACTION
+    降级为非 layout 模式（fallback）或直接跳过（skip）。计时依赖 SIGALRM：串行提取且在主线程中时
+    在本进程内计时；在其他线程（如入库流水线的解析线程）中串行提取时只能交给单进程的进程池。
+    超时的页面以 {"page", "mode", "seconds"} 追加到 slow_pages。
+    """
+    workers = config.PDF_EXTRACT_WORKERS if workers is None else workers
+    budget = config.PAGE_TIME_BUDGET if hasattr(signal, "setitimer") else 0.0
+    in_main_thread = threading.current_thread() is threading.main_thread()
+    if workers > 1 or (budget > 0 and not in_main_thread):
+        pages = _iter_page_texts_parallel(pdf_path, max(workers, 1), config.PDF_EXTRACT_SHARD_PAGES,
+                                          budget, config.PAGE_TIMEOUT_ACTION)
+    else:
+        pages = _iter_page_texts_serial(pdf_path, budget, config.PAGE_TIMEOUT_ACTION)
+    for page_number, page_text, mode, seconds in pages:
+        if mode != "layout":
+            logger.warning(f"⏱️ {os.path.basename(pdf_path)} 第 {page_number} 页提取超时（{seconds:.1f}s），处理方式：{mode}")
+            if slow_pages is not None:
+                slow_pages.append({"page": page_number, "mode": mode, "seconds": round(seconds, 2)})
+        if not page_text or not page_text.strip():
+            continue  # 跳过空白页
+        yield page_number, page_text
+
+
+def count_pages(pdf_path: str) -> int:
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
+
+
+def _iter_page_texts_serial(pdf_path: str, budget: float = 0.0,
+                            on_timeout: str = "fallback") -> Iterator[Tuple[int, str, str, float]]:
+    """本进程内逐页提取；budget > 0 时用 SIGALRM 计时，只能在主线程中调用"""
+    previous = signal.signal(signal.SIGALRM, _raise_page_timeout) if budget > 0 else None
+    try:
+        with pdfplumber.open(pdf_path) as pdf:
+            for page in pdf.pages:
+                if budget > 0:
+                    yield (page.page_number, *_extract_page_with_budget(page, budget, on_timeout))
+                    continue
+                start = time.perf_counter()
+                text = _extract_page_text(page)
+                yield page.page_number, text, "layout", time.perf_counter() - start
+    finally:
+        if previous is not None:
+            signal.signal(signal.SIGALRM, previous)
+
+
+# -------------------------
+# 文本规范化：压缩版面空白、去除页眉页脚
+# -------------------------
+
+_LAYOUT_SPACES = re.compile(r"[ \t\u3000]{2,}")
+_DIGITS = re.compile(r"\d+")
+
+
+def compact_layout_text(text: str) -> str:
+    """
+    extract_text(layout=True) 会用大段空格保持对齐：折叠成单个空格，去掉行首尾空白，
+    连续空行合并为一个（保留段落边界供切分器使用）
+    """
+    lines: List[str] = []
+    blank = False
+    for line in text.split("\n"):
+        line = _LAYOUT_SPACES.sub(" ", line).strip()
+        if not line:
+            if lines and not blank:
+                lines.append("")
+            blank = True
+            continue
+        lines.append(line)
+        blank = False
+    return "\n".join(lines).strip()
+
+
+@dataclass
+class NormalizeStats:
+    pages: int = 0
+    raw_chars: int = 0
+    clean_chars: int = 0
+    raw_chunks: int = 0
+    clean_chunks: int = 0
+    removed_lines: int = 0
+    repeated_lines: List[str] = field(default_factory=list)  # 识别出的页眉页脚（数字已替换为 #）
+
+    def as_dict(self) -> Dict:
+        data = asdict(self)
+        data["char_reduction"] = 1 - self.clean_chars / self.raw_chars if self.raw_chars else 0.0
+        if self.raw_chunks:
+            data["chunk_reduction"] = 1 - self.clean_chunks / self.raw_chunks
+        else:
+            # 未统计规范化前的 chunk 数（NORMALIZE_COUNT_RAW_CHUNKS 关闭），不报告无法计算的值
+            data["raw_chunks"] = data["chunk_reduction"] = None
+        return data
+
+
+class PageNormalizer:
+    """
+    流式规范化页文本。先缓存前 window 页，统计每页首尾 edge_lines 行（数字替换为 # 以兼容页码），
+    在至少 min_ratio 比例页面中重复出现的行视为页眉页脚，在之后所有页中删除。
+    只缓存固定页数，内存占用与文档大小无关。
+    count_raw_chunks 为 True 时对原文再切分一次以统计 raw_chunks（切分开销翻倍），默认只统计字符数。
+    """
+
+    def __init__(
+        self,
+        window: int = config.HEADER_FOOTER_WINDOW,
+        edge_lines: int = 3,
+        min_ratio: float = 0.6,
+        stats: Optional[NormalizeStats] = None,
+        count_raw_chunks: bool = config.NORMALIZE_COUNT_RAW_CHUNKS,
+    ):
+        self.window = window
+        self.edge_lines = edge_lines
+        self.min_ratio = min_ratio
+        self.stats = stats if stats is not None else NormalizeStats()
+        self.count_raw_chunks = count_raw_chunks
+        self.repeated: set = set()
+
+    @staticmethod
+    def _key(line: str) -> str:
+        return _DIGITS.sub("#", line)
+
+    def _edge_indices(self, lines: List[str]) -> List[int]:
+        non_empty = [i for i, line in enumerate(lines) if line]
+        # 短页面只看最外侧少量行，避免把正文当成页眉页脚
+        k = min(self.edge_lines, len(non_empty) // 4)
+        if k == 0:
+            return []
+        return sorted(set(non_empty[:k] + non_empty[-k:]))
+
+    def _detect(self, pages: List[List[str]]):
+        if len(pages) < 3:
+            return
+        counter: Counter = Counter()
+        for lines in pages:
+            counter.update({self._key(lines[i]) for i in self._edge_indices(lines)})
+        threshold = max(2, math.ceil(self.min_ratio * len(pages)))
+        self.repeated = {key for key, count in counter.items() if count >= threshold}
+        self.stats.repeated_lines = sorted(self.repeated)
+
+    def _clean(self, lines: List[str]) -> str:
+        if self.repeated:
+            drop = {i for i in self._edge_indices(lines) if self._key(lines[i]) in self.repeated}
+            self.stats.removed_lines += len(drop)
+            lines = [line for i, line in enumerate(lines) if i not in drop]
+        return compact_layout_text("\n".join(lines))
+
+    def __call__(self, pages: Iterator[Tuple[int, str]]) -> Iterator[Tuple[int, str]]:
+        pages = iter(pages)
+        head: List[Tuple[int, str, List[str]]] = []
+        for page_number, raw in pages:
+            head.append((page_number, raw, compact_layout_text(raw).split("\n")))
+            if len(head) >= self.window:
+                break
+        self._detect([lines for _, _, lines in head])
+
+        def compacted():
+            yield from head
+            for page_number, raw in pages:
+                yield page_number, raw, compact_layout_text(raw).split("\n")
+
+        for page_number, raw, lines in compacted():
+            clean = self._clean(lines)
+            self.stats.pages += 1
+            self.stats.raw_chars += len(raw)
+            self.stats.clean_chars += len(clean)
+            if self.count_raw_chunks:
+                self.stats.raw_chunks += len(split_text(raw))
+            if clean:
+                yield page_number, clean
+
+
+def iter_chunks_with_pages(
+    pdf_path: str,
+    workers: Optional[int] = None,
+    stats: Optional[NormalizeStats] = None,
+    slow_pages: Optional[List[Dict]] = None,
+) -> Iterator[Tuple[str, int]]:
+    """
+    流式解析 PDF，逐个产出 (chunk, page_number)，页码从 1 开始
+    config.NORMALIZE_TEXT 开启时先压缩版面空白并去除页眉页脚；传入 stats 可获得规范化前后的字符/chunk 统计
+    slow_pages 用于收集提取超时的页面，见 iter_page_texts
+    """
+    pages = iter_page_texts(pdf_path, workers, slow_pages)
+    if config.NORMALIZE_TEXT:
+        pages = PageNormalizer(stats=stats)(pages)
+    for page_number, page_text in pages:
+        chunks = split_text(page_text)
+        if stats is not None:
+            stats.clean_chunks += len(chunks)
+        for chunk in chunks:
+            yield chunk, page_number
+
+
+def extract_and_split_with_pages(pdf_path: str, workers: Optional[int] = None) -> Tuple[List[str], List[int]]:
     """
     解析 PDF 并按页分割文本，返回：
     - chunks: 所有文本块（List[str]）
     - page_numbers: 每个 chunk 对应的页码（List[int]，从 1 开始）
 
     保证 len(chunks) == len(page_numbers)
+    大文档请优先使用 iter_chunks_with_pages，避免一次性物化全部 chunk
+    workers: 并行提取的进程数，None 表示使用 config.PDF_EXTRACT_WORKERS，1 为串行
     """
     all_chunks: List[str] = []
     all_page_numbers: List[int] = []
 
-    with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            page_text = page.extract_text(
-                layout=True,
-                x_tolerance=2,
-                y_tolerance=2
-            )
-            if not page_text or not page_text.strip():
-                continue  # 跳过空白页
-
-            # 对当前页的文本进行分割
-            page_chunks = text_splitter.split_text(page_text)
-
-            # 将当前页的所有 chunks 添加到全局列表
-            all_chunks.extend(page_chunks)
-            # 每个 chunk 都标记为当前页码
-            all_page_numbers.extend([page.page_number] * len(page_chunks))
+    for chunk, page_number in iter_chunks_with_pages(pdf_path, workers):
+        all_chunks.append(chunk)
+        all_page_numbers.append(page_number)
 
     return all_chunks, all_page_numbers
 
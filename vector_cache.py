@@ -0,0 +1,326 @@
+import threading
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+import config
+from dataES import ChunkChange
+
+"""
+热点工作区向量缓存：kNN 在进程内用矩阵乘完成，不再走 ES 的 HTTP kNN
+
+大多数工作区只有几千到两万个 chunk，一次 numpy 矩阵-向量乘比 ES kNN 请求（序列化 768 维查询向量、
+HNSW 检索、网络往返）更快。缓存按工作区保存 L2 归一化后的向量（int8 + 每行缩放系数，或 float16）、
+chunk_id、用户名与 doc_id，在内存预算内按 LRU 淘汰。
+
+- 未缓存的工作区：本次查询照常走 ES，同时在后台线程加载该工作区，之后的查询命中缓存
+- chunk 数超过 VECTOR_CACHE_MAX_CHUNKS 的工作区不缓存，始终走 ES
+- 本进程的写入通过 SmallRAGDB 的 chunk 变更回调立即失效；加载期间发生的变更会使这次加载作废
+- 失效后的去抖：工作区最近一次变更后 VECTOR_CACHE_DEBOUNCE_SECONDS 内不重新加载（查询走 ES），
+  入库过程中每次 bulk 写入都会失效，去抖避免反复整库重载；该时长应不小于 ES 的 refresh_interval，
+  加载时无需再强制 refresh
+- 跨进程的写入（其他 API worker、独立的入库进程）收不到回调：命中时每隔 VECTOR_CACHE_CHECK_SECONDS
+  在后台探测工作区签名（chunk 数与最新 created_at），与加载时不一致则丢弃重载。
+  探测间隔内已删除的 chunk 不会被返回（按 id 取回时 ES 中已不存在），新增的 chunk 最多滞后一个探测间隔
+"""
+
+logger = logging.getLogger(__name__)
+
+# loader(workspace_id, max_chunks) -> (chunk_ids, users, doc_ids, float32 向量矩阵)；超过 max_chunks 时返回 None
+Loader = Callable[[str, int], Optional[Tuple[List[str], List[str], List[str], np.ndarray]]]
+# probe(workspace_id) -> 工作区内容签名，任何写入后应发生变化
+Probe = Callable[[str], Any]
+
+_BLOCK_ROWS = 256  # 分块反量化到可复用的小缓冲区（留在 CPU 缓存内），避免为整个工作区生成 float32 临时矩阵
+
+
+@dataclass
+class _Entry:
+    chunk_ids: np.ndarray        # object
+    users: np.ndarray            # object
+    doc_ids: np.ndarray          # object
+    vectors: np.ndarray          # float16 / int8 [n, dim]
+    scales: Optional[np.ndarray]  # int8 时每行的缩放系数
+    nbytes: int
+    signature: Any = None         # 加载前探测到的工作区签名
+    checked_at: float = 0.0       # 最近一次确认签名未变的时间（monotonic）
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """先做 L2 归一化；int8 按行对称量化（scale = max|x| / 127）"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    if dtype == "int8":
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    return vectors, None
+
+
+def cosine_scores(vectors: np.ndarray, scales: Optional[np.ndarray], query: np.ndarray) -> np.ndarray:
+    """query 需已归一化；返回与每行的余弦相似度（float32）"""
+    if vectors.dtype == np.float32:
+        return vectors @ query
+    sims = np.empty(len(vectors), dtype=np.float32)
+    buf = np.empty((min(_BLOCK_ROWS, len(vectors)), vectors.shape[1]), dtype=np.float32)
+    for start in range(0, len(vectors), _BLOCK_ROWS):
+        block = vectors[start:start + _BLOCK_ROWS]
+        np.copyto(buf[:len(block)], block, casting="unsafe")
+        sims[start:start + len(block)] = buf[:len(block)] @ query
+    if scales is not None:
+        sims *= scales
+    return sims
+
+
+class WorkspaceVectorCache:
+    def __init__(
+            self,
+            loader: Loader,
+            probe: Optional[Probe] = None,
+            max_bytes: int = config.VECTOR_CACHE_MAX_MB * 1024 * 1024,
+            max_chunks: int = config.VECTOR_CACHE_MAX_CHUNKS,
+            dtype: str = config.VECTOR_CACHE_DTYPE,
+            check_seconds: float = config.VECTOR_CACHE_CHECK_SECONDS,
+            debounce_seconds: float = config.VECTOR_CACHE_DEBOUNCE_SECONDS,
+    ):
+        """probe 为 None 时不做跨进程探测，只依赖本进程的变更回调"""
+        self.loader = loader
+        self.probe = probe
+        self.max_bytes = max_bytes
+        self.max_chunks = max_chunks
+        self.dtype = dtype
+        self.check_seconds = check_seconds
+        self.debounce_seconds = debounce_seconds
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._too_large: Set[str] = set()
+        self._generations: Dict[str, int] = {}  # 工作区被失效的次数，加载完成时据此判断是否作废
+        self._epoch = 0                          # 无法定位工作区的失效（如只有 chunk_id）使所有进行中的加载作废
+        self._loading: Set[str] = set()
+        self._checking: Set[str] = set()
+        self._changed_at: Dict[str, float] = {}  # 工作区最近一次失效的时间（monotonic），用于去抖
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vector-cache-load")
+        self.hits = 0
+        self.misses = 0
+        self.fallthrough = 0
+        self.debounced = 0
+        self.loads = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    # -------------------------
+    # 检索
+    # -------------------------
+
+    def search(self, workspace_id: str, vector: List[float], username: str, k: int,
+               doc_ids: Optional[List[str]] = None) -> Optional[List[Tuple[str, float]]]:
+        """
+        命中时返回按得分降序的 [(chunk_id, (1 + cos) / 2)]，与 ES cosine 得分口径一致；
+        未缓存或工作区过大时返回 None，由调用方走 ES
+        """
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(workspace_id)
+            if entry is None:
+                if workspace_id in self._too_large:
+                    self.fallthrough += 1
+                elif now - self._changed_at.get(workspace_id, float("-inf")) < self.debounce_seconds:
+                    self.debounced += 1  # 刚有写入，等写入停下来再加载
+                else:
+                    self.misses += 1
+                    self._schedule_load(workspace_id)
+                return None
+            self._entries.move_to_end(workspace_id)
+            self.hits += 1
+            if self.probe is not None and now - entry.checked_at >= self.check_seconds:
+                self._schedule_check(workspace_id, entry)
+
+        mask = entry.users == username
+        if doc_ids is not None:
+            mask &= np.isin(entry.doc_ids, list(doc_ids))
+        candidates = np.flatnonzero(mask)
+        if len(candidates) == 0 or k <= 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        if len(candidates) == len(entry.chunk_ids):
+            sims = cosine_scores(entry.vectors, entry.scales, query)
+        else:
+            sims = cosine_scores(entry.vectors[candidates],
+                                 None if entry.scales is None else entry.scales[candidates], query)
+        kk = min(k, len(sims))
+        top = np.argpartition(-sims, kk - 1)[:kk]
+        top = top[np.argsort(-sims[top])]
+        rows = top if len(candidates) == len(entry.chunk_ids) else candidates[top]
+        return [(entry.chunk_ids[r], (1.0 + float(s)) / 2) for r, s in zip(rows, sims[top])]
+
+    # -------------------------
+    # 加载与淘汰
+    # -------------------------
+
+    def _schedule_load(self, workspace_id: str):
+        """需持有锁"""
+        if workspace_id in self._loading:
+            return
+        self._loading.add(workspace_id)
+        self._pool.submit(self._load, workspace_id, self._generations.get(workspace_id, 0), self._epoch)
+
+    def _schedule_check(self, workspace_id: str, entry: _Entry):
+        """需持有锁"""
+        if workspace_id in self._checking or workspace_id in self._loading:
+            return
+        self._checking.add(workspace_id)
+        self._pool.submit(self._check, workspace_id, entry)
+
+    def _check(self, workspace_id: str, entry: _Entry):
+        """探测工作区签名；与加载时不同说明有其他进程写入，丢弃后立即重新加载"""
+        try:
+            signature = self.probe(workspace_id)
+        except Exception as e:
+            logger.error(f"❌ 探测工作区 {workspace_id} 失败: {e}")
+            signature = entry.signature
+        with self._lock:
+            self._checking.discard(workspace_id)
+            if self._entries.get(workspace_id) is not entry:
+                return
+            if signature == entry.signature:
+                entry.checked_at = time.monotonic()
+                return
+            self.stale += 1
+            self._invalidate(workspace_id)
+            self._changed_at.pop(workspace_id, None)  # 探测到的写入已可见，无需去抖
+            self._schedule_load(workspace_id)
+
+    def _load(self, workspace_id: str, generation: int, epoch: int):
+        start = time.perf_counter()
+        try:
+            # 签名在读取向量之前探测：读取期间若有写入，下一次探测必然不一致
+            signature = self.probe(workspace_id) if self.probe is not None else None
+            loaded = self.loader(workspace_id, self.max_chunks)
+        except Exception as e:
+            logger.error(f"❌ 加载工作区 {workspace_id} 的向量失败: {e}")
+            loaded = None
+            failed = True
+        else:
+            failed = False
+        with self._lock:
+            self._loading.discard(workspace_id)
+            if self._generations.get(workspace_id, 0) != generation or self._epoch != epoch:
+                return  # 加载期间有写入，丢弃，下次查询重新加载
+            if failed:
+                return
+            if loaded is None:
+                self._too_large.add(workspace_id)
+                return
+        chunk_ids, users, doc_ids, vectors = loaded
+        vectors, scales = quantize(vectors, self.dtype) if len(chunk_ids) else (np.empty((0, 0), np.float32), None)
+        entry = _Entry(
+            chunk_ids=np.array(chunk_ids, dtype=object),
+            users=np.array(users, dtype=object),
+            doc_ids=np.array(doc_ids, dtype=object),
+            vectors=vectors,
+            scales=scales,
+            nbytes=vectors.nbytes + (scales.nbytes if scales is not None else 0) + 3 * 8 * len(chunk_ids),
+            signature=signature,
+            checked_at=time.monotonic(),
+        )
+        with self._lock:
+            if self._generations.get(workspace_id, 0) != generation or self._epoch != epoch:
+                return
+            if entry.nbytes > self.max_bytes:
+                self._too_large.add(workspace_id)
+                return
+            self._drop(workspace_id)
+            self._entries[workspace_id] = entry
+            self._bytes += entry.nbytes
+            while self._bytes > self.max_bytes:
+                evicted, _ = next(iter(self._entries.items()))
+                self._drop(evicted)
+                self.evictions += 1
+            self.loads += 1
+        logger.info(f"📥 工作区 {workspace_id} 向量已缓存：{len(chunk_ids)} 个 chunk，"
+                    f"{entry.nbytes / 1024 / 1024:.1f}MB，耗时 {time.perf_counter() - start:.2f}s")
+
+    def _drop(self, workspace_id: str):
+        """需持有锁"""
+        entry = self._entries.pop(workspace_id, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+
+    # -------------------------
+    # 失效
+    # -------------------------
+
+    def invalidate_workspace(self, workspace_id: str):
+        with self._lock:
+            self._invalidate(workspace_id)
+
+    def _invalidate(self, workspace_id: str):
+        self._generations[workspace_id] = self._generations.get(workspace_id, 0) + 1
+        self._changed_at[workspace_id] = time.monotonic()
+        self._too_large.discard(workspace_id)
+        if workspace_id in self._entries:
+            self._drop(workspace_id)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._too_large.clear()
+            self._bytes = 0
+
+    def on_chunk_change(self, change: ChunkChange):
+        """注册到 SmallRAGDB.add_chunk_listener"""
+        with self._lock:
+            if change.workspace_ids:
+                # 存储已给出全部受影响的工作区，无需扫描各缓存条目
+                for ws in {str(ws) for ws in change.workspace_ids}:
+                    self._invalidate(ws)
+                return
+            # 工作区未知的变更（旧布局下按 chunk_id 更新/删除、按文档删除）使进行中的加载作废，并扫描各条目
+            self._epoch += 1
+            affected = set()
+            if change.chunk_ids:
+                ids = list(change.chunk_ids)
+                affected.update(ws for ws, e in self._entries.items() if np.isin(e.chunk_ids, ids).any())
+            if change.doc_id is not None:
+                affected.update(ws for ws, e in self._entries.items() if (e.doc_ids == change.doc_id).any())
+            if not change.workspace_ids and not change.chunk_ids and change.doc_id is None:
+                affected.update(self._entries)
+            for ws in affected:
+                self._invalidate(ws)
+
+    # -------------------------
+    # 统计
+    # -------------------------
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses + self.fallthrough + self.debounced
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "fallthrough": self.fallthrough,
+                "debounced": self.debounced,
+                "hit_rate": self.hits / total if total else 0.0,
+                "workspaces": len(self._entries),
+                "chunks": sum(len(e.chunk_ids) for e in self._entries.values()),
+                "memory_mb": self._bytes / 1024 / 1024,
+                "max_memory_mb": self.max_bytes / 1024 / 1024,
+                "dtype": self.dtype,
+                "too_large": len(self._too_large),
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "stale_reloads": self.stale,
+            }